@@ -2,8 +2,55 @@
 Wrapper on top of OpenAI & LangChain integration which allow to:
 - await for TPM/RPM limits instead of hitting them and then retrying
 - use multiple API keys
+
+Wrappers are imported lazily (on first access), so importing the package is cheap
+and does not pull LangChain chat models or tokenizers unless they are used.
 """
-from .choose_key_chat_openai import ChooseKeyChatOpenAI
-from .limit_await_chat_openai import LimitAwaitChatOpenAI
-from .choose_key_openai_embeddings import ChooseKeyOpenAIEmbeddings
-from .limit_await_openai_embeddings import LimitAwaitOpenAIEmbeddings
+import importlib
+from typing import TYPE_CHECKING, Any, List
+
+
+_LAZY_IMPORTS = {
+    "ChooseKeyChatOpenAI": ".choose_key_chat_openai",
+    "FallbackChatOpenAI": ".fallback_chat_openai",
+    "FallbackTier": ".fallback_chat_openai",
+    "LimitAwaitChatOpenAI": ".limit_await_chat_openai",
+    "ChooseKeyOpenAIEmbeddings": ".choose_key_openai_embeddings",
+    "LimitAwaitOpenAIEmbeddings": ".limit_await_openai_embeddings",
+    "AIMDSettings": ".concurrency_limit",
+    "ResponseCache": ".response_cache",
+    "EmbeddingCache": ".embedding_cache",
+    "BatchOffload": ".batch_offload",
+    "BatchUploader": ".batch_offload",
+    "OpenAIBatchUploader": ".batch_offload",
+    "SnapshotExporter": ".introspection",
+}
+
+__all__ = list(_LAZY_IMPORTS)
+
+if TYPE_CHECKING:
+    from .choose_key_chat_openai import ChooseKeyChatOpenAI
+    from .fallback_chat_openai import FallbackChatOpenAI, FallbackTier
+    from .limit_await_chat_openai import LimitAwaitChatOpenAI
+    from .choose_key_openai_embeddings import ChooseKeyOpenAIEmbeddings
+    from .limit_await_openai_embeddings import LimitAwaitOpenAIEmbeddings
+    from .concurrency_limit import AIMDSettings
+    from .response_cache import ResponseCache
+    from .embedding_cache import EmbeddingCache
+    from .batch_offload import BatchOffload, BatchUploader, OpenAIBatchUploader
+    from .introspection import SnapshotExporter
+
+
+def __getattr__(name: str) -> Any:
+    """
+    Import wrapper on first access
+    """
+    if name not in _LAZY_IMPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_LAZY_IMPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(__all__))
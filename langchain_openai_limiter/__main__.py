@@ -0,0 +1,9 @@
+"""
+Print limiter state exported by a running process: `python -m langchain_openai_limiter`
+"""
+import sys
+from .introspection import main
+
+
+if __name__ == "__main__":
+    sys.exit(main())
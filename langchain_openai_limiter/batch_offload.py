@@ -0,0 +1,291 @@
+"""
+Module for deferred (batch job) request offload.
+
+Non-urgent requests are written to JSONL batch files instead of being sent
+against live RPM/TPM limits. Files are submitted through a pluggable uploader
+(OpenAI batch API has separate, larger quotas), a background thread polls jobs
+for completion and resolves futures of the original requests.
+"""
+from abc import ABC, abstractmethod
+import asyncio
+from concurrent.futures import Future
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Tuple, Union
+
+
+# OpenAI limit of requests in a single batch file
+_BATCH_MAX_REQUESTS = 50000
+_BATCH_FLUSH_DELAY = 60.0
+_BATCH_POLL_INTERVAL = 60.0
+_BATCH_COMPLETION_WINDOW = "24h"
+_FAILED_BATCH_STATUSES = ("failed", "expired", "cancelled")
+CHAT_COMPLETIONS_ENDPOINT = "/v1/chat/completions"
+EMBEDDINGS_ENDPOINT = "/v1/embeddings"
+
+
+class BatchUploader(ABC):
+    """
+    Batch job backend: OpenAI batch API, or a local stand-in
+    """
+    @abstractmethod
+    def submit(self, path: str, endpoint: str) -> str:
+        """
+        Submit JSONL batch file
+        :param path: Batch file path
+        :param endpoint: Endpoint of all file requests (like "/v1/chat/completions")
+        :return: Job ID
+        """
+
+    @abstractmethod
+    def result(self, job_id: str) -> Union[str, None]:
+        """
+        Check the job (raising an exception if it failed)
+        :return: Path of JSONL file with job results or None if the job still runs
+        """
+
+
+class OpenAIBatchUploader(BatchUploader):
+    """
+    Uploader to OpenAI batch API
+    """
+    def __init__(self, openai_api_key: str, directory: Union[str, None] = None):
+        """
+        :param openai_api_key: API key to run batch jobs with
+        :param directory: Where to download job results (None - temporary directory)
+        """
+        self.openai_api_key = openai_api_key
+        self.directory = directory or tempfile.mkdtemp(prefix="openai-batch-")
+
+    def _request(self, method: str, url: str, params: Union[dict, None] = None) -> dict:
+        """
+        Call OpenAI API endpoint which has no client method
+        """
+        # pylint: disable=import-outside-toplevel
+        import openai.api_requestor
+        # pylint: enable=import-outside-toplevel
+        requestor = openai.api_requestor.APIRequestor(key=self.openai_api_key)
+        response, _, _ = requestor.request(method, url, params)
+        return response.data
+
+    def submit(self, path: str, endpoint: str) -> str:
+        # pylint: disable=import-outside-toplevel
+        import openai
+        # pylint: enable=import-outside-toplevel
+        with open(path, "rb") as src:
+            batch_file = openai.File.create(file=src, purpose="batch",
+                                            api_key=self.openai_api_key)
+        job = self._request("post", "/batches", {
+            "input_file_id": batch_file["id"],
+            "endpoint": endpoint,
+            "completion_window": _BATCH_COMPLETION_WINDOW,
+        })
+        return job["id"]
+
+    def result(self, job_id: str) -> Union[str, None]:
+        # pylint: disable=import-outside-toplevel
+        import openai
+        # pylint: enable=import-outside-toplevel
+        job = self._request("get", f"/batches/{job_id}")
+        if job["status"] in _FAILED_BATCH_STATUSES:
+            raise RuntimeError(f"Batch job {job_id} is {job['status']}: {job.get('errors')}")
+        if job["status"] != "completed":
+            return None
+        path = os.path.join(self.directory, f"{job_id}.jsonl")
+        with open(path, "wb") as dst:
+            for file_id in (job.get("output_file_id"), job.get("error_file_id")):
+                if file_id:
+                    content = openai.File.download(file_id, api_key=self.openai_api_key)
+                    dst.write(content.rstrip(b"\n") + b"\n")
+        return path
+
+
+def _response_body(line: dict) -> Union[dict, Exception]:
+    """
+    Response body of the batch result line (or exception if the request failed)
+    """
+    response = line.get("response") or {}
+    if line.get("error") or response.get("status_code") != 200:
+        return RuntimeError(f"Batch request failed: {line.get('error') or response.get('body')}")
+    return response["body"]
+
+
+class BatchOffload:
+    """
+    Deferred request queue. Requests are collected into one batch file per endpoint,
+    which is submitted when it is full or its oldest request waited `flush_delay`.
+    The instance is shared (not copied) when wrappers are deep-copied.
+    """
+    def __init__(self, uploader: BatchUploader,
+                 directory: Union[str, None] = None,
+                 max_requests: int = _BATCH_MAX_REQUESTS,
+                 flush_delay: float = _BATCH_FLUSH_DELAY,
+                 poll_interval: float = _BATCH_POLL_INTERVAL):
+        """
+        :param uploader: Batch job backend
+        :param directory: Where to write batch files (None - temporary directory)
+        :param max_requests: Max requests in one batch file
+        :param flush_delay: How long (in seconds) requests may wait for the file to fill up
+        :param poll_interval: How often (in seconds) to check submitted jobs
+        """
+        self.uploader = uploader
+        self.directory = directory or tempfile.mkdtemp(prefix="openai-batch-")
+        self.max_requests = max_requests
+        self.flush_delay = flush_delay
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker: Union[threading.Thread, None] = None
+        self._custom_ids = itertools.count()
+        # Queued requests and the time the oldest of them was queued, per endpoint
+        self._pending: Dict[str, List[Tuple[str, dict, Future]]] = {}
+        self._pending_since: Dict[str, float] = {}
+        self._jobs: Dict[str, Dict[str, Future]] = {}
+
+    def __deepcopy__(self, memo: dict) -> "BatchOffload":
+        return self
+
+    def _enqueue(self, endpoint: str, body: dict) \
+        -> Tuple[Future, Union[List[Tuple[str, dict, Future]], None]]:
+        """
+        Queue request to the endpoint batch file
+        :return: Future of the response body and requests of the batch file
+          if the request filled it up (to be uploaded by the caller)
+        """
+        future = Future()
+        with self._lock:
+            pending = self._pending.setdefault(endpoint, [])
+            if not pending:
+                self._pending_since[endpoint] = time.monotonic()
+            pending.append((str(next(self._custom_ids)), body, future))
+            full = self._take(endpoint) if len(pending) >= self.max_requests else None
+            self._start_worker()
+        self._wakeup.set()
+        return future, full
+
+    def submit(self, endpoint: str, body: dict) -> Future:
+        """
+        Queue request to the batch file
+        :return: Future of the response body
+        """
+        future, full = self._enqueue(endpoint, body)
+        if full is not None:
+            self._upload(endpoint, full)
+        return future
+
+    async def asubmit(self, endpoint: str, body: dict) -> Any:
+        """
+        Queue request to the batch file and wait for the response body
+        (filled up batch file is uploaded in the executor, not in the event loop)
+        """
+        future, full = self._enqueue(endpoint, body)
+        if full is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._upload, endpoint, full)
+        return await asyncio.wrap_future(future)
+
+    def flush(self) -> None:
+        """
+        Submit queued requests right now
+        """
+        with self._lock:
+            batches = [(endpoint, self._take(endpoint)) for endpoint in list(self._pending)]
+        for endpoint, pending in batches:
+            self._upload(endpoint, pending)
+
+    def _start_worker(self) -> None:
+        """
+        (INNER VERSION) Start the background loop if it is not running
+        """
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._work, daemon=True)
+            self._worker.start()
+
+    def _take(self, endpoint: str) -> List[Tuple[str, dict, Future]]:
+        """
+        (INNER VERSION) Take queued requests of the endpoint to upload them
+        """
+        del self._pending_since[endpoint]
+        return self._pending.pop(endpoint)
+
+    def _upload(self, endpoint: str, pending: List[Tuple[str, dict, Future]]) -> None:
+        """
+        Write requests to the batch file and submit it (without holding the lock,
+        so other requests are queued meanwhile)
+        """
+        path = os.path.join(self.directory, f"batch-{pending[0][0]}.jsonl")
+        try:
+            with open(path, "w", encoding="utf-8") as dst:
+                for custom_id, body, _ in pending:
+                    dst.write(json.dumps({
+                        "custom_id": custom_id,
+                        "method": "POST",
+                        "url": endpoint,
+                        "body": body,
+                    }) + "\n")
+            job_id = self.uploader.submit(path, endpoint)
+        except Exception as error: # pylint: disable=broad-exception-caught
+            for _, _, future in pending:
+                future.set_exception(error)
+            return
+        with self._lock:
+            self._jobs[job_id] = {custom_id: future for custom_id, _, future in pending}
+            self._start_worker()
+        self._wakeup.set()
+
+    def _resolve(self, job_id: str, futures: Dict[str, Future]) -> bool:
+        """
+        Resolve futures of the job if it is finished
+        :return: Whether the job is finished
+        """
+        try:
+            path = self.uploader.result(job_id)
+        except Exception as error: # pylint: disable=broad-exception-caught
+            for future in futures.values():
+                future.set_exception(error)
+            return True
+        if path is None:
+            return False
+        with open(path, "r", encoding="utf-8") as src:
+            for row in src:
+                if not row.strip():
+                    continue
+                line = json.loads(row)
+                future = futures.pop(line["custom_id"], None)
+                if future is None:
+                    continue
+                body = _response_body(line)
+                if isinstance(body, Exception):
+                    future.set_exception(body)
+                else:
+                    future.set_result(body)
+        for custom_id, future in futures.items():
+            future.set_exception(RuntimeError(f"Batch job {job_id} has no result of "
+                                              f"request {custom_id}"))
+        return True
+
+    def _work(self) -> None:
+        """
+        Background loop: submit batch files which waited long enough and poll jobs
+        """
+        while True:
+            with self._lock:
+                current_time = time.monotonic()
+                batches = [(endpoint, self._take(endpoint))
+                           for endpoint, pending_since in list(self._pending_since.items())
+                           if current_time - pending_since >= self.flush_delay]
+                jobs = list(self._jobs.items())
+                if not batches and not jobs and not self._pending:
+                    self._worker = None
+                    return
+            for endpoint, pending in batches:
+                self._upload(endpoint, pending)
+            for job_id, futures in jobs:
+                if self._resolve(job_id, futures):
+                    with self._lock:
+                        del self._jobs[job_id]
+            self._wakeup.wait(min(self.poll_interval, self.flush_delay))
+            self._wakeup.clear()
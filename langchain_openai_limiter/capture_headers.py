@@ -1,15 +1,21 @@
 """
-Module which set hooks to catch limit-related headers from the OpenAI response
+Module which set hooks to catch limit-related headers from the OpenAI response.
+
+Hooks mutate `openai` globals, so they are attached on the first request
+(not on import), and `openai` / HTTP clients are imported only then.
 """
 from datetime import datetime, timedelta
 import json
-from typing import Callable, Tuple, Union
-import aiohttp
-import openai
-import openai.api_requestor
-import requests
+import threading
+import time
+from typing import TYPE_CHECKING, Tuple, Union
 from .reset_time_parser import reset_time_to_ms
-from .limit_info import OrganizationLimitInfo, ApiKey, ModelName, set_limit_info, aset_limit_info
+from .limit_info import OrganizationLimitInfo, ApiKey, ModelName, set_limit_info, \
+    aset_limit_info, learn_model_alias, model_aliases_pending, record_rtt, arecord_rtt
+
+if TYPE_CHECKING:
+    import aiohttp
+    import requests
 
 
 def _extract_openai_api_key(authorization: str) -> ApiKey:
@@ -21,6 +27,25 @@ def _extract_openai_api_key(authorization: str) -> ApiKey:
     return openai_api_key
 
 
+# Headers which per-minute limits are read from
+_LIMIT_HEADERS = (
+    "x-ratelimit-limit-requests",
+    "x-ratelimit-limit-tokens",
+    "x-ratelimit-remaining-requests",
+    "x-ratelimit-remaining-tokens",
+    "x-ratelimit-reset-requests",
+    "x-ratelimit-reset-tokens",
+)
+
+
+def _has_limit_headers(headers: dict) -> bool:
+    """
+    Whether the response has limit headers (responses of files, batches and other
+    non-model endpoints do not)
+    """
+    return all(name in headers for name in _LIMIT_HEADERS)
+
+
 def _extract_limit_info(headers: dict) -> Tuple[Union[None, ModelName],\
                                                 OrganizationLimitInfo]:
     """
@@ -37,7 +62,7 @@ def _extract_limit_info(headers: dict) -> Tuple[Union[None, ModelName],\
     tpm_reset_ms = reset_time_to_ms(headers["x-ratelimit-reset-tokens"])
     rpm_reset_time = current_time + timedelta(milliseconds=rpm_reset_ms)
     tpm_reset_time = current_time + timedelta(milliseconds=tpm_reset_ms)
-    return model_name, OrganizationLimitInfo(
+    limit_info = OrganizationLimitInfo(
         tpm_total=tpm_total,
         tpm_remain=tpm_remain,
         rpm_total=rpm_total,
@@ -45,47 +70,109 @@ def _extract_limit_info(headers: dict) -> Tuple[Union[None, ModelName],\
         rpm_reset_time=rpm_reset_time,
         tpm_reset_time=tpm_reset_time,
     )
+    _extract_daily_limit_info(headers, limit_info, current_time)
+    return model_name, limit_info
+
+
+def _extract_daily_limit_info(headers: dict, limit_info: OrganizationLimitInfo,
+                              current_time: datetime) -> None:
+    """
+    Parse daily quotas (sent for some models and tiers) into limit info
+    """
+    if "x-ratelimit-limit-requests-day" in headers:
+        limit_info.rpd_total = int(headers["x-ratelimit-limit-requests-day"])
+        limit_info.rpd_remain = int(headers["x-ratelimit-remaining-requests-day"])
+    if "x-ratelimit-limit-tokens-day" in headers:
+        limit_info.tpd_total = int(headers["x-ratelimit-limit-tokens-day"])
+        limit_info.tpd_remain = int(headers["x-ratelimit-remaining-tokens-day"])
+    if limit_info.rpd_total is None and limit_info.tpd_total is None:
+        return
+    reset_ms = max(
+        [reset_time_to_ms(headers[name])
+         for name in ("x-ratelimit-reset-requests-day", "x-ratelimit-reset-tokens-day")
+         if name in headers],
+        default=24 * 60 * 60 * 1000,
+    )
+    limit_info.daily_reset_time = current_time + timedelta(milliseconds=reset_ms)
+
+
+def _extract_rtt(elapsed: float, headers: dict) -> Union[float, None]:
+    """
+    Estimate network round trip of the request: response time without server processing
+    :param elapsed: Seconds between sending the request and receiving response headers
+    :return: Round trip (seconds) or None if processing time is unknown
+    """
+    if "openai-processing-ms" not in headers:
+        return None
+    return max(elapsed - float(headers["openai-processing-ms"]) / 1000, 0.0)
+
+
+# Hooks are attached once, even if a few threads send their first requests together
+_ATTACH_HOOKS_LOCK = threading.Lock()
 
 
 # region Sync stuff
 _ATTACHED_SYNC_SESSION_HOOKS = False
 
 
+def _requested_model_name(request: "requests.PreparedRequest") -> Union[ModelName, None]:
+    """
+    Model name from the request body
+    :return: Model name or None if the body is not a JSON object (like a file upload)
+    """
+    content_type = request.headers.get("content-type", "")
+    if not request.body or not content_type.startswith("application/json"):
+        return None
+    try:
+        body = json.loads(request.body)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(body, dict):
+        return None
+    return body.get("model")
+
+
 # pylint: disable=unused-argument
-def _response_hook(response: requests.Response, *args, **kwargs) -> None:
+def _response_hook(response: "requests.Response", *args, **kwargs) -> None:
     """
-    Hook for `requests` session
+    Hook for `requests` responses of openai
     """
+    if not _has_limit_headers(response.headers):
+        return
     api_key = _extract_openai_api_key(response.request.headers["authorization"])
     model_name, limit_info = _extract_limit_info(response.headers)
+    requested_model_name = None
+    # Requests may be large, so their bodies are parsed only if the model name is needed
+    if model_name is None or model_aliases_pending():
+        requested_model_name = _requested_model_name(response.request)
     if model_name is None:
-        model_name = json.loads(response.request.body).get("model")
-    assert model_name is not None
-    set_limit_info(model_name, api_key, limit_info)
+        model_name = requested_model_name
+    elif requested_model_name is not None:
+        learn_model_alias(requested_model_name, model_name)
+    if model_name is None: # Not a model request
+        return
+    set_limit_info(model_name, api_key, limit_info,
+                   response.headers.get("openai-organization"))
+    rtt = _extract_rtt(response.elapsed.total_seconds(), response.headers)
+    if rtt is not None:
+        record_rtt(api_key, rtt)
 # pylint: enable=unused-argument
 
 
-def _attach_to_session(session: requests.Session) -> None:
+def _wrap_request_raw(old_request_raw):
     """
-    Attach `_response_hook` hook to `requests` session
+    Wrap old `openai.api_requestor.APIRequestor.request_raw` in
+    a new decorator able to call our hook. Unlike `requests` session hooks it also sees
+    requests sent via sessions openai has already cached per thread
+    :param old_request_raw: Original `openai.api_requestor.APIRequestor.request_raw`
+    :return: decorated `openai.api_requestor.APIRequestor.request_raw`
     """
-    original_hook = session.hooks.get("response")
-    if not isinstance(original_hook, list):
-        original_hook = [original_hook]
-    session.hooks["response"] = original_hook + [_response_hook]
-
-
-def _attach_to_session_getter(getter: Callable[[], requests.Session]) -> \
-    Callable[[], requests.Session]:
-    """
-    Attach `_response_hook` hook to `requests` session generator
-    """
-    def new_getter() -> requests.Session:
-        session = getter()
-        _attach_to_session(session)
-        return session
+    def request_raw(self, *args, **kwargs) -> "requests.Response":
+        response: "requests.Response" = old_request_raw(self, *args, **kwargs)
+        _response_hook(response)
+        return response
 
-    return new_getter
+    return request_raw
 
 
 def _attach_sync_session_hooks():
@@ -95,14 +182,17 @@ def _attach_sync_session_hooks():
     # pylint: disable=global-statement
     global _ATTACHED_SYNC_SESSION_HOOKS
     # pylint: enable=global-statement
-    if not _ATTACHED_SYNC_SESSION_HOOKS:
-        _ATTACHED_SYNC_SESSION_HOOKS = True
-        if openai.requestssession is None:
-            openai.requestssession = requests.Session()
-        if isinstance(openai.requestssession, requests.Session):
-            _attach_to_session(openai.requestssession)
-        elif callable(openai.requestssession):
-            openai.requestssession = _attach_to_session_getter(openai.requestssession)
+    if _ATTACHED_SYNC_SESSION_HOOKS:
+        return
+    with _ATTACH_HOOKS_LOCK:
+        if not _ATTACHED_SYNC_SESSION_HOOKS:
+            # pylint: disable=import-outside-toplevel
+            import openai.api_requestor
+            # pylint: enable=import-outside-toplevel
+            old_request_raw = openai.api_requestor.APIRequestor.request_raw
+            new_request_raw = _wrap_request_raw(old_request_raw)
+            openai.api_requestor.APIRequestor.request_raw = new_request_raw
+            _ATTACHED_SYNC_SESSION_HOOKS = True
 # endregion
 
 
@@ -117,14 +207,27 @@ def _wrap_arequest_raw(old_arequest_raw):
     :param old_arequest_raw: Original `openai.api_requestor.APIRequestor.arequest_raw`
     :return: decorated `openai.api_requestor.APIRequestor.arequest_raw`
     """
-    async def arequest_raw(self, *args, **kwargs) -> aiohttp.ClientResponse:
-        response: aiohttp.ClientResponse = await old_arequest_raw(self, *args, **kwargs)
+    async def arequest_raw(self, *args, **kwargs) -> "aiohttp.ClientResponse":
+        start_time = time.monotonic()
+        response: "aiohttp.ClientResponse" = await old_arequest_raw(self, *args, **kwargs)
+        elapsed = time.monotonic() - start_time
+        if not _has_limit_headers(response.headers):
+            return response
         api_key = _extract_openai_api_key(response.request_info.headers["authorization"])
         model_name, limit_info = _extract_limit_info(response.headers)
+        requested_model_name = (kwargs.get("params") or {}).get("model") \
+            or response.request_info.headers.get("x-model")
         if model_name is None:
-            model_name = response.request_info.headers.get("x-model")
-        assert model_name is not None
-        await aset_limit_info(model_name, api_key, limit_info)
+            model_name = requested_model_name
+        elif requested_model_name is not None:
+            learn_model_alias(requested_model_name, model_name)
+        if model_name is None: # Not a model request
+            return response
+        await aset_limit_info(model_name, api_key, limit_info,
+                              response.headers.get("openai-organization"))
+        rtt = _extract_rtt(elapsed, response.headers)
+        if rtt is not None:
+            await arecord_rtt(api_key, rtt)
         return response
 
     return arequest_raw
@@ -137,17 +240,24 @@ def _attach_async_session_hooks():
     # pylint: disable=global-statement
     global _ATTACHED_ASYNC_SESSION_HOOKS
     # pylint: enable=global-statement
-    if not _ATTACHED_ASYNC_SESSION_HOOKS:
-        _ATTACHED_ASYNC_SESSION_HOOKS = True
-        old_arequest_raw = openai.api_requestor.APIRequestor.arequest_raw
-        new_arequest_raw = _wrap_arequest_raw(old_arequest_raw)
-        openai.api_requestor.APIRequestor.arequest_raw = new_arequest_raw
+    if _ATTACHED_ASYNC_SESSION_HOOKS:
+        return
+    with _ATTACH_HOOKS_LOCK:
+        if not _ATTACHED_ASYNC_SESSION_HOOKS:
+            # pylint: disable=import-outside-toplevel
+            import openai.api_requestor
+            # pylint: enable=import-outside-toplevel
+            old_arequest_raw = openai.api_requestor.APIRequestor.arequest_raw
+            new_arequest_raw = _wrap_arequest_raw(old_arequest_raw)
+            openai.api_requestor.APIRequestor.arequest_raw = new_arequest_raw
+            _ATTACHED_ASYNC_SESSION_HOOKS = True
 # endregion
 
 
 def attach_session_hooks():
     """
     Attach both synchronyous and asynchronyous hooks
+    (wrappers do it before their first request, so it is cheap to call repeatedly)
     """
     _attach_sync_session_hooks()
     _attach_async_session_hooks()
@@ -1,23 +1,34 @@
 """
 Wrapper to choose between a few OpenAI keys before chat generation
 """
+import asyncio
 import copy
-from typing import Any, AsyncIterator, Iterator, List, Union
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Tuple, Union
 from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
 from langchain.chat_models.base import BaseChatModel
 from langchain.chat_models import ChatOpenAI
 from langchain.schema.output import ChatGenerationChunk, ChatResult
 from langchain.schema.messages import BaseMessage
+from langchain.schema.runnable import Runnable
 from .capture_headers import attach_session_hooks
-from .limit_info import choose_key, achoose_key, ApiKey
-from .limit_await_chat_openai import LimitAwaitChatOpenAI
+from .limit_batch import LimitAwareBatchMixin, LIMIT_ADMITTED_KWARG
+from .hedging import observed_hedge_delay, record_latency
+from .single_flight import request_key
+from .tenant_quota import TENANT_KWARG
+from .limit_info import choose_key, achoose_key, areserve_any_key, await_for_any_key, \
+    choose_key_by_affinity, achoose_key_by_affinity, keys_of_other_owners, ApiKey, \
+    LimitReservation
+from .limit_await_chat_openai import LimitAwaitChatOpenAI, TOKEN_COUNT_KWARG
+from .token_counter import num_tokens_from_messages, anum_tokens_from_messages, \
+    estimate_num_tokens_from_messages
 
 
 _LIMIT_AWAIT_SLEEP = 0.01
 _LIMIT_AWAIT_TIMEOUT = 60.0
 
 
-class ChooseKeyChatOpenAI(BaseChatModel):
+class ChooseKeyChatOpenAI(LimitAwareBatchMixin, BaseChatModel):
     """
     Key-choosing OpenAI chat wrapper
     """
@@ -25,6 +36,15 @@ class ChooseKeyChatOpenAI(BaseChatModel):
                                # we will use base model her
                                # than introduce specific property and validatior
     openai_api_keys: List[ApiKey] # API keys
+    limit_await_timeout: float = _LIMIT_AWAIT_TIMEOUT # How long batch items may wait for limits
+    limit_await_sleep: float = _LIMIT_AWAIT_SLEEP
+    hedge: bool = False # Send a second request via another key if the first one is slow.
+                        # Only async generation is hedged
+    hedge_delay: Union[float, None] = None # Seconds to wait before hedging.
+                                           # None - observed 95th latency percentile
+    prefix_affinity: bool = False # Route requests with the same leading messages to the same
+                                  # key (organization), so OpenAI prompt cache is hit
+    prefix_affinity_messages: int = 1 # How many leading messages make the prefix
 
     @property
     def _chat_model(self) -> Union[ChatOpenAI, LimitAwaitChatOpenAI]:
@@ -54,19 +74,113 @@ class ChooseKeyChatOpenAI(BaseChatModel):
 
     def get_num_tokens_from_messages(self, messages: List[BaseMessage]) -> int:
         """
-        Calculates number of tokens
+        Calculates number of tokens (reusing cached counts of already seen messages)
+        """
+        chat_model = self._chat_model
+        if isinstance(chat_model, LimitAwaitChatOpenAI):
+            return chat_model.get_num_tokens_from_messages(messages)
+        return num_tokens_from_messages(chat_model, messages)
+
+    async def aget_num_tokens_from_messages(self, messages: List[BaseMessage]) -> int:
+        """
+        Calculates number of tokens without blocking the event loop on large inputs
+        """
+        chat_model = self._chat_model
+        if isinstance(chat_model, LimitAwaitChatOpenAI):
+            return await chat_model.aget_num_tokens_from_messages(messages)
+        return await anum_tokens_from_messages(chat_model, messages)
+
+    @property
+    def _estimate_tokens(self) -> bool:
+        """
+        Whether the wrapped limit awaiting model admits requests by token estimates
+        """
+        chat_model = self._chat_model
+        return isinstance(chat_model, LimitAwaitChatOpenAI) and chat_model.estimate_tokens
+
+    def _choice_token_count(self, messages: List[BaseMessage], kwargs: dict) -> int:
+        """
+        Token count to choose key by: the one passed by the outer wrapper
+        (like FallbackChatOpenAI), exact one or a cheap estimate
+        (if the wrapped model counts tokens exactly only when needed)
+        """
+        if kwargs.get(TOKEN_COUNT_KWARG) is not None:
+            return kwargs[TOKEN_COUNT_KWARG]
+        if self._estimate_tokens:
+            return estimate_num_tokens_from_messages(messages)
+        return self.get_num_tokens_from_messages(messages)
+
+    async def _achoice_token_count(self, messages: List[BaseMessage], kwargs: dict) -> int:
+        """
+        Async version of `_choice_token_count`
+        """
+        if kwargs.get(TOKEN_COUNT_KWARG) is not None:
+            return kwargs[TOKEN_COUNT_KWARG]
+        if self._estimate_tokens:
+            return estimate_num_tokens_from_messages(messages)
+        return await self.aget_num_tokens_from_messages(messages)
+
+    def _pass_token_count(self, chat_openai: Union[ChatOpenAI, LimitAwaitChatOpenAI],
+                          token_count: int, kwargs: dict) -> dict:
+        """
+        Pass calculated token count down to LimitAwaitChatOpenAI, so it won't count it again
+        (ChatOpenAI does not await limits, so it does not get the token count
+        and the request tenant either)
+        """
+        if not isinstance(chat_openai, LimitAwaitChatOpenAI):
+            kwargs = {key: value for key, value in kwargs.items()
+                      if key not in (TENANT_KWARG, TOKEN_COUNT_KWARG)}
+        elif not self._estimate_tokens:
+            kwargs = dict(kwargs, **{TOKEN_COUNT_KWARG: token_count})
+        return kwargs
+
+    def _affinity_key(self, messages: List[BaseMessage]) -> str:
+        """
+        Hash of the leading messages to route by
+        """
+        return request_key([
+            message.dict()
+            for message in messages[:self.prefix_affinity_messages]
+        ])
+
+    def _choose_key(self, messages: List[BaseMessage], token_count: int) -> ApiKey:
+        """
+        Choose API key for the request (by prefix affinity, if it is enabled)
         """
-        return self._chat_model.get_num_tokens_from_messages(messages)
+        attach_session_hooks()
+        if self.prefix_affinity:
+            return choose_key_by_affinity(self.model_name, self.openai_api_keys, token_count,
+                                          self._affinity_key(messages))
+        return choose_key(self.model_name, self.openai_api_keys, token_count)
+
+    async def _achoose_key(self, messages: List[BaseMessage], token_count: int) -> ApiKey:
+        """
+        Async version of `_choose_key`
+        """
+        attach_session_hooks()
+        if self.prefix_affinity:
+            return await achoose_key_by_affinity(self.model_name, self.openai_api_keys,
+                                                 token_count, self._affinity_key(messages))
+        return await achoose_key(self.model_name, self.openai_api_keys, token_count)
+
+    def _batch_api_keys(self) -> List[ApiKey]:
+        return self.openai_api_keys
+
+    def _batch_runnable(self, api_key: ApiKey) -> Tuple[Runnable, Dict[str, Any]]:
+        chat_openai = copy.deepcopy(self._chat_model)
+        chat_openai.openai_api_key = api_key
+        if isinstance(chat_openai, LimitAwaitChatOpenAI):
+            return chat_openai, {LIMIT_ADMITTED_KWARG: True}
+        return chat_openai, {}
 
     def _stream(self, messages: List[BaseMessage],
                 stop: List[str] | None = None,
                 run_manager: CallbackManagerForLLMRun | None = None,
                 **kwargs: Any) -> Iterator[ChatGenerationChunk]:
-        token_count = self.get_num_tokens_from_messages(messages)
+        token_count = self._choice_token_count(messages, kwargs)
         chat_openai = copy.deepcopy(self._chat_model)
-        chat_openai.openai_api_key = choose_key(chat_openai.model_name,
-                                                self.openai_api_keys,
-                                                token_count)
+        kwargs = self._pass_token_count(chat_openai, token_count, kwargs)
+        chat_openai.openai_api_key = self._choose_key(messages, token_count)
         # pylint: disable=protected-access
         for chunk in chat_openai._stream(messages, stop, run_manager, **kwargs):
             yield chunk
@@ -78,11 +192,10 @@ class ChooseKeyChatOpenAI(BaseChatModel):
                        stop: List[str] | None = None,
                        run_manager: AsyncCallbackManagerForLLMRun | None = None,
                        **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
-        token_count = self.get_num_tokens_from_messages(messages)
+        token_count = await self._achoice_token_count(messages, kwargs)
         chat_openai = copy.deepcopy(self._chat_model)
-        chat_openai.openai_api_key = await achoose_key(chat_openai.model_name,
-                                                       self.openai_api_keys,
-                                                       token_count)
+        kwargs = self._pass_token_count(chat_openai, token_count, kwargs)
+        chat_openai.openai_api_key = await self._achoose_key(messages, token_count)
         # pylint: disable=protected-access
         async for chunk in chat_openai._astream(messages, stop, run_manager, **kwargs):
             yield chunk
@@ -93,12 +206,10 @@ class ChooseKeyChatOpenAI(BaseChatModel):
                   stop: List[str] | None = None,
                   run_manager: CallbackManagerForLLMRun | None = None,
                   **kwargs: Any) -> ChatResult:
-        token_count = self.get_num_tokens_from_messages(messages)
+        token_count = self._choice_token_count(messages, kwargs)
         chat_openai = copy.deepcopy(self._chat_model)
-        chosen_key = choose_key(chat_openai.model_name,
-                                self.openai_api_keys,
-                                token_count)
-        chat_openai.openai_api_key = chosen_key
+        kwargs = self._pass_token_count(chat_openai, token_count, kwargs)
+        chat_openai.openai_api_key = self._choose_key(messages, token_count)
         # pylint: disable=protected-access
         return chat_openai._generate(messages,
                                      stop,
@@ -110,11 +221,13 @@ class ChooseKeyChatOpenAI(BaseChatModel):
                          stop: List[str] | None = None,
                          run_manager: AsyncCallbackManagerForLLMRun | None = None,
                          **kwargs: Any) -> ChatResult:
-        token_count = self.get_num_tokens_from_messages(messages)
+        token_count = await self._achoice_token_count(messages, kwargs)
+        if self.hedge:
+            return await self._ahedged_generate(messages, stop, run_manager, token_count,
+                                                kwargs)
         chat_openai = copy.deepcopy(self._chat_model)
-        chat_openai.openai_api_key = await achoose_key(chat_openai.model_name,
-                                                       self.openai_api_keys,
-                                                       token_count)
+        kwargs = self._pass_token_count(chat_openai, token_count, kwargs)
+        chat_openai.openai_api_key = await self._achoose_key(messages, token_count)
         # pylint: disable=protected-access
         return await chat_openai._agenerate(messages,
                                             stop,
@@ -122,5 +235,84 @@ class ChooseKeyChatOpenAI(BaseChatModel):
                                             **kwargs)
         # pylint: enable=protected-access
 
+    async def _agenerate_with_key(self, api_key: ApiKey, messages: List[BaseMessage],
+                                  stop: List[str] | None,
+                                  run_manager: AsyncCallbackManagerForLLMRun | None,
+                                  kwargs: dict) -> ChatResult:
+        """
+        Generate via given API key, which limits were already reserved
+        """
+        chat_openai = copy.deepcopy(self._chat_model)
+        chat_openai.openai_api_key = api_key
+        if isinstance(chat_openai, LimitAwaitChatOpenAI):
+            kwargs = dict(kwargs, **{LIMIT_ADMITTED_KWARG: True})
+        # pylint: disable=protected-access
+        return await chat_openai._agenerate(messages, stop, run_manager, **kwargs)
+        # pylint: enable=protected-access
 
-attach_session_hooks()
+    async def _ahedged_generate(self, messages: List[BaseMessage],
+                                stop: List[str] | None,
+                                run_manager: AsyncCallbackManagerForLLMRun | None,
+                                token_count: int,
+                                kwargs: dict) -> ChatResult:
+        """
+        Generate via the key with the most headroom. If it is slower than the hedge delay -
+        also send the same request via a key of another organization, if some has spare budget.
+        The first successful result wins, the other request is cancelled.
+        Reservations of cancelled and failed requests are refunded.
+        Latency of a cancelled request is recorded as the time it ran (a lower bound),
+        so hedging does not hide slow requests from the hedge delay percentile.
+        Hedging bypasses prefix affinity: keys are picked by headroom, as the point
+        is to get around a slow key.
+        """
+        attach_session_hooks()
+        model_name = self.model_name
+        kwargs = dict(kwargs)
+        kwargs.pop(TOKEN_COUNT_KWARG, None)
+        tenant = kwargs.pop(TENANT_KWARG, None)
+        primary = await await_for_any_key(model_name, self.openai_api_keys, token_count,
+                                          self.limit_await_timeout, self.limit_await_sleep,
+                                          tenant)
+        tasks: Dict[asyncio.Future, LimitReservation] = {
+            asyncio.ensure_future(self._agenerate_with_key(
+                primary.api_key, messages, stop, run_manager, kwargs
+            )): primary,
+        }
+        start_times = {task: time.monotonic() for task in tasks}
+        delay = self.hedge_delay
+        if delay is None:
+            delay = observed_hedge_delay(model_name)
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                other_keys = keys_of_other_owners(self.openai_api_keys, primary.api_key)
+                hedge = None
+                if other_keys:
+                    hedge = await areserve_any_key(model_name, other_keys, token_count, tenant)
+                if hedge is not None:
+                    task = asyncio.ensure_future(self._agenerate_with_key(
+                        hedge.api_key, messages, stop, run_manager, kwargs
+                    ))
+                    tasks[task] = hedge
+                    start_times[task] = time.monotonic()
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    reservation = tasks.pop(task)
+                    if task.exception() is not None:
+                        reservation.refund()
+                    if task.exception() is None or not tasks:
+                        result = task.result()
+                        reservation.commit()
+                        record_latency(model_name, time.monotonic() - start_times[task])
+                        return result
+        finally:
+            end_time = time.monotonic()
+            for task, reservation in tasks.items():
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    # Finished together with the winner, the budget is spent
+                    reservation.commit()
+                else:
+                    task.cancel()
+                    reservation.refund()
+                record_latency(model_name, end_time - start_times[task])
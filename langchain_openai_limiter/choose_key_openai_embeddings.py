@@ -1,13 +1,24 @@
 """
 Wrapper to choose between a few OpenAI keys before embeddings
 """
+from collections.abc import AsyncIterable
 import copy
-from typing import Union, List
+import functools
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, Tuple, \
+    Union, List
 from langchain.embeddings.base import Embeddings
 from langchain.embeddings.openai import OpenAIEmbeddings
-import tiktoken
-from .limit_info import choose_key, achoose_key, ApiKey
+import numpy as np
+from .embedding_array import EmbeddingsOutput, embed_texts_array, aembed_texts_array
+from .embedding_cache import EmbeddingCache
+from .embeddings_batch import embed_chunks_with_limits, aembed_chunks_with_limits, \
+    embed_stream_with_limits, aembed_stream_with_limits, unique_texts, expand_vectors
+from .limit_batch import _BATCH_MAX_CONCURRENCY
+from .limit_info import ApiKey
 from .limit_await_openai_embeddings import LimitAwaitOpenAIEmbeddings
+from .tenant_quota import Tenant
+from .token_counter import num_tokens_from_texts, anum_tokens_from_texts, \
+    num_tokens_per_text, anum_tokens_per_text, estimate_num_tokens_per_text
 
 
 _LIMIT_AWAIT_SLEEP = 0.01
@@ -16,18 +27,28 @@ _LIMIT_AWAIT_TIMEOUT = 60.0
 
 class ChooseKeyOpenAIEmbeddings(Embeddings):
     """
-    Key-choosing OpenAI embeddings wrapper
+    Key-choosing OpenAI embeddings wrapper.
+    Texts are split into chunks, which are sent concurrently via keys with enough budget.
     """
     def __init__(self, openai_embeddings: Union[LimitAwaitOpenAIEmbeddings, OpenAIEmbeddings],
                  openai_api_keys: List[ApiKey],
                  limit_await_timeout: float = _LIMIT_AWAIT_TIMEOUT,
-                 limit_await_sleep: float = _LIMIT_AWAIT_SLEEP):
+                 limit_await_sleep: float = _LIMIT_AWAIT_SLEEP,
+                 embedding_cache: Union[EmbeddingCache, None] = None,
+                 numpy_dtype: Union[str, np.dtype, None] = None):
+        """
+        :param embedding_cache: Cache of text vectors, so only new texts are sent to OpenAI
+        :param numpy_dtype: Return embeddings as (texts, dimensions) array of this type
+          (like "float32"), decoded right from the response. None - return lists
+        """
         super().__init__()
         self.openai_embeddings = openai_embeddings
         self.openai_api_keys = openai_api_keys
         self.limit_await_timeout = limit_await_timeout
         self.limit_await_sleep = limit_await_sleep
-    
+        self.embedding_cache = embedding_cache
+        self.numpy_dtype = numpy_dtype
+
     @property
     def model(self) -> str:
         return self.openai_embeddings.model
@@ -36,25 +57,123 @@ class ChooseKeyOpenAIEmbeddings(Embeddings):
         """
         Count tokens in texts
         """
-        encoding = tiktoken.encoding_for_model(self.openai_embeddings.model)
-        token_ids = encoding.encode_batch(texts)
-        total_length = 0
-        for row in token_ids:
-            total_length += len(row)
-        return total_length
+        return num_tokens_from_texts(self.openai_embeddings.model, texts)
+
+    async def aget_num_tokens(self, texts: List[str]) -> int:
+        """
+        Count tokens in texts without blocking the event loop on large inputs
+        """
+        return await anum_tokens_from_texts(self.openai_embeddings.model, texts)
+
+    @property
+    def _estimate_tokens(self) -> bool:
+        """
+        Whether the wrapped limit awaiting model admits requests by token estimates
+        """
+        return isinstance(self.openai_embeddings, LimitAwaitOpenAIEmbeddings) \
+            and self.openai_embeddings.estimate_tokens
+
+    def _text_token_counts(self, texts: List[str]) -> List[int]:
+        """
+        Count (or estimate, if the wrapped model does so) tokens in every text
+        """
+        if self._estimate_tokens:
+            return estimate_num_tokens_per_text(texts)
+        return num_tokens_per_text(self.openai_embeddings.model, texts)
 
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+    async def _atext_token_counts(self, texts: List[str]) -> List[int]:
         """
-        Get document embeddings
+        Async version of `_text_token_counts`
+        """
+        if self._estimate_tokens:
+            return estimate_num_tokens_per_text(texts)
+        return await anum_tokens_per_text(self.openai_embeddings.model, texts)
+
+    def _key_embeddings(self) -> Callable[[ApiKey], Union[LimitAwaitOpenAIEmbeddings,
+                                                          OpenAIEmbeddings]]:
+        """
+        Build getter of the wrapped model copy which uses given API key
+        """
+        key_embeddings: Dict[ApiKey, Union[LimitAwaitOpenAIEmbeddings, OpenAIEmbeddings]] = {}
+
+        def _get(api_key: ApiKey) -> Union[LimitAwaitOpenAIEmbeddings, OpenAIEmbeddings]:
+            if api_key not in key_embeddings:
+                openai_embeddings = copy.deepcopy(self.openai_embeddings)
+                openai_embeddings.openai_api_key = api_key
+                if isinstance(openai_embeddings, LimitAwaitOpenAIEmbeddings) \
+                        and self.numpy_dtype is not None:
+                    openai_embeddings.numpy_dtype = self.numpy_dtype
+                key_embeddings[api_key] = openai_embeddings
+            return key_embeddings[api_key]
+
+        return _get
+
+    def _chunk_call(self) -> Callable[[List[str], ApiKey], EmbeddingsOutput]:
+        """
+        Build synchronyous chunk embedder
+        """
+        key_embeddings = self._key_embeddings()
+
+        def _call(texts: List[str], api_key: ApiKey) -> EmbeddingsOutput:
+            openai_embeddings = key_embeddings(api_key)
+            if isinstance(openai_embeddings, LimitAwaitOpenAIEmbeddings):
+                return openai_embeddings.embed_documents(texts, limit_admitted=True)
+            if self.numpy_dtype is not None:
+                return embed_texts_array(openai_embeddings, texts, self.numpy_dtype)
+            return openai_embeddings.embed_documents(texts)
+
+        return _call
+
+    def _achunk_call(self) -> Callable[[List[str], ApiKey], Awaitable[EmbeddingsOutput]]:
         """
-        token_count = self.get_num_tokens(texts)
-        openai_embeddings = copy.deepcopy(self.openai_embeddings)
-        openai_embeddings.openai_api_key = choose_key(
+        Build asynchronyous chunk embedder
+        """
+        key_embeddings = self._key_embeddings()
+
+        async def _call(texts: List[str], api_key: ApiKey) -> EmbeddingsOutput:
+            openai_embeddings = key_embeddings(api_key)
+            if isinstance(openai_embeddings, LimitAwaitOpenAIEmbeddings):
+                return await openai_embeddings.aembed_documents(texts, limit_admitted=True)
+            if self.numpy_dtype is not None:
+                return await aembed_texts_array(openai_embeddings, texts, self.numpy_dtype)
+            return await openai_embeddings.aembed_documents(texts)
+
+        return _call
+
+    def embed_documents(self, texts: List[str], tenant: Tenant = None) -> EmbeddingsOutput:
+        """
+        Get document embeddings (duplicate texts are sent and counted once)
+        :param tenant: Tenant which share chunks are admitted within (see `set_tenant_quota`)
+        """
+        unique, positions = unique_texts(texts)
+        if len(unique) < len(texts):
+            return expand_vectors(self.embed_documents(unique, tenant), positions)
+        if self.embedding_cache is not None:
+            return self.embedding_cache.embed_documents(
+                self.openai_embeddings.model,
+                texts,
+                functools.partial(self._embed_documents_uncached, tenant=tenant),
+                self.numpy_dtype,
+            )
+        return self._embed_documents_uncached(texts, tenant)
+
+    def _embed_documents_uncached(self, texts: List[str],
+                                  tenant: Tenant = None) -> EmbeddingsOutput:
+        """
+        Get document embeddings from OpenAI
+        """
+        return embed_chunks_with_limits(
             self.openai_embeddings.model,
             self.openai_api_keys,
-            token_count
+            texts,
+            self._text_token_counts(texts),
+            self.openai_embeddings.chunk_size,
+            self._chunk_call(),
+            self.limit_await_timeout,
+            self.limit_await_sleep,
+            self.numpy_dtype,
+            tenant,
         )
-        return openai_embeddings.embed_documents(texts)
 
     def embed_query(self, text: str) -> List[float]:
         """
@@ -62,18 +181,83 @@ class ChooseKeyOpenAIEmbeddings(Embeddings):
         """
         return self.embed_documents([text])[0]
 
-    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+    async def aembed_documents(self, texts: List[str], tenant: Tenant = None) \
+        -> EmbeddingsOutput:
+        """
+        Get document embeddings (duplicate texts are sent and counted once)
+        :param tenant: Tenant which share chunks are admitted within (see `set_tenant_quota`)
+        """
+        unique, positions = unique_texts(texts)
+        if len(unique) < len(texts):
+            return expand_vectors(await self.aembed_documents(unique, tenant), positions)
+        if self.embedding_cache is not None:
+            return await self.embedding_cache.aembed_documents(
+                self.openai_embeddings.model,
+                texts,
+                functools.partial(self._aembed_documents_uncached, tenant=tenant),
+                self.numpy_dtype,
+            )
+        return await self._aembed_documents_uncached(texts, tenant)
+
+    async def _aembed_documents_uncached(self, texts: List[str],
+                                         tenant: Tenant = None) -> EmbeddingsOutput:
+        """
+        Get document embeddings from OpenAI
+        """
+        return await aembed_chunks_with_limits(
+            self.openai_embeddings.model,
+            self.openai_api_keys,
+            texts,
+            await self._atext_token_counts(texts),
+            self.openai_embeddings.chunk_size,
+            self._achunk_call(),
+            self.limit_await_timeout,
+            self.limit_await_sleep,
+            self.numpy_dtype,
+            tenant,
+        )
+
+    def embed_stream(self, texts: Iterable[str],
+                     max_concurrency: int = _BATCH_MAX_CONCURRENCY,
+                     tenant: Tenant = None) -> Iterator[Tuple[int, Any]]:
+        """
+        Embed lazily consumed texts (like a corpus read from disk), batching them by
+        token budget and keeping up to `max_concurrency` requests in flight across keys.
+        Texts are read only when there is room for them, so memory stays constant.
+        Embedding cache is not used.
+        :return: Iterator over (text index, vector) pairs in completion order
+        """
+        return embed_stream_with_limits(
+            self.openai_embeddings.model,
+            self.openai_api_keys,
+            texts,
+            self._text_token_counts,
+            self.openai_embeddings.chunk_size,
+            self._chunk_call(),
+            self.limit_await_timeout,
+            self.limit_await_sleep,
+            max_concurrency,
+            tenant,
+        )
+
+    def aembed_stream(self, texts: Union[Iterable[str], AsyncIterable],
+                      max_concurrency: int = _BATCH_MAX_CONCURRENCY,
+                      tenant: Tenant = None) -> AsyncIterator[Tuple[int, Any]]:
         """
-        Get document embeddings
+        Async version of `embed_stream` (`texts` could also be an asynchronyous iterable)
         """
-        token_count = self.get_num_tokens(texts)
-        openai_embeddings = copy.deepcopy(self.openai_embeddings)
-        openai_embeddings.openai_api_key = await achoose_key(
+        return aembed_stream_with_limits(
             self.openai_embeddings.model,
             self.openai_api_keys,
-            token_count
+            texts,
+            self._atext_token_counts,
+            self.openai_embeddings.chunk_size,
+            self._achunk_call(),
+            self.limit_await_timeout,
+            self.limit_await_sleep,
+            max_concurrency,
+            tenant,
         )
-        return await openai_embeddings.aembed_documents(texts)
 
     async def aembed_query(self, text: str) -> List[float]:
         """
@@ -0,0 +1,196 @@
+"""
+Module for adaptive (AIMD) in-flight request limiting.
+
+RPM/TPM headers do not describe every server-side constraint, so we also limit
+the amount of in-flight requests per (model, API key). The window grows additively
+while latency is stable and shrinks multiplicatively on 429s or latency spikes.
+"""
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+import copy
+from dataclasses import dataclass
+import threading
+import time
+from typing import AsyncIterator, Dict, Iterator, Tuple, Union
+from .limit_info import ApiKey, ModelName
+
+
+@dataclass
+class AIMDSettings:
+    """
+    Adaptive concurrency limiting settings
+    """
+    initial_window: float = 4.0 # In-flight requests allowed before we know anything
+    min_window: float = 1.0
+    max_window: float = 256.0
+    increase: float = 1.0 # Window growth per window of successful requests
+    decrease: float = 0.5 # Window multiplier on 429 or latency spike
+    latency_tolerance: float = 2.0 # Latency above `tolerance * average` is a spike
+    latency_smoothing: float = 0.1 # Exponential moving average factor of latency
+
+
+@dataclass
+class ConcurrencyState:
+    """
+    In-flight request window of (model, API key) pair
+    """
+    window: float # Current window size
+    in_flight: int # Requests running right now
+    latency: Union[float, None] # Average latency (seconds) of successful requests
+    last_decrease: float # When did we shrink the window last time (monotonic time)
+
+
+class ConcurrencySlot:
+    """
+    Running request handle, used to measure its latency
+    """
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.latency: Union[float, None] = None
+
+    def mark_latency(self) -> None:
+        """
+        Fix request latency now (like on the first streamed chunk)
+        """
+        if self.latency is None:
+            self.latency = time.monotonic() - self.start_time
+
+
+# Concurrency state store
+_CONCURRENCY_STORE: Dict[Tuple[ModelName, ApiKey], ConcurrencyState] = {}
+_SYNC_CONCURRENCY_LOCK = threading.Lock()
+_ASYNC_CONCURRENCY_LOCK = asyncio.Lock()
+
+
+def _try_acquire(model_name: ModelName, api_key: ApiKey, settings: AIMDSettings) -> bool:
+    """
+    Take in-flight slot if the window allows it
+    """
+    with _SYNC_CONCURRENCY_LOCK:
+        state = _CONCURRENCY_STORE.get((model_name, api_key))
+        if state is None:
+            state = ConcurrencyState(window=settings.initial_window, in_flight=0,
+                                     latency=None, last_decrease=0.0)
+            _CONCURRENCY_STORE[(model_name, api_key)] = state
+        if state.in_flight < max(int(state.window), 1):
+            state.in_flight += 1
+            return True
+        return False
+
+
+def _release(model_name: ModelName, api_key: ApiKey, settings: AIMDSettings,
+             latency: float, error: Union[BaseException, None]) -> None:
+    """
+    Return in-flight slot and adapt the window by request outcome.
+    Failures other than 429 (including cancellation) say nothing about congestion,
+    so they do not change the window.
+    """
+    # pylint: disable=import-outside-toplevel
+    import openai.error
+    # pylint: enable=import-outside-toplevel
+    throttled = isinstance(error, openai.error.RateLimitError)
+    with _SYNC_CONCURRENCY_LOCK:
+        state = _CONCURRENCY_STORE[(model_name, api_key)]
+        state.in_flight -= 1
+        if error is not None and not throttled:
+            return
+        current_time = time.monotonic()
+        spike = state.latency is not None and latency > state.latency * settings.latency_tolerance
+        if throttled or spike:
+            # Shrink at most once per average round trip, since requests which were
+            # in flight together will likely report the same congestion
+            if current_time - state.last_decrease > (state.latency or 0.0):
+                state.window = max(settings.min_window, state.window * settings.decrease)
+                state.last_decrease = current_time
+        else:
+            state.window = min(settings.max_window,
+                               state.window + settings.increase / state.window)
+        if not throttled:
+            if state.latency is None:
+                state.latency = latency
+            else:
+                state.latency += settings.latency_smoothing * (latency - state.latency)
+
+
+@contextmanager
+def concurrency_slot(model_name: ModelName, api_key: ApiKey,
+                     settings: Union[AIMDSettings, None],
+                     limit_await_timeout: float, limit_await_sleep: float) \
+    -> Iterator[ConcurrencySlot]:
+    """
+    Wait up to `limit_await_timeout` seconds (splitted to `limit_await_sleep` chunks)
+    for a free in-flight slot, hold it while the block runs and adapt the window by
+    the block outcome. Does not limit anything if `settings` is None.
+    """
+    slot = ConcurrencySlot()
+    if settings is None:
+        yield slot
+        return
+    max_await_count = int(limit_await_timeout / limit_await_sleep)
+    for _ in range(max_await_count):
+        if _try_acquire(model_name, api_key, settings):
+            break
+        time.sleep(limit_await_sleep)
+    else:
+        raise TimeoutError()
+    slot = ConcurrencySlot()
+    error = None
+    try:
+        yield slot
+    except BaseException as exc:
+        error = exc
+        raise
+    finally:
+        slot.mark_latency()
+        _release(model_name, api_key, settings, slot.latency, error)
+
+
+@asynccontextmanager
+async def aconcurrency_slot(model_name: ModelName, api_key: ApiKey,
+                            settings: Union[AIMDSettings, None],
+                            limit_await_timeout: float, limit_await_sleep: float) \
+    -> AsyncIterator[ConcurrencySlot]:
+    """
+    Async version of `concurrency_slot`
+    """
+    slot = ConcurrencySlot()
+    if settings is None:
+        yield slot
+        return
+    max_await_count = int(limit_await_timeout / limit_await_sleep)
+    for _ in range(max_await_count):
+        async with _ASYNC_CONCURRENCY_LOCK:
+            acquired = _try_acquire(model_name, api_key, settings)
+        if acquired:
+            break
+        await asyncio.sleep(limit_await_sleep)
+    else:
+        raise TimeoutError()
+    slot = ConcurrencySlot()
+    error = None
+    try:
+        yield slot
+    except BaseException as exc:
+        error = exc
+        raise
+    finally:
+        slot.mark_latency()
+        _release(model_name, api_key, settings, slot.latency, error)
+
+
+def get_concurrency_state(model_name: ModelName, api_key: ApiKey) \
+    -> Union[ConcurrencyState, None]:
+    """
+    Get current in-flight window of (model, API key) pair
+    :return: ConcurrencyState copy, or None if adaptive concurrency was never used for it
+    """
+    with _SYNC_CONCURRENCY_LOCK:
+        state = _CONCURRENCY_STORE.get((model_name, api_key))
+        return copy.copy(state)
+
+
+def reset_concurrency_state() -> None:
+    """
+    Reset collected concurrency state for testing purpose
+    """
+    _CONCURRENCY_STORE.clear()
@@ -0,0 +1,177 @@
+"""
+Module for NumPy embedding output.
+
+OpenAI returns embeddings as base64-encoded float32 buffers, so we decode them
+right into a contiguous array instead of building lists of Python floats.
+"""
+import base64
+from typing import Any, List, Union
+from langchain.embeddings.openai import OpenAIEmbeddings, embed_with_retry, \
+    async_embed_with_retry
+import numpy as np
+from .token_counter import anum_tokens_per_text, estimate_num_tokens_per_text, \
+    num_tokens_per_text
+
+
+EmbeddingsOutput = Union[List[List[float]], np.ndarray]
+
+
+def _decode_vector(embedding: Union[str, List[float]]) -> np.ndarray:
+    """
+    Decode single response embedding (engines which ignore `encoding_format` send lists)
+    """
+    if isinstance(embedding, str):
+        return np.frombuffer(base64.b64decode(embedding), dtype=np.float32)
+    return np.asarray(embedding, dtype=np.float32)
+
+
+def _fill_from_response(result: Union[np.ndarray, None], offset: int, count: int,
+                        response: Any, dtype: np.dtype) -> np.ndarray:
+    """
+    Put response vectors to rows `offset...offset + count` of the result
+    (allocating it when the first response comes)
+    """
+    for data in response["data"]:
+        vector = _decode_vector(data["embedding"])
+        if result is None:
+            result = np.empty((count, vector.shape[0]), dtype=dtype)
+        result[offset + data["index"]] = vector
+    return result
+
+
+def _long_text_candidates(openai_embeddings: OpenAIEmbeddings, texts: List[str]) -> List[int]:
+    """
+    Texts whose cheap token count upper bound exceeds the model context
+    (only they need to be tokenized to tell if they really do)
+    """
+    return [
+        i
+        for i, token_count in enumerate(estimate_num_tokens_per_text(texts))
+        if token_count > openai_embeddings.embedding_ctx_length
+    ]
+
+
+def _tokenizer_model_name(openai_embeddings: OpenAIEmbeddings) -> str:
+    """
+    Model name LangChain takes the tokenizer for
+    """
+    return openai_embeddings.tiktoken_model_name or openai_embeddings.model
+
+
+def _long_text_indices(openai_embeddings: OpenAIEmbeddings, texts: List[str]) -> List[int]:
+    """
+    Texts which do not fit the model context, so need LangChain length-safe embedding
+    """
+    candidates = _long_text_candidates(openai_embeddings, texts)
+    if not candidates:
+        return []
+    token_counts = num_tokens_per_text(_tokenizer_model_name(openai_embeddings),
+                                       [texts[i] for i in candidates])
+    return [
+        i
+        for i, token_count in zip(candidates, token_counts)
+        if token_count > openai_embeddings.embedding_ctx_length
+    ]
+
+
+async def _along_text_indices(openai_embeddings: OpenAIEmbeddings,
+                              texts: List[str]) -> List[int]:
+    """
+    Async version of `_long_text_indices`
+    """
+    candidates = _long_text_candidates(openai_embeddings, texts)
+    if not candidates:
+        return []
+    token_counts = await anum_tokens_per_text(_tokenizer_model_name(openai_embeddings),
+                                              [texts[i] for i in candidates])
+    return [
+        i
+        for i, token_count in zip(candidates, token_counts)
+        if token_count > openai_embeddings.embedding_ctx_length
+    ]
+
+
+def embed_texts_array(openai_embeddings: OpenAIEmbeddings, texts: List[str],
+                      dtype: Union[str, np.dtype]) -> np.ndarray:
+    """
+    Embed texts into (texts, dimensions) array of the given dtype.
+    Texts which exceed the model context are embedded by LangChain
+    (it splits and averages them).
+    """
+    long_indices = _long_text_indices(openai_embeddings, texts)
+    if long_indices:
+        return _embed_with_long_texts(openai_embeddings, texts, dtype, long_indices)
+    result = None
+    # pylint: disable=protected-access
+    for offset in range(0, len(texts), openai_embeddings.chunk_size):
+        chunk = texts[offset:offset + openai_embeddings.chunk_size]
+        response = embed_with_retry(openai_embeddings, input=chunk, encoding_format="base64",
+                                    **openai_embeddings._invocation_params)
+        result = _fill_from_response(result, offset, len(texts), response, dtype)
+    # pylint: enable=protected-access
+    if result is None:
+        return np.empty((0, 0), dtype=dtype)
+    return result
+
+
+async def aembed_texts_array(openai_embeddings: OpenAIEmbeddings, texts: List[str],
+                             dtype: Union[str, np.dtype]) -> np.ndarray:
+    """
+    Async version of `embed_texts_array`
+    """
+    long_indices = await _along_text_indices(openai_embeddings, texts)
+    if long_indices:
+        return await _aembed_with_long_texts(openai_embeddings, texts, dtype, long_indices)
+    result = None
+    # pylint: disable=protected-access
+    for offset in range(0, len(texts), openai_embeddings.chunk_size):
+        chunk = texts[offset:offset + openai_embeddings.chunk_size]
+        response = await async_embed_with_retry(openai_embeddings, input=chunk,
+                                                encoding_format="base64",
+                                                **openai_embeddings._invocation_params)
+        result = _fill_from_response(result, offset, len(texts), response, dtype)
+    # pylint: enable=protected-access
+    if result is None:
+        return np.empty((0, 0), dtype=dtype)
+    return result
+
+
+def _merge_long_texts(texts: List[str], long_indices: List[int],
+                      short_vectors: np.ndarray, long_vectors: List[List[float]],
+                      dtype: Union[str, np.dtype]) -> np.ndarray:
+    """
+    Merge vectors of short and long texts back in input order
+    """
+    dim = len(long_vectors[0])
+    result = np.empty((len(texts), dim), dtype=dtype)
+    long_mask = np.zeros(len(texts), dtype=bool)
+    long_mask[long_indices] = True
+    result[long_mask] = long_vectors
+    if short_vectors.size:
+        result[~long_mask] = short_vectors
+    return result
+
+
+def _embed_with_long_texts(openai_embeddings: OpenAIEmbeddings, texts: List[str],
+                           dtype: Union[str, np.dtype], long_indices: List[int]) -> np.ndarray:
+    """
+    Embed short texts directly into array, and long ones with LangChain
+    """
+    long_set = set(long_indices)
+    short_texts = [text for i, text in enumerate(texts) if i not in long_set]
+    short_vectors = embed_texts_array(openai_embeddings, short_texts, dtype)
+    long_vectors = openai_embeddings.embed_documents([texts[i] for i in long_indices])
+    return _merge_long_texts(texts, long_indices, short_vectors, long_vectors, dtype)
+
+
+async def _aembed_with_long_texts(openai_embeddings: OpenAIEmbeddings, texts: List[str],
+                                  dtype: Union[str, np.dtype],
+                                  long_indices: List[int]) -> np.ndarray:
+    """
+    Async version of `_embed_with_long_texts`
+    """
+    long_set = set(long_indices)
+    short_texts = [text for i, text in enumerate(texts) if i not in long_set]
+    short_vectors = await aembed_texts_array(openai_embeddings, short_texts, dtype)
+    long_vectors = await openai_embeddings.aembed_documents([texts[i] for i in long_indices])
+    return _merge_long_texts(texts, long_indices, short_vectors, long_vectors, dtype)
@@ -0,0 +1,213 @@
+"""
+Module for content-addressed embedding caching.
+
+Re-indexing mostly re-embeds unchanged texts, so vectors are cached by (model, text hash).
+Vectors are kept in a memory-mapped float32 file per model, and their positions
+in an SQLite index. Only missing texts are sent to OpenAI (batched together).
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Awaitable, Callable, Dict, List, Union
+import numpy as np
+from .embedding_array import EmbeddingsOutput
+
+
+_VECTOR_DTYPE = np.float32
+# SQLite could limit the amount of query parameters to 999
+_INDEX_QUERY_SIZE = 500
+
+
+def _text_key(text: str) -> str:
+    """
+    Content address of the text
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _merge_vectors(vectors: List[Union[np.ndarray, None]], missing: List[int],
+                   missing_vectors: EmbeddingsOutput,
+                   dtype: Union[str, np.dtype, None]) -> EmbeddingsOutput:
+    """
+    Put embedded missing vectors between cached ones
+    """
+    if dtype is None:
+        result: List[List[float]] = [
+            vector.tolist() if vector is not None else None
+            for vector in vectors
+        ]
+        for i, vector in zip(missing, missing_vectors):
+            result[i] = vector
+        return result
+    if not vectors:
+        return np.empty((0, 0), dtype=dtype)
+    missing_vectors = np.asarray(missing_vectors, dtype=dtype)
+    dim = missing_vectors.shape[1] if missing else vectors[0].shape[0]
+    result = np.empty((len(vectors), dim), dtype=dtype)
+    for i, vector in enumerate(vectors):
+        if vector is not None:
+            result[i] = vector
+    if missing:
+        result[missing] = missing_vectors
+    return result
+
+
+class EmbeddingCache:
+    """
+    Disk embedding cache: memory-mapped float32 vectors + SQLite index.
+    The instance is shared (not copied) when wrappers are deep-copied
+    (like ChooseKeyOpenAIEmbeddings does).
+    """
+    def __init__(self, path: str):
+        """
+        :param path: Cache directory
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._vectors: Dict[str, np.memmap] = {}
+        self._connection = sqlite3.connect(os.path.join(path, "index.sqlite"),
+                                           check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS models "
+                "(model TEXT PRIMARY KEY, dim INTEGER, rows INTEGER)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS vectors "
+                "(model TEXT, key TEXT, row INTEGER, PRIMARY KEY (model, key))"
+            )
+
+    def __deepcopy__(self, memo: dict) -> "EmbeddingCache":
+        return self
+
+    def _vector_file(self, model: str) -> str:
+        """
+        Vector file of the model
+        """
+        return os.path.join(self.path, f"{hashlib.sha256(model.encode('utf-8')).hexdigest()}.f32")
+
+    def _mapped_vectors(self, model: str, dim: int, rows: int) -> np.memmap:
+        """
+        (INNER VERSION) Get memory map with at least `rows` vectors of the model
+        """
+        vectors = self._vectors.get(model)
+        if vectors is None or vectors.shape[0] < rows:
+            vectors = np.memmap(self._vector_file(model), dtype=_VECTOR_DTYPE, mode="r",
+                                shape=(rows, dim))
+            self._vectors[model] = vectors
+        return vectors
+
+    def get(self, model: str, texts: List[str]) -> List[Union[np.ndarray, None]]:
+        """
+        Get cached vectors of texts
+        :return: Read-only vector views (without copying) or None for missing texts
+        """
+        keys = [_text_key(text) for text in texts]
+        key_rows: Dict[str, int] = {}
+        with self._lock:
+            model_info = self._connection.execute(
+                "SELECT dim, rows FROM models WHERE model = ?", (model,)
+            ).fetchone()
+            if model_info is None:
+                return [None] * len(texts)
+            dim, rows = model_info
+            unique_keys = list(dict.fromkeys(keys))
+            for i in range(0, len(unique_keys), _INDEX_QUERY_SIZE):
+                query_keys = unique_keys[i:i + _INDEX_QUERY_SIZE]
+                key_rows.update(self._connection.execute(
+                    "SELECT key, row FROM vectors WHERE model = ? "
+                    f"AND key IN ({', '.join('?' * len(query_keys))})",
+                    (model, *query_keys),
+                ).fetchall())
+            if not key_rows:
+                return [None] * len(texts)
+            vectors = self._mapped_vectors(model, dim, rows)
+        return [
+            vectors[key_rows[key]] if key in key_rows else None
+            for key in keys
+        ]
+
+    def set(self, model: str, texts: List[str], vectors: EmbeddingsOutput) -> None:
+        """
+        Put vectors of texts to the cache
+        """
+        if not texts:
+            return
+        array = np.asarray(vectors, dtype=_VECTOR_DTYPE)
+        dim = array.shape[1]
+        # Repeated texts are stored once
+        key_positions: Dict[str, int] = {}
+        for i, text in enumerate(texts):
+            key_positions.setdefault(_text_key(text), i)
+        keys = list(key_positions)
+        if len(keys) < len(texts):
+            array = array[list(key_positions.values())]
+        with self._lock, self._connection:
+            model_info = self._connection.execute(
+                "SELECT dim, rows FROM models WHERE model = ?", (model,)
+            ).fetchone()
+            if model_info is None:
+                model_info = (dim, 0)
+            model_dim, rows = model_info
+            if model_dim != dim:
+                raise ValueError(f"Cached {model} vectors have {model_dim} dimensions, got {dim}")
+            # Write right after the indexed rows, dropping garbage of an interrupted write
+            # (append mode would ignore the position)
+            path = self._vector_file(model)
+            with open(path, "r+b" if os.path.exists(path) else "w+b") as dst:
+                dst.truncate(rows * dim * array.itemsize)
+                dst.seek(rows * dim * array.itemsize)
+                dst.write(array.tobytes())
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO vectors (model, key, row) VALUES (?, ?, ?)",
+                [(model, key, rows + i) for i, key in enumerate(keys)],
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO models (model, dim, rows) VALUES (?, ?, ?)",
+                (model, dim, rows + len(keys)),
+            )
+
+    def embed_documents(self, model: str, texts: List[str],
+                        embed: Callable[[List[str]], EmbeddingsOutput],
+                        dtype: Union[str, np.dtype, None] = None) -> EmbeddingsOutput:
+        """
+        Get embeddings of texts from the cache, embedding missing ones with `embed`
+        :param dtype: Return (texts, dimensions) array of this type instead of lists
+        """
+        vectors = self.get(model, texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        missing_vectors = []
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            missing_vectors = embed(missing_texts)
+            self.set(model, missing_texts, missing_vectors)
+        return _merge_vectors(vectors, missing, missing_vectors, dtype)
+
+    async def aembed_documents(self, model: str, texts: List[str],
+                               embed: Callable[[List[str]], Awaitable[EmbeddingsOutput]],
+                               dtype: Union[str, np.dtype, None] = None) -> EmbeddingsOutput:
+        """
+        Async version of `embed_documents`
+        """
+        vectors = self.get(model, texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        missing_vectors = []
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            missing_vectors = await embed(missing_texts)
+            self.set(model, missing_texts, missing_vectors)
+        return _merge_vectors(vectors, missing, missing_vectors, dtype)
+
+    def clear(self) -> None:
+        """
+        Drop all cached vectors
+        """
+        with self._lock, self._connection:
+            models = [row[0] for row in self._connection.execute("SELECT model FROM models")]
+            self._connection.execute("DELETE FROM vectors")
+            self._connection.execute("DELETE FROM models")
+            self._vectors.clear()
+            for model in models:
+                os.remove(self._vector_file(model))
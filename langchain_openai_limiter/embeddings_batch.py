@@ -0,0 +1,381 @@
+"""
+Limit-aware chunking of embedding inputs.
+
+Large inputs are split into chunks which fit both per-request input limits and a TPM window,
+chunks are dispatched concurrently across API keys as their RPM/TPM budget allows,
+and vectors are reassembled in input order.
+Streaming versions consume inputs lazily, keeping a bounded amount of chunks in flight.
+Deferred versions send chunks as batch job requests instead.
+"""
+import asyncio
+from collections.abc import AsyncIterable
+import itertools
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, \
+    Tuple, Union
+import numpy as np
+from .batch_offload import BatchOffload, EMBEDDINGS_ENDPOINT
+from .embedding_array import EmbeddingsOutput
+from .limit_batch import batch_as_completed_with_limits, abatch_as_completed_with_limits, \
+    _BATCH_MAX_CONCURRENCY
+from .limit_info import get_limit_info, wait_for_any_key, await_for_any_key, ApiKey, \
+    ModelName
+from .tenant_quota import Tenant
+from .token_counter import estimate_num_tokens_per_text
+
+
+# OpenAI limit of tokens summed across all inputs of a single embedding request
+_EMBEDDING_MAX_REQUEST_TOKENS = 300000
+# Chunks are not made smaller than this just to spread them across keys:
+# small calls are sent as a single request
+_MIN_SPREAD_CHUNK_TOKENS = 8192
+# End of the input marker
+_END = object()
+
+
+def chunk_token_limit(model_name: ModelName, api_keys: List[ApiKey],
+                      total_token_count: Union[int, None]) -> int:
+    """
+    Max token count of a chunk: it should fit a single request and the TPM window
+    of the largest known key. If there are a few keys, large inputs are split to spread
+    across all keys (inputs which fit a single request and the remaining TPM of some key
+    are split only into chunks of at least `_MIN_SPREAD_CHUNK_TOKENS` tokens)
+    :param total_token_count: Token count of all texts (None - unknown, like for streams)
+    """
+    limit = _EMBEDDING_MAX_REQUEST_TOKENS
+    fits_one_key = True
+    limit_infos = [get_limit_info(model_name, api_key) for api_key in api_keys]
+    if all(limit_info is not None for limit_info in limit_infos):
+        # Admission needs remaining TPM strictly more than the chunk token count
+        limit = min(limit, max(limit_info.tpm_total for limit_info in limit_infos) - 1)
+        if total_token_count is not None:
+            fits_one_key = total_token_count < max(limit_info.tpm_remain
+                                                   for limit_info in limit_infos)
+    if len(api_keys) > 1 and total_token_count is not None:
+        spread_limit = -(-total_token_count // len(api_keys))
+        if total_token_count <= limit and fits_one_key:
+            spread_limit = max(spread_limit, _MIN_SPREAD_CHUNK_TOKENS)
+        limit = min(limit, spread_limit)
+    return max(limit, 1)
+
+
+def unique_texts(texts: List[str]) -> Tuple[List[str], List[int]]:
+    """
+    Deduplicate texts
+    :return: Unique texts and position of every input text among them
+    """
+    text_positions: Dict[str, int] = {}
+    positions = [text_positions.setdefault(text, len(text_positions)) for text in texts]
+    return list(text_positions), positions
+
+
+def expand_vectors(vectors: EmbeddingsOutput, positions: List[int]) -> EmbeddingsOutput:
+    """
+    Fan vectors of unique texts back out to the input positions
+    (repeated list vectors are copied, so callers could modify them independently)
+    """
+    if isinstance(vectors, np.ndarray):
+        return vectors[positions]
+    used = [False] * len(vectors)
+    result = []
+    for position in positions:
+        result.append(list(vectors[position]) if used[position] else vectors[position])
+        used[position] = True
+    return result
+
+
+def split_texts(token_counts: List[int], max_tokens: int, max_inputs: int) -> List[List[int]]:
+    """
+    Split texts (given their token counts) into consecutive chunks of up to `max_inputs` texts
+    and up to `max_tokens` tokens. Text which does not fit `max_tokens` alone
+    becomes a separate chunk.
+    :return: Text indices of every chunk
+    """
+    chunks: List[List[int]] = []
+    chunk: List[int] = []
+    chunk_tokens = 0
+    for index, token_count in enumerate(token_counts):
+        if chunk and (chunk_tokens + token_count > max_tokens or len(chunk) >= max_inputs):
+            chunks.append(chunk)
+            chunk = []
+            chunk_tokens = 0
+        chunk.append(index)
+        chunk_tokens += token_count
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _put_vectors(results: Union[EmbeddingsOutput, None], indices: List[int],
+                 vectors: EmbeddingsOutput, total: int,
+                 dtype: Union[str, np.dtype, None]) -> EmbeddingsOutput:
+    """
+    Put chunk vectors to their input positions of the results
+    (list, or array allocated when the first chunk comes if `dtype` is set)
+    """
+    if dtype is None:
+        for index, vector in zip(indices, vectors):
+            results[index] = vector
+        return results
+    vectors = np.asarray(vectors, dtype=dtype)
+    if results is None:
+        results = np.empty((total, vectors.shape[1]), dtype=dtype)
+    results[indices] = vectors
+    return results
+
+
+def _empty_results(total: int, dtype: Union[str, np.dtype, None]) \
+    -> Union[EmbeddingsOutput, None]:
+    """
+    Initial value of the results
+    """
+    if dtype is None:
+        return [None] * total
+    if total == 0:
+        return np.empty((0, 0), dtype=dtype)
+    return None
+
+
+def embed_chunks_with_limits(model_name: ModelName, api_keys: List[ApiKey],
+                             texts: List[str], token_counts: List[int], max_inputs: int,
+                             call: Callable[[List[str], ApiKey], EmbeddingsOutput],
+                             limit_await_timeout: float, limit_await_sleep: float,
+                             dtype: Union[str, np.dtype, None] = None,
+                             tenant: Tenant = None) -> EmbeddingsOutput:
+    """
+    Embed texts chunk by chunk with `call(chunk_texts, api_key)`, admitting every chunk
+    when some of the keys has enough budget for it
+    :param dtype: Return (texts, dimensions) array of this type instead of lists
+    :param tenant: Tenant which share chunks are admitted within (see `set_tenant_quota`)
+    :return: Text embeddings in input order
+    """
+    chunks = split_texts(token_counts,
+                         chunk_token_limit(model_name, api_keys, sum(token_counts)),
+                         max_inputs)
+    chunk_token_counts = [sum(token_counts[index] for index in chunk) for chunk in chunks]
+    results = _empty_results(len(texts), dtype)
+    if len(chunks) == 1:
+        # A single request needs no dispatcher
+        reservation = wait_for_any_key(model_name, api_keys, chunk_token_counts[0],
+                                       limit_await_timeout, limit_await_sleep, tenant)
+        with reservation:
+            vectors = call(texts, reservation.api_key)
+        return _put_vectors(results, chunks[0], vectors, len(texts), dtype)
+    for chunk_index, vectors in batch_as_completed_with_limits(
+            model_name,
+            api_keys,
+            chunk_token_counts,
+            lambda chunk_index, api_key: call([texts[index] for index in chunks[chunk_index]],
+                                              api_key),
+            limit_await_timeout,
+            limit_await_sleep,
+            tenant=tenant):
+        results = _put_vectors(results, chunks[chunk_index], vectors, len(texts), dtype)
+    return results
+
+
+async def aembed_chunks_with_limits(model_name: ModelName, api_keys: List[ApiKey],
+                                    texts: List[str], token_counts: List[int], max_inputs: int,
+                                    call: Callable[[List[str], ApiKey],
+                                                   Awaitable[EmbeddingsOutput]],
+                                    limit_await_timeout: float, limit_await_sleep: float,
+                                    dtype: Union[str, np.dtype, None] = None,
+                                    tenant: Tenant = None) -> EmbeddingsOutput:
+    """
+    Async version of `embed_chunks_with_limits`
+    """
+    chunks = split_texts(token_counts,
+                         chunk_token_limit(model_name, api_keys, sum(token_counts)),
+                         max_inputs)
+    chunk_token_counts = [sum(token_counts[index] for index in chunk) for chunk in chunks]
+    results = _empty_results(len(texts), dtype)
+    if len(chunks) == 1:
+        # A single request needs no dispatcher
+        reservation = await await_for_any_key(model_name, api_keys, chunk_token_counts[0],
+                                              limit_await_timeout, limit_await_sleep, tenant)
+        with reservation:
+            vectors = await call(texts, reservation.api_key)
+        return _put_vectors(results, chunks[0], vectors, len(texts), dtype)
+    async for chunk_index, vectors in abatch_as_completed_with_limits(
+            model_name,
+            api_keys,
+            chunk_token_counts,
+            lambda chunk_index, api_key: call([texts[index] for index in chunks[chunk_index]],
+                                              api_key),
+            limit_await_timeout,
+            limit_await_sleep,
+            tenant=tenant):
+        results = _put_vectors(results, chunks[chunk_index], vectors, len(texts), dtype)
+    return results
+
+
+def _offload_requests(model_name: ModelName, texts: List[str],
+                      max_inputs: int) -> Tuple[List[List[int]], List[dict]]:
+    """
+    Split texts into chunks fitting a single request
+    :return: Text indices of every chunk and batch request bodies
+    """
+    chunks = split_texts(estimate_num_tokens_per_text(texts), _EMBEDDING_MAX_REQUEST_TOKENS,
+                         max_inputs)
+    return chunks, [
+        {"model": model_name, "input": [texts[index] for index in chunk]}
+        for chunk in chunks
+    ]
+
+
+def _response_vectors(body: dict) -> List[List[float]]:
+    """
+    Vectors of the embedding response body in input order
+    """
+    return [data["embedding"] for data in sorted(body["data"], key=lambda data: data["index"])]
+
+
+def embed_offloaded(batch_offload: BatchOffload, model_name: ModelName, texts: List[str],
+                    max_inputs: int, dtype: Union[str, np.dtype, None] = None) \
+    -> EmbeddingsOutput:
+    """
+    Embed texts via batch jobs (waiting for their completion) instead of live requests
+    :param dtype: Return (texts, dimensions) array of this type instead of lists
+    :return: Text embeddings in input order
+    """
+    chunks, bodies = _offload_requests(model_name, texts, max_inputs)
+    futures = [batch_offload.submit(EMBEDDINGS_ENDPOINT, body) for body in bodies]
+    results = _empty_results(len(texts), dtype)
+    for chunk, future in zip(chunks, futures):
+        results = _put_vectors(results, chunk, _response_vectors(future.result()), len(texts),
+                               dtype)
+    return results
+
+
+async def aembed_offloaded(batch_offload: BatchOffload, model_name: ModelName,
+                           texts: List[str], max_inputs: int,
+                           dtype: Union[str, np.dtype, None] = None) -> EmbeddingsOutput:
+    """
+    Async version of `embed_offloaded`
+    """
+    chunks, bodies = _offload_requests(model_name, texts, max_inputs)
+    responses = await asyncio.gather(*[
+        batch_offload.asubmit(EMBEDDINGS_ENDPOINT, body)
+        for body in bodies
+    ])
+    results = _empty_results(len(texts), dtype)
+    for chunk, body in zip(chunks, responses):
+        results = _put_vectors(results, chunk, _response_vectors(body), len(texts), dtype)
+    return results
+
+
+def _stream_chunks(model_name: ModelName, api_keys: List[ApiKey],
+                   texts: Iterable[str], token_counter: Callable[[List[str]], List[int]],
+                   max_inputs: int, chunks: Dict[int, Tuple[int, List[str]]]) -> Iterator[int]:
+    """
+    Read texts by `max_inputs`, split them into chunks, and put every chunk
+    as (first text index, texts) to `chunks`
+    :return: Iterator over chunk token counts
+    """
+    iterator = iter(texts)
+    offset = 0
+    chunk_index = 0
+    while True:
+        buffer = list(itertools.islice(iterator, max_inputs))
+        if not buffer:
+            return
+        token_counts = token_counter(buffer)
+        for chunk in split_texts(token_counts, chunk_token_limit(model_name, api_keys, None),
+                                 max_inputs):
+            chunks[chunk_index] = (offset + chunk[0], [buffer[index] for index in chunk])
+            yield sum(token_counts[index] for index in chunk)
+            chunk_index += 1
+        offset += len(buffer)
+
+
+async def _astream_chunks(model_name: ModelName, api_keys: List[ApiKey],
+                          texts: Union[Iterable[str], AsyncIterable],
+                          token_counter: Callable[[List[str]], Awaitable[List[int]]],
+                          max_inputs: int,
+                          chunks: Dict[int, Tuple[int, List[str]]]) -> AsyncIterator[int]:
+    """
+    Async version of `_stream_chunks` (`texts` could also be an asynchronyous iterable)
+    """
+    if isinstance(texts, AsyncIterable):
+        iterator = aiter(texts)
+    else:
+        iterator = iter(texts)
+    offset = 0
+    chunk_index = 0
+    while True:
+        buffer = []
+        for _ in range(max_inputs):
+            if isinstance(texts, AsyncIterable):
+                text = await anext(iterator, _END)
+            else:
+                text = next(iterator, _END)
+            if text is _END:
+                break
+            buffer.append(text)
+        if not buffer:
+            return
+        token_counts = await token_counter(buffer)
+        for chunk in split_texts(token_counts, chunk_token_limit(model_name, api_keys, None),
+                                 max_inputs):
+            chunks[chunk_index] = (offset + chunk[0], [buffer[index] for index in chunk])
+            yield sum(token_counts[index] for index in chunk)
+            chunk_index += 1
+        offset += len(buffer)
+
+
+def embed_stream_with_limits(model_name: ModelName, api_keys: List[ApiKey],
+                             texts: Iterable[str],
+                             token_counter: Callable[[List[str]], List[int]], max_inputs: int,
+                             call: Callable[[List[str], ApiKey], EmbeddingsOutput],
+                             limit_await_timeout: float, limit_await_sleep: float,
+                             max_concurrency: int = _BATCH_MAX_CONCURRENCY,
+                             tenant: Tenant = None) \
+    -> Iterator[Tuple[int, Any]]:
+    """
+    Embed lazily consumed texts chunk by chunk with `call(chunk_texts, api_key)`,
+    keeping up to `max_concurrency` chunks in flight. Texts are read only when
+    there is a free slot, so memory does not depend on the input size.
+    :param token_counter: Function to count tokens in every text of the list
+    :return: Iterator over (text index, vector) pairs in chunk completion order
+    """
+    chunks: Dict[int, Tuple[int, List[str]]] = {}
+    for chunk_index, vectors in batch_as_completed_with_limits(
+            model_name,
+            api_keys,
+            _stream_chunks(model_name, api_keys, texts, token_counter, max_inputs, chunks),
+            lambda chunk_index, api_key: call(chunks[chunk_index][1], api_key),
+            limit_await_timeout,
+            limit_await_sleep,
+            max_concurrency,
+            tenant=tenant):
+        offset, _ = chunks.pop(chunk_index)
+        for i, vector in enumerate(vectors):
+            yield offset + i, vector
+
+
+async def aembed_stream_with_limits(model_name: ModelName, api_keys: List[ApiKey],
+                                    texts: Union[Iterable[str], AsyncIterable],
+                                    token_counter: Callable[[List[str]], Awaitable[List[int]]],
+                                    max_inputs: int,
+                                    call: Callable[[List[str], ApiKey],
+                                                   Awaitable[EmbeddingsOutput]],
+                                    limit_await_timeout: float, limit_await_sleep: float,
+                                    max_concurrency: int = _BATCH_MAX_CONCURRENCY,
+                                    tenant: Tenant = None) \
+    -> AsyncIterator[Tuple[int, Any]]:
+    """
+    Async version of `embed_stream_with_limits`
+    (`texts` could also be an asynchronyous iterable)
+    """
+    chunks: Dict[int, Tuple[int, List[str]]] = {}
+    async for chunk_index, vectors in abatch_as_completed_with_limits(
+            model_name,
+            api_keys,
+            _astream_chunks(model_name, api_keys, texts, token_counter, max_inputs, chunks),
+            lambda chunk_index, api_key: call(chunks[chunk_index][1], api_key),
+            limit_await_timeout,
+            limit_await_sleep,
+            max_concurrency,
+            tenant=tenant):
+        offset, _ = chunks.pop(chunk_index)
+        for i, vector in enumerate(vectors):
+            yield offset + i, vector
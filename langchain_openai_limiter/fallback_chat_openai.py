@@ -0,0 +1,149 @@
+"""
+Router which sends chat requests to the first model tier able to serve them in time
+"""
+from typing import Any, AsyncIterator, Dict, Iterator, List, Tuple
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain.chat_models.base import BaseChatModel
+from langchain.pydantic_v1 import BaseModel
+from langchain.schema.output import ChatGenerationChunk, ChatResult
+from langchain.schema.messages import BaseMessage
+from .choose_key_chat_openai import ChooseKeyChatOpenAI
+from .limit_await_chat_openai import TOKEN_COUNT_KWARG
+from .limit_info import predict_wait, apredict_wait
+
+
+# Key of the chosen tier index in generation info
+FALLBACK_TIER_KEY = "fallback_tier"
+
+
+class FallbackTier(BaseModel):
+    """
+    Model (with its API keys) and how long requests may wait for its limits
+    """
+    chat_model: ChooseKeyChatOpenAI
+    max_wait: float = 0.0 # Seconds
+
+
+class FallbackChatOpenAI(BaseChatModel):
+    """
+    Capacity-aware fallback router. Every request goes to the first tier
+    which limits are predicted to fit it within the tier `max_wait`.
+    If neither tier fits - to the one which frees up first, so overflow
+    does not queue behind the premium model.
+    """
+    tiers: List[FallbackTier] # In the order of preference
+
+    @property
+    def _llm_type(self) -> str:
+        """Return type of chat model."""
+        return "fallback-openai-chat"
+
+    @staticmethod
+    def _choose_tier(waits: List[float], tiers: List[FallbackTier]) -> int:
+        """
+        Choose tier index given predicted waits of every tier
+        """
+        for i, (wait, tier) in enumerate(zip(waits, tiers)):
+            if wait <= tier.max_wait:
+                return i
+        return min(range(len(tiers)), key=lambda i: waits[i])
+
+    def _route(self, messages: List[BaseMessage], kwargs: Dict[str, Any]) \
+        -> Tuple[int, ChooseKeyChatOpenAI, Dict[str, Any]]:
+        """
+        Choose tier for the request by exact (memoized) token count of every tier model
+        :return: Tier index, chat model and call kwargs with the token count for it
+          (so the tier won't count it again)
+        """
+        assert len(self.tiers) > 0, "Should have passed tiers"
+        token_counts = [
+            tier.chat_model.get_num_tokens_from_messages(messages)
+            for tier in self.tiers
+        ]
+        waits = [
+            predict_wait(tier.chat_model.model_name, tier.chat_model.openai_api_keys, token_count)
+            for tier, token_count in zip(self.tiers, token_counts)
+        ]
+        index = self._choose_tier(waits, self.tiers)
+        return index, self.tiers[index].chat_model, \
+            dict(kwargs, **{TOKEN_COUNT_KWARG: token_counts[index]})
+
+    async def _aroute(self, messages: List[BaseMessage], kwargs: Dict[str, Any]) \
+        -> Tuple[int, ChooseKeyChatOpenAI, Dict[str, Any]]:
+        """
+        Async version of `_route`
+        """
+        assert len(self.tiers) > 0, "Should have passed tiers"
+        token_counts = [
+            await tier.chat_model.aget_num_tokens_from_messages(messages)
+            for tier in self.tiers
+        ]
+        waits = [
+            await apredict_wait(tier.chat_model.model_name, tier.chat_model.openai_api_keys,
+                                token_count)
+            for tier, token_count in zip(self.tiers, token_counts)
+        ]
+        index = self._choose_tier(waits, self.tiers)
+        return index, self.tiers[index].chat_model, \
+            dict(kwargs, **{TOKEN_COUNT_KWARG: token_counts[index]})
+
+    @staticmethod
+    def _mark_result(result: ChatResult, index: int) -> ChatResult:
+        """
+        Record the used tier in the result
+        """
+        for generation in result.generations:
+            generation.generation_info = dict(generation.generation_info or {},
+                                              **{FALLBACK_TIER_KEY: index})
+        return result
+
+    @staticmethod
+    def _mark_chunk(chunk: ChatGenerationChunk, index: int) -> ChatGenerationChunk:
+        """
+        Record the used tier in the stream chunk
+        """
+        chunk.generation_info = dict(chunk.generation_info or {}, **{FALLBACK_TIER_KEY: index})
+        return chunk
+
+    def _stream(self, messages: List[BaseMessage],
+                stop: List[str] | None = None,
+                run_manager: CallbackManagerForLLMRun | None = None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        index, chat_model, kwargs = self._route(messages, kwargs)
+        # pylint: disable=protected-access
+        for chunk in chat_model._stream(messages, stop, run_manager, **kwargs):
+            yield self._mark_chunk(chunk, index)
+        # pylint: enable=protected-access
+
+    # pylint: disable=invalid-overridden-method
+    # I need to perform async operations inside, so method is async - and it works this way
+    async def _astream(self, messages: List[BaseMessage],
+                       stop: List[str] | None = None,
+                       run_manager: AsyncCallbackManagerForLLMRun | None = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        index, chat_model, kwargs = await self._aroute(messages, kwargs)
+        # pylint: disable=protected-access
+        async for chunk in chat_model._astream(messages, stop, run_manager, **kwargs):
+            yield self._mark_chunk(chunk, index)
+        # pylint: enable=protected-access
+    # pylint: enable=invalid-overridden-method
+
+    def _generate(self, messages: List[BaseMessage],
+                  stop: List[str] | None = None,
+                  run_manager: CallbackManagerForLLMRun | None = None,
+                  **kwargs: Any) -> ChatResult:
+        index, chat_model, kwargs = self._route(messages, kwargs)
+        # pylint: disable=protected-access
+        result = chat_model._generate(messages, stop, run_manager, **kwargs)
+        # pylint: enable=protected-access
+        return self._mark_result(result, index)
+
+    async def _agenerate(self, messages: List[BaseMessage],
+                         stop: List[str] | None = None,
+                         run_manager: AsyncCallbackManagerForLLMRun | None = None,
+                         **kwargs: Any) -> ChatResult:
+        index, chat_model, kwargs = await self._aroute(messages, kwargs)
+        # pylint: disable=protected-access
+        result = await chat_model._agenerate(messages, stop, run_manager, **kwargs)
+        # pylint: enable=protected-access
+        return self._mark_result(result, index)
@@ -0,0 +1,50 @@
+"""
+Module for hedged requests latency tracking.
+
+Hedged request is a second copy of a slow request sent via another API key.
+It is sent after a delay - by default the observed latency percentile of the model.
+"""
+from collections import deque
+import threading
+from typing import Deque, Dict
+from .limit_info import ModelName
+
+
+_LATENCY_WINDOW = 100 # How many latest latencies to keep per model
+_MIN_LATENCY_SAMPLES = 20 # How many latencies do we need to trust the percentile
+_DEFAULT_HEDGE_DELAY = 2.0 # Hedge delay (seconds) to use until we have enough latencies
+_HEDGE_QUANTILE = 0.95
+
+
+_LATENCY_STORE: Dict[ModelName, Deque[float]] = {}
+_LATENCY_LOCK = threading.Lock()
+
+
+def record_latency(model_name: ModelName, latency: float) -> None:
+    """
+    Remember request latency (seconds)
+    """
+    with _LATENCY_LOCK:
+        if model_name not in _LATENCY_STORE:
+            _LATENCY_STORE[model_name] = deque(maxlen=_LATENCY_WINDOW)
+        _LATENCY_STORE[model_name].append(latency)
+
+
+def observed_hedge_delay(model_name: ModelName, quantile: float = _HEDGE_QUANTILE) -> float:
+    """
+    Get delay after which a request is considered slow enough to hedge it:
+    observed latency quantile, or a default value if there are not enough observations
+    """
+    with _LATENCY_LOCK:
+        latencies = sorted(_LATENCY_STORE.get(model_name, []))
+    if len(latencies) < _MIN_LATENCY_SAMPLES:
+        return _DEFAULT_HEDGE_DELAY
+    index = min(len(latencies) - 1, int(quantile * len(latencies)))
+    return latencies[index]
+
+
+def reset_latency_info() -> None:
+    """
+    Reset collected latencies for testing purpose
+    """
+    _LATENCY_STORE.clear()
@@ -0,0 +1,199 @@
+"""
+Live introspection of the limiter state.
+
+A running process exports snapshots of its limit store (see `limit_info.snapshot_limits`)
+to a JSON file, and `python -m langchain_openai_limiter` prints them live from another shell.
+So it is visible at once whether keys are saturated and requests queue for them
+(a capacity problem) or keys have spare budget while requests are slow (a latency problem).
+"""
+import argparse
+from dataclasses import asdict
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import List, Union
+from .limit_info import snapshot_limits
+
+
+# Snapshot file path, used by both the exporter and the command line tool
+SNAPSHOT_PATH_ENV = "LANGCHAIN_OPENAI_LIMITER_SNAPSHOT"
+_SNAPSHOT_INTERVAL = 1.0
+_CLEAR_SCREEN = "\033[H\033[J"
+_COLUMNS = ["MODEL", "OWNER", "STATE", "RPM", "TPM", "RESET IN", "WAITERS", "IN FLIGHT", "RTT"]
+
+
+def snapshot_dict() -> dict:
+    """
+    Snapshot of the limit store as a JSON-serializable dictionary
+    """
+    return {
+        "time": time.time(),
+        "pid": os.getpid(),
+        "limits": [asdict(snapshot) for snapshot in snapshot_limits()],
+    }
+
+
+def write_snapshot(path: str) -> None:
+    """
+    Write the snapshot to the file (atomically, so readers never see a partial one)
+    """
+    descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                            prefix=".limiter-snapshot-")
+    try:
+        with os.fdopen(descriptor, "w", encoding="utf-8") as dst:
+            json.dump(snapshot_dict(), dst)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def read_snapshot(path: str) -> Union[dict, None]:
+    """
+    Read the snapshot written by `write_snapshot`
+    :return: Snapshot dictionary or None if there is no snapshot yet
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as src:
+            return json.load(src)
+    except FileNotFoundError:
+        return None
+
+
+class SnapshotExporter:
+    """
+    Background thread which writes limit store snapshots to a file every `interval` seconds
+    """
+    def __init__(self, path: Union[str, None] = None, interval: float = _SNAPSHOT_INTERVAL):
+        """
+        :param path: Snapshot file (None - take it from LANGCHAIN_OPENAI_LIMITER_SNAPSHOT)
+        :param interval: Seconds between snapshots
+        """
+        path = path or os.environ.get(SNAPSHOT_PATH_ENV)
+        assert path, f"Should have passed snapshot path or set {SNAPSHOT_PATH_ENV}"
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._worker: Union[threading.Thread, None] = None
+
+    def start(self) -> "SnapshotExporter":
+        """
+        Start exporting (no-op if already started)
+        """
+        if self._worker is None:
+            self._stopped.clear()
+            self._worker = threading.Thread(target=self._work, daemon=True)
+            self._worker.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stop exporting (the last snapshot file is kept)
+        """
+        self._stopped.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+
+    def _work(self) -> None:
+        """
+        Background loop: write snapshots until stopped
+        """
+        while not self._stopped.is_set():
+            try:
+                write_snapshot(self.path)
+            except OSError:
+                pass # Like a full disk - try again next time, do not kill the exporter
+            self._stopped.wait(self.interval)
+
+
+def _limit_state(limits: dict) -> str:
+    """
+    Short description of key (organization) state
+    """
+    if limits["rpm_total"] is None:
+        return "unknown"
+    if limits["waiters"] > 0 or limits["rpm_remain"] <= 0 or limits["tpm_remain"] <= 0 \
+            or limits["rpd_remain"] == 0 or limits["tpd_remain"] == 0:
+        return "saturated"
+    return "ok"
+
+
+def _limit_row(limits: dict) -> List[str]:
+    """
+    Table row of key (organization) state
+    """
+    if limits["rpm_total"] is None:
+        rpm = tpm = reset_in = "-"
+    else:
+        rpm = f"{limits['rpm_remain']}/{limits['rpm_total']}"
+        tpm = f"{limits['tpm_remain']}/{limits['tpm_total']}"
+        reset_in = f"{max(limits['rpm_reset_in'], limits['tpm_reset_in']):.1f}s"
+    rtt = "-" if limits["rtt"] is None else f"{limits['rtt'] * 1000:.0f}ms"
+    return [
+        limits["model_name"],
+        limits["owner"],
+        _limit_state(limits),
+        rpm,
+        tpm,
+        reset_in,
+        str(limits["waiters"]),
+        f"{limits['in_flight']} ({limits['in_flight_tokens']} tokens)",
+        rtt,
+    ]
+
+
+def format_snapshot(snapshot: dict, current_time: float) -> str:
+    """
+    Render the snapshot as a table
+    :param current_time: Unix time to tell the snapshot age
+    """
+    rows = [_COLUMNS] + [_limit_row(limits) for limits in snapshot["limits"]]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(_COLUMNS))]
+    lines = [f"Process {snapshot['pid']}, snapshot is "
+             f"{max(current_time - snapshot['time'], 0.0):.1f}s old"]
+    lines += ["  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
+              for row in rows]
+    return "\n".join(lines)
+
+
+def main(argv: Union[List[str], None] = None) -> int:
+    """
+    Command line tool: print limiter state exported by a running process
+    (see SnapshotExporter), refreshing it live
+    :return: Exit code
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m langchain_openai_limiter",
+        description="Print limiter state exported by a running process (see SnapshotExporter)",
+    )
+    parser.add_argument("path", nargs="?", default=os.environ.get(SNAPSHOT_PATH_ENV),
+                        help=f"Snapshot file (default: ${SNAPSHOT_PATH_ENV})")
+    parser.add_argument("--interval", type=float, default=_SNAPSHOT_INTERVAL,
+                        help="Refresh interval, seconds")
+    parser.add_argument("--once", action="store_true", help="Print the snapshot once and exit")
+    args = parser.parse_args(argv)
+    if not args.path:
+        parser.error(f"Pass snapshot file path or set {SNAPSHOT_PATH_ENV}")
+    if args.once:
+        snapshot = read_snapshot(args.path)
+        if snapshot is None:
+            print(f"No snapshot at {args.path}", file=sys.stderr)
+            return 1
+        print(format_snapshot(snapshot, time.time()))
+        return 0
+    try:
+        while True:
+            snapshot = read_snapshot(args.path)
+            if snapshot is None:
+                text = f"Waiting for snapshot at {args.path}"
+            else:
+                text = format_snapshot(snapshot, time.time())
+            sys.stdout.write(_CLEAR_SCREEN + text + "\n")
+            sys.stdout.flush()
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        return 0
@@ -1,27 +1,108 @@
 """
 Wrapper for ChatOpenAI which do limit awaiting before running the model
 """
-from typing import Any, AsyncIterator, Coroutine, Iterator, List
+from concurrent.futures import Future
+import functools
+import threading
+from typing import Any, AsyncContextManager, AsyncIterator, ContextManager, Coroutine, Dict, \
+    Iterator, List, Optional, Tuple, Union
 from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
 from langchain.chat_models import ChatOpenAI
 from langchain.chat_models.base import BaseChatModel
-from langchain.schema.messages import BaseMessage
-from langchain.schema.output import ChatGenerationChunk, ChatResult
+from langchain.schema.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain.schema.output import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain.adapters.openai import convert_message_to_dict
+from langchain.schema.language_model import LanguageModelInput
+from langchain.schema.runnable import Runnable, RunnableConfig
+from .batch_offload import BatchOffload, CHAT_COMPLETIONS_ENDPOINT
 from .capture_headers import attach_session_hooks
-from .limit_info import wait_for_limit, await_for_limit
+from .concurrency_limit import AIMDSettings, ConcurrencySlot, concurrency_slot, \
+    aconcurrency_slot
+from .limit_batch import LimitAwareBatchMixin, LIMIT_ADMITTED_KWARG
+from .limit_info import wait_for_limit, await_for_limit, ApiKey, LimitReservation
+from .response_cache import ResponseCache
+from .single_flight import request_key, single_flight, asingle_flight
+from .tenant_quota import TENANT_KWARG
+from .token_counter import num_tokens_from_messages, anum_tokens_from_messages, \
+    estimate_num_tokens_from_messages
 
 
 _LIMIT_AWAIT_SLEEP = 0.01
 _LIMIT_AWAIT_TIMEOUT = 60.0
+# Call kwarg used by outer wrappers to pass already calculated token count
+TOKEN_COUNT_KWARG = "token_count"
+# Batch job requests submitted ahead by deferred `batch` calls, for `_generate` to claim:
+# (batch offload id, request body key) -> futures of the requests
+_PRESUBMITTED: Dict[Tuple[int, str], List[Future]] = {}
+_PRESUBMITTED_LOCK = threading.Lock()
 
 
-class LimitAwaitChatOpenAI(BaseChatModel):
+def _replay_chunks(result: ChatResult) -> List[ChatGenerationChunk]:
+    """
+    Turn cached chat result into stream chunks
+    """
+    generation = result.generations[0]
+    return [ChatGenerationChunk(
+        message=AIMessageChunk(
+            content=generation.message.content,
+            additional_kwargs=generation.message.additional_kwargs,
+        ),
+        generation_info=generation.generation_info,
+    )]
+
+
+def _result_from_chunks(chunks: List[ChatGenerationChunk]) -> ChatResult:
+    """
+    Combine streamed chunks into chat result to cache
+    """
+    combined = chunks[0]
+    for chunk in chunks[1:]:
+        combined += chunk
+    return ChatResult(generations=[ChatGeneration(
+        message=AIMessage(
+            content=combined.message.content,
+            additional_kwargs=combined.message.additional_kwargs,
+        ),
+        generation_info=combined.generation_info,
+    )])
+
+
+def _drop_presubmitted(presubmitted: List[Tuple[Tuple[int, str], Future]]) -> None:
+    """
+    Forget presubmitted requests which were not claimed (like inputs which failed early)
+    """
+    with _PRESUBMITTED_LOCK:
+        for key, future in presubmitted:
+            futures = _PRESUBMITTED.get(key, [])
+            if future in futures:
+                futures.remove(future)
+            if not futures:
+                _PRESUBMITTED.pop(key, None)
+
+
+class LimitAwaitChatOpenAI(LimitAwareBatchMixin, BaseChatModel):
     """
     Rate/Token Per Minute waiting ChatOpenAI wrapper
     """
     chat_openai: ChatOpenAI
     limit_await_timeout: float = _LIMIT_AWAIT_TIMEOUT
     limit_await_sleep: float = _LIMIT_AWAIT_SLEEP
+    # Admit requests by a cheap upper-bound token estimate,
+    # doing exact tokenization only when the estimate does not fit the remaining budget
+    estimate_tokens: bool = False
+    # Adaptive in-flight request limit per (model, API key). None - do not limit
+    concurrency_control: Union[AIMDSettings, None] = None
+    # Coalesce identical concurrent generation requests into one OpenAI call and one
+    # limit reservation. Only makes sense for deterministic (temperature=0) requests
+    single_flight: bool = False
+    # Exact-match response cache. Cache hits do not wait for (and do not spend) limits
+    response_cache: Union[ResponseCache, None] = None
+    # Deferred mode: send requests as batch jobs instead of live (limited) calls.
+    # Requests wait for the job completion, so use it for non-urgent work
+    batch_offload: Union[BatchOffload, None] = None
+    # Blocked requests are dispatched one measured RTT before TPM/RPM reset,
+    # so they arrive right after the server-side reset instead of a round trip later
+    align_reset: bool = False
     openai_api_key: str = ""
 
     @property
@@ -61,78 +142,348 @@ class LimitAwaitChatOpenAI(BaseChatModel):
 
     def get_num_tokens_from_messages(self, messages: List[BaseMessage]) -> int:
         """
-        Calculates number of tokens
+        Calculates number of tokens (reusing cached counts of already seen messages)
         """
-        return self.chat_openai.get_num_tokens_from_messages(messages)
+        return num_tokens_from_messages(self.chat_openai, messages)
 
-    def _stream(self, messages: List[BaseMessage],
-                stop: List[str] | None = None,
-                run_manager: CallbackManagerForLLMRun | None = None,
-                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
-        token_count = self.get_num_tokens_from_messages(messages)
-        wait_for_limit(
+    async def aget_num_tokens_from_messages(self, messages: List[BaseMessage]) -> int:
+        """
+        Calculates number of tokens without blocking the event loop on large inputs
+        """
+        return await anum_tokens_from_messages(self.chat_openai, messages)
+
+    def _batch_api_keys(self) -> List[ApiKey]:
+        return [self.openai_api_key]
+
+    def _batch_runnable(self, api_key: ApiKey) -> Tuple[Runnable, Dict[str, Any]]:
+        return self, {LIMIT_ADMITTED_KWARG: True}
+
+    def batch(self, inputs: List[LanguageModelInput],
+              config: Optional[Union[RunnableConfig, List[RunnableConfig]]] = None,
+              *,
+              return_exceptions: bool = False,
+              **kwargs: Any) -> List[Any]:
+        if self.batch_offload is not None:
+            # Deferred requests do not spend live limits, so there is nothing to dispatch.
+            # All of them are submitted before any is awaited, so they share batch files
+            # instead of filling them by the thread pool size
+            presubmitted = self._presubmit(inputs, kwargs)
+            try:
+                return BaseChatModel.batch(self, inputs, config,
+                                           return_exceptions=return_exceptions, **kwargs)
+            finally:
+                _drop_presubmitted(presubmitted)
+        return super().batch(inputs, config, return_exceptions=return_exceptions, **kwargs)
+
+    async def abatch(self, inputs: List[LanguageModelInput],
+                     config: Optional[Union[RunnableConfig, List[RunnableConfig]]] = None,
+                     *,
+                     return_exceptions: bool = False,
+                     **kwargs: Any) -> List[Any]:
+        if self.batch_offload is not None:
+            return await BaseChatModel.abatch(self, inputs, config,
+                                              return_exceptions=return_exceptions, **kwargs)
+        return await super().abatch(inputs, config, return_exceptions=return_exceptions,
+                                    **kwargs)
+
+    def _presubmit(self, inputs: List[LanguageModelInput], kwargs: dict) \
+        -> List[Tuple[Tuple[int, str], Future]]:
+        """
+        Submit batch job requests of deferred `batch` inputs (except cached ones) at once
+        :return: Presubmitted (key, future) pairs to drop once the batch is done
+        """
+        call_kwargs = dict(kwargs)
+        stop = call_kwargs.pop("stop", None)
+        presubmitted = []
+        for batch_input in inputs:
+            messages = self._convert_input(batch_input).to_messages()
+            if self.response_cache is not None and self.response_cache.get(
+                    self._request_key(messages, stop, call_kwargs)) is not None:
+                continue
+            body = self._offload_body(messages, stop, dict(call_kwargs))
+            future = self.batch_offload.submit(CHAT_COMPLETIONS_ENDPOINT, body)
+            key = (id(self.batch_offload), request_key(body))
+            with _PRESUBMITTED_LOCK:
+                _PRESUBMITTED.setdefault(key, []).append(future)
+            presubmitted.append((key, future))
+        return presubmitted
+
+    def _submit_offloaded(self, body: dict) -> Future:
+        """
+        Take the request presubmitted by deferred `batch`, or submit it now
+        """
+        key = (id(self.batch_offload), request_key(body))
+        with _PRESUBMITTED_LOCK:
+            futures = _PRESUBMITTED.get(key)
+            if futures:
+                future = futures.pop(0)
+                if not futures:
+                    del _PRESUBMITTED[key]
+                return future
+        return self.batch_offload.submit(CHAT_COMPLETIONS_ENDPOINT, body)
+
+    def _offload_body(self, messages: List[BaseMessage], stop: List[str] | None,
+                      kwargs: dict) -> dict:
+        """
+        Chat completion request body for the batch file
+        """
+        kwargs.pop(TOKEN_COUNT_KWARG, None)
+        kwargs.pop(LIMIT_ADMITTED_KWARG, None)
+        kwargs.pop(TENANT_KWARG, None)
+        # pylint: disable=protected-access
+        params = {
+            key: value
+            for key, value in self.chat_openai._default_params.items()
+            if key not in ("request_timeout", "stream") and value is not None
+        }
+        # pylint: enable=protected-access
+        if stop is not None:
+            params["stop"] = stop
+        return dict(params, messages=[convert_message_to_dict(m) for m in messages], **kwargs)
+
+    def _wait_for_limit(self, messages: List[BaseMessage], kwargs: dict) -> LimitReservation:
+        """
+        Wait until the model has enough TPM/RPM limit to process messages.
+        Token count passed by the outer wrapper (like ChooseKeyChatOpenAI) is taken
+        from call kwargs, so it won't reach OpenAI. Otherwise it is calculated here
+        (or estimated, if `estimate_tokens` is set).
+        The request tenant (see `set_tenant_quota`) is taken from call kwargs as well.
+        :return: Reservation to refund if the request fails
+          (empty one if the limits were already reserved by the batch dispatcher)
+        """
+        attach_session_hooks()
+        token_count = kwargs.pop(TOKEN_COUNT_KWARG, None)
+        tenant = kwargs.pop(TENANT_KWARG, None)
+        if kwargs.pop(LIMIT_ADMITTED_KWARG, False):
+            return LimitReservation(self.model_name, self.openai_api_key, 0, None)
+        exact_token_count = None
+        if token_count is None and self.estimate_tokens:
+            token_count = estimate_num_tokens_from_messages(messages)
+            exact_token_count = functools.partial(self.get_num_tokens_from_messages, messages)
+        elif token_count is None:
+            token_count = self.get_num_tokens_from_messages(messages)
+        return wait_for_limit(
             self.model_name,
             self.openai_api_key,
             token_count,
             self.limit_await_timeout,
             self.limit_await_sleep,
+            exact_token_count,
+            tenant,
+            self.align_reset,
         )
-        # pylint: disable=protected-access
-        for chunk in self.chat_openai._stream(messages, stop, run_manager, **kwargs):
-            yield chunk
-        # pylint: enable=protected-access
 
-    # pylint: disable=invalid-overridden-method
-    # I need to perform async operations inside, so method is async - and it works this way
-    async def _astream(self, messages: List[BaseMessage],
-                       stop: List[str] | None = None,
-                       run_manager: AsyncCallbackManagerForLLMRun | None = None,
-                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
-        token_count = self.get_num_tokens_from_messages(messages)
-        await await_for_limit(
+    async def _await_for_limit(self, messages: List[BaseMessage], kwargs: dict) \
+        -> LimitReservation:
+        """
+        Async version of `_wait_for_limit`
+        """
+        attach_session_hooks()
+        token_count = kwargs.pop(TOKEN_COUNT_KWARG, None)
+        tenant = kwargs.pop(TENANT_KWARG, None)
+        if kwargs.pop(LIMIT_ADMITTED_KWARG, False):
+            return LimitReservation(self.model_name, self.openai_api_key, 0, None)
+        exact_token_count = None
+        if token_count is None and self.estimate_tokens:
+            token_count = estimate_num_tokens_from_messages(messages)
+            exact_token_count = functools.partial(self.aget_num_tokens_from_messages, messages)
+        elif token_count is None:
+            token_count = await self.aget_num_tokens_from_messages(messages)
+        return await await_for_limit(
             self.model_name,
             self.openai_api_key,
             token_count,
             self.limit_await_timeout,
             self.limit_await_sleep,
+            exact_token_count,
+            tenant,
+            self.align_reset,
         )
+
+    def _concurrency_slot(self) -> ContextManager[ConcurrencySlot]:
+        """
+        Hold adaptive in-flight request slot (if `concurrency_control` is set)
+        """
+        return concurrency_slot(self.model_name, self.openai_api_key, self.concurrency_control,
+                                self.limit_await_timeout, self.limit_await_sleep)
+
+    def _aconcurrency_slot(self) -> AsyncContextManager[ConcurrencySlot]:
+        """
+        Async version of `_concurrency_slot`
+        """
+        return aconcurrency_slot(self.model_name, self.openai_api_key, self.concurrency_control,
+                                 self.limit_await_timeout, self.limit_await_sleep)
+
+    def _stream(self, messages: List[BaseMessage],
+                stop: List[str] | None = None,
+                run_manager: CallbackManagerForLLMRun | None = None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        if self.batch_offload is not None:
+            # Batch jobs do not stream, so the whole response comes as one chunk
+            for chunk in _replay_chunks(self._generate(messages, stop, None, **kwargs)):
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+            return
+        key = None
+        if self.response_cache is not None:
+            key = self._request_key(messages, stop, kwargs)
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                for chunk in _replay_chunks(cached):
+                    if run_manager:
+                        run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                    yield chunk
+                return
+        chunks = []
+        with self._wait_for_limit(messages, kwargs), self._concurrency_slot() as slot:
+            # pylint: disable=protected-access
+            for chunk in self.chat_openai._stream(messages, stop, run_manager, **kwargs):
+                slot.mark_latency()
+                chunks.append(chunk)
+                yield chunk
+            # pylint: enable=protected-access
+        if key is not None and chunks:
+            self.response_cache.set(key, _result_from_chunks(chunks))
+
+    # pylint: disable=invalid-overridden-method
+    # I need to perform async operations inside, so method is async - and it works this way
+    async def _astream(self, messages: List[BaseMessage],
+                       stop: List[str] | None = None,
+                       run_manager: AsyncCallbackManagerForLLMRun | None = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        if self.batch_offload is not None:
+            result = await self._agenerate(messages, stop, None, **kwargs)
+            for chunk in _replay_chunks(result):
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+            return
+        key = None
+        if self.response_cache is not None:
+            key = self._request_key(messages, stop, kwargs)
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                for chunk in _replay_chunks(cached):
+                    if run_manager:
+                        await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                    yield chunk
+                return
+        chunks = []
+        with await self._await_for_limit(messages, kwargs):
+            async with self._aconcurrency_slot() as slot:
+                # pylint: disable=protected-access
+                async for chunk in self.chat_openai._astream(messages, stop, run_manager,
+                                                             **kwargs):
+                    slot.mark_latency()
+                    chunks.append(chunk)
+                    yield chunk
+                # pylint: enable=protected-access
+        if key is not None and chunks:
+            self.response_cache.set(key, _result_from_chunks(chunks))
+    # pylint: enable=invalid-overridden-method
+
+    def _request_key(self, messages: List[BaseMessage], stop: List[str] | None,
+                     kwargs: dict) -> str:
+        """
+        Identity of the request, to coalesce identical in-flight ones and cache responses
+        """
+        call_kwargs = {
+            key: value
+            for key, value in kwargs.items()
+            if key not in (TOKEN_COUNT_KWARG, LIMIT_ADMITTED_KWARG, TENANT_KWARG)
+        }
         # pylint: disable=protected-access
-        async for chunk in self.chat_openai._astream(messages, stop, run_manager, **kwargs):
-            yield chunk
+        return request_key(
+            self.chat_openai._identifying_params,
+            [message.dict() for message in messages],
+            stop,
+            call_kwargs,
+        )
         # pylint: enable=protected-access
-    # pylint: enable=invalid-overridden-method
 
     def _generate(self, messages: List[BaseMessage],
                   stop: List[str] | None = None,
                   run_manager: CallbackManagerForLLMRun | None = None,
                   **kwargs: Any) -> ChatResult:
-        token_count = self.get_num_tokens_from_messages(messages)
-        wait_for_limit(
-            self.model_name,
-            self.openai_api_key,
-            token_count,
-            self.limit_await_timeout,
-            self.limit_await_sleep,
-        )
-        # pylint: disable=protected-access
-        return self.chat_openai._generate(messages, stop, run_manager, **kwargs)
-        # pylint: enable=protected-access
+        key = None
+        if self.response_cache is not None or self.single_flight:
+            key = self._request_key(messages, stop, kwargs)
+        if self.response_cache is not None:
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                return cached
+        if self.batch_offload is not None:
+            body = self._submit_offloaded(self._offload_body(messages, stop, kwargs)).result()
+            # pylint: disable=protected-access
+            result = self.chat_openai._create_chat_result(body)
+            # pylint: enable=protected-access
+        elif self.single_flight:
+            result = single_flight(
+                key,
+                functools.partial(self._generate_with_limit, messages, stop, run_manager,
+                                  **kwargs),
+            )
+        else:
+            result = self._generate_with_limit(messages, stop, run_manager, **kwargs)
+        if self.response_cache is not None:
+            self.response_cache.set(key, result)
+        return result
+
+    def _generate_with_limit(self, messages: List[BaseMessage],
+                             stop: List[str] | None = None,
+                             run_manager: CallbackManagerForLLMRun | None = None,
+                             **kwargs: Any) -> ChatResult:
+        """
+        Wait for limits and generate
+        (in-flight slot is taken after admission, so limit waits do not count as latency)
+        """
+        with self._wait_for_limit(messages, kwargs), self._concurrency_slot():
+            # pylint: disable=protected-access
+            return self.chat_openai._generate(messages, stop, run_manager, **kwargs)
+            # pylint: enable=protected-access
 
     async def _agenerate(self, messages: List[BaseMessage],
                          stop: List[str] | None = None,
                          run_manager: AsyncCallbackManagerForLLMRun | None = None,
                          **kwargs: Any) -> Coroutine[Any, Any, ChatResult]:
-        token_count = self.get_num_tokens_from_messages(messages)
-        await await_for_limit(
-            self.model_name,
-            self.openai_api_key,
-            token_count,
-            self.limit_await_timeout,
-            self.limit_await_sleep,
-        )
-        # pylint: disable=protected-access
-        return await self.chat_openai._agenerate(messages, stop, run_manager, **kwargs)
-        # pylint: enable=protected-access
+        key = None
+        if self.response_cache is not None or self.single_flight:
+            key = self._request_key(messages, stop, kwargs)
+        if self.response_cache is not None:
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                return cached
+        if self.batch_offload is not None:
+            body = await self.batch_offload.asubmit(
+                CHAT_COMPLETIONS_ENDPOINT, self._offload_body(messages, stop, kwargs)
+            )
+            # pylint: disable=protected-access
+            result = self.chat_openai._create_chat_result(body)
+            # pylint: enable=protected-access
+        elif self.single_flight:
+            result = await asingle_flight(
+                key,
+                functools.partial(self._agenerate_with_limit, messages, stop, run_manager,
+                                  **kwargs),
+            )
+        else:
+            result = await self._agenerate_with_limit(messages, stop, run_manager, **kwargs)
+        if self.response_cache is not None:
+            self.response_cache.set(key, result)
+        return result
 
+    async def _agenerate_with_limit(self, messages: List[BaseMessage],
+                                    stop: List[str] | None = None,
+                                    run_manager: AsyncCallbackManagerForLLMRun | None = None,
+                                    **kwargs: Any) -> ChatResult:
+        """
+        Wait for limits and generate
+        (in-flight slot is taken after admission, so limit waits do not count as latency)
+        """
+        with await self._await_for_limit(messages, kwargs):
+            async with self._aconcurrency_slot():
+                # pylint: disable=protected-access
+                return await self.chat_openai._agenerate(messages, stop, run_manager, **kwargs)
+                # pylint: enable=protected-access
 
-attach_session_hooks()
@@ -1,12 +1,27 @@
 """
 Module for rate/token per minute waiting OpenAIEmbeddings wrapper
 """
-from typing import List
+import functools
+from collections.abc import AsyncIterable
+from typing import Any, AsyncIterator, Iterable, Iterator, List, Tuple, Union
 from langchain.embeddings.base import Embeddings
 from langchain.embeddings.openai import OpenAIEmbeddings
-import tiktoken
-from .limit_info import wait_for_limit, await_for_limit
+import numpy as np
+from .limit_info import wait_for_limit, await_for_limit, LimitReservation
 from .capture_headers import attach_session_hooks
+from .concurrency_limit import AIMDSettings, concurrency_slot, aconcurrency_slot
+from .embedding_array import EmbeddingsOutput, embed_texts_array, aembed_texts_array
+from .embedding_cache import EmbeddingCache
+from .batch_offload import BatchOffload
+from .embeddings_batch import chunk_token_limit, embed_chunks_with_limits, \
+    aembed_chunks_with_limits, embed_stream_with_limits, aembed_stream_with_limits, \
+    unique_texts, expand_vectors, embed_offloaded, aembed_offloaded
+from .limit_batch import _BATCH_MAX_CONCURRENCY
+from .single_flight import request_key, single_flight, asingle_flight
+from .tenant_quota import Tenant
+from .token_counter import num_tokens_from_texts, anum_tokens_from_texts, \
+    num_tokens_per_text, anum_tokens_per_text, estimate_num_tokens_from_texts, \
+    estimate_num_tokens_per_text
 
 
 _LIMIT_AWAIT_SLEEP = 0.01
@@ -19,11 +34,40 @@ class LimitAwaitOpenAIEmbeddings(Embeddings):
     """
     def __init__(self, openai_embeddings: OpenAIEmbeddings,
                  limit_await_timeout: float = _LIMIT_AWAIT_TIMEOUT,
-                 limit_await_sleep: float = _LIMIT_AWAIT_SLEEP):
+                 limit_await_sleep: float = _LIMIT_AWAIT_SLEEP,
+                 estimate_tokens: bool = False,
+                 concurrency_control: Union[AIMDSettings, None] = None,
+                 single_flight: bool = False,
+                 embedding_cache: Union[EmbeddingCache, None] = None,
+                 numpy_dtype: Union[str, np.dtype, None] = None,
+                 batch_offload: Union[BatchOffload, None] = None,
+                 align_reset: bool = False):
+        """
+        :param estimate_tokens: Admit requests by a cheap upper-bound token estimate,
+          doing exact tokenization only when the estimate does not fit the remaining budget
+        :param concurrency_control: Adaptive in-flight request limit per (model, API key).
+          None - do not limit
+        :param single_flight: Coalesce identical concurrent requests into one OpenAI call
+          and one limit reservation
+        :param embedding_cache: Cache of text vectors, so only new texts are sent to OpenAI
+        :param numpy_dtype: Return embeddings as (texts, dimensions) array of this type
+          (like "float32"), decoded right from the response. None - return lists
+        :param batch_offload: Deferred mode: send texts as batch jobs instead of live
+          (limited) requests, waiting for the job completion. For non-urgent work
+        :param align_reset: Dispatch blocked requests one measured RTT before TPM/RPM reset,
+          so they arrive right after the server-side reset
+        """
         super().__init__()
         self.openai_embeddings = openai_embeddings
         self.limit_await_timeout = limit_await_timeout
         self.limit_await_sleep = limit_await_sleep
+        self.estimate_tokens = estimate_tokens
+        self.concurrency_control = concurrency_control
+        self.single_flight = single_flight
+        self.embedding_cache = embedding_cache
+        self.numpy_dtype = numpy_dtype
+        self.batch_offload = batch_offload
+        self.align_reset = align_reset
 
     @property
     def openai_api_key(self) -> str:
@@ -51,53 +95,324 @@ class LimitAwaitOpenAIEmbeddings(Embeddings):
     def model(self, value: str) -> None:
         self.openai_embeddings.model = value
 
+    @property
+    def chunk_size(self) -> int:
+        """
+        Max number of texts per OpenAI request
+        """
+        return self.openai_embeddings.chunk_size
+
     def get_num_tokens(self, texts: List[str]) -> int:
         """
         Count tokens in texts
         """
-        encoding = tiktoken.encoding_for_model(self.openai_embeddings.model)
-        token_ids = encoding.encode_batch(texts)
-        total_length = 0
-        for row in token_ids:
-            total_length += len(row)
-        return total_length
+        return num_tokens_from_texts(self.openai_embeddings.model, texts)
+
+    async def aget_num_tokens(self, texts: List[str]) -> int:
+        """
+        Count tokens in texts without blocking the event loop on large inputs
+        """
+        return await anum_tokens_from_texts(self.openai_embeddings.model, texts)
+
+    def _wait_for_limit(self, texts: List[str], token_count: Union[int, None],
+                        tenant: Tenant = None) -> LimitReservation:
+        """
+        Wait until the model has enough TPM/RPM limit to embed texts
+        :return: Reservation to refund if the request fails
+        """
+        exact_token_count = None
+        if token_count is None and self.estimate_tokens:
+            token_count = estimate_num_tokens_from_texts(texts)
+            exact_token_count = functools.partial(self.get_num_tokens, texts)
+        elif token_count is None:
+            token_count = self.get_num_tokens(texts)
+        return wait_for_limit(
+            self.openai_embeddings.model,
+            self.openai_api_key,
+            token_count,
+            self.limit_await_timeout,
+            self.limit_await_sleep,
+            exact_token_count,
+            tenant,
+            self.align_reset,
+        )
 
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+    async def _await_for_limit(self, texts: List[str], token_count: Union[int, None],
+                               tenant: Tenant = None) -> LimitReservation:
         """
-        Get document embeddings
+        Async version of `_wait_for_limit`
         """
-        token_count = self.get_num_tokens(texts)
-        wait_for_limit(
+        exact_token_count = None
+        if token_count is None and self.estimate_tokens:
+            token_count = estimate_num_tokens_from_texts(texts)
+            exact_token_count = functools.partial(self.aget_num_tokens, texts)
+        elif token_count is None:
+            token_count = await self.aget_num_tokens(texts)
+        return await await_for_limit(
             self.openai_embeddings.model,
             self.openai_api_key,
             token_count,
             self.limit_await_timeout,
             self.limit_await_sleep,
+            exact_token_count,
+            tenant,
+            self.align_reset,
         )
+
+    def _text_token_counts(self, texts: List[str]) -> List[int]:
+        """
+        Count (or estimate, if `estimate_tokens` is set) tokens in every text
+        """
+        if self.estimate_tokens:
+            return estimate_num_tokens_per_text(texts)
+        return num_tokens_per_text(self.openai_embeddings.model, texts)
+
+    async def _atext_token_counts(self, texts: List[str]) -> List[int]:
+        """
+        Async version of `_text_token_counts`
+        """
+        if self.estimate_tokens:
+            return estimate_num_tokens_per_text(texts)
+        return await anum_tokens_per_text(self.openai_embeddings.model, texts)
+
+    def _needs_chunking(self, texts: List[str], token_count: Union[int, None]) -> bool:
+        """
+        Check if texts could not be sent as a single request
+        (judging by cheap token count upper bound if the exact count is unknown)
+        """
+        if len(texts) > self.chunk_size:
+            return True
+        if token_count is None:
+            token_count = estimate_num_tokens_from_texts(texts)
+        return token_count > chunk_token_limit(self.openai_embeddings.model,
+                                               [self.openai_api_key], token_count)
+
+    def embed_documents(self, texts: List[str],
+                        token_count: Union[int, None] = None,
+                        limit_admitted: bool = False,
+                        tenant: Tenant = None) -> EmbeddingsOutput:
+        """
+        Get document embeddings.
+        Duplicate texts are sent (and counted) once.
+        Texts which do not fit a single request (or the TPM window) are split into chunks.
+        :param texts: Documents to embed
+        :param token_count: Token count of `texts` if it was already calculated by the caller
+        :param limit_admitted: Limits were already reserved by the caller
+          (like ChooseKeyOpenAIEmbeddings), so embed texts as they are
+        :param tenant: Tenant which share the request is admitted within (see `set_tenant_quota`)
+        """
+        if limit_admitted:
+            return self._embed_documents_admitted(texts)
+        unique, positions = unique_texts(texts)
+        if len(unique) < len(texts):
+            return expand_vectors(self.embed_documents(unique, tenant=tenant), positions)
+        if self.embedding_cache is not None:
+            return self.embedding_cache.embed_documents(
+                self.openai_embeddings.model,
+                texts,
+                functools.partial(self._embed_documents_uncached, token_count=None,
+                                  tenant=tenant),
+                self.numpy_dtype,
+            )
+        return self._embed_documents_uncached(texts, token_count, tenant)
+
+    def _embed_documents_uncached(self, texts: List[str], token_count: Union[int, None],
+                                  tenant: Tenant = None) -> EmbeddingsOutput:
+        """
+        Get document embeddings from OpenAI (splitting texts into chunks if needed)
+        """
+        if self.batch_offload is not None:
+            return embed_offloaded(self.batch_offload, self.openai_embeddings.model, texts,
+                                   self.chunk_size, self.numpy_dtype)
+        if self._needs_chunking(texts, token_count):
+            return embed_chunks_with_limits(
+                self.openai_embeddings.model,
+                [self.openai_api_key],
+                texts,
+                self._text_token_counts(texts),
+                self.chunk_size,
+                lambda chunk, _: self._embed_documents_admitted(chunk),
+                self.limit_await_timeout,
+                self.limit_await_sleep,
+                self.numpy_dtype,
+                tenant,
+            )
+        if self.single_flight:
+            return single_flight(
+                request_key(self.openai_embeddings.model, texts),
+                functools.partial(self._embed_documents_with_limit, texts, token_count, tenant),
+            )
+        return self._embed_documents_with_limit(texts, token_count, tenant)
+
+    def _embed_texts(self, texts: List[str]) -> EmbeddingsOutput:
+        """
+        Call OpenAI to get embeddings (in the configured output format)
+        """
+        attach_session_hooks()
+        if self.numpy_dtype is not None:
+            return embed_texts_array(self.openai_embeddings, texts, self.numpy_dtype)
         return self.openai_embeddings.embed_documents(texts)
 
+    def _embed_documents_admitted(self, texts: List[str]) -> EmbeddingsOutput:
+        """
+        Get document embeddings without limit awaiting
+        """
+        with concurrency_slot(self.openai_embeddings.model, self.openai_api_key,
+                              self.concurrency_control,
+                              self.limit_await_timeout, self.limit_await_sleep):
+            return self._embed_texts(texts)
+
+    def _embed_documents_with_limit(self, texts: List[str], token_count: Union[int, None],
+                                    tenant: Tenant = None) -> EmbeddingsOutput:
+        """
+        Wait for limits and get document embeddings
+        (in-flight slot is taken after admission, so limit waits do not count as latency)
+        """
+        with self._wait_for_limit(texts, token_count, tenant):
+            return self._embed_documents_admitted(texts)
+
     def embed_query(self, text: str) -> List[float]:
         """
         Get query embeddings
         """
         return self.embed_documents([text])[0]
 
-    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+    async def aembed_documents(self, texts: List[str],
+                               token_count: Union[int, None] = None,
+                               limit_admitted: bool = False,
+                               tenant: Tenant = None) -> EmbeddingsOutput:
+        """
+        Get document embeddings.
+        Duplicate texts are sent (and counted) once.
+        Texts which do not fit a single request (or the TPM window) are split into chunks.
+        :param texts: Documents to embed
+        :param token_count: Token count of `texts` if it was already calculated by the caller
+        :param limit_admitted: Limits were already reserved by the caller
+          (like ChooseKeyOpenAIEmbeddings), so embed texts as they are
+        :param tenant: Tenant which share the request is admitted within (see `set_tenant_quota`)
+        """
+        if limit_admitted:
+            return await self._aembed_documents_admitted(texts)
+        unique, positions = unique_texts(texts)
+        if len(unique) < len(texts):
+            return expand_vectors(await self.aembed_documents(unique, tenant=tenant), positions)
+        if self.embedding_cache is not None:
+            return await self.embedding_cache.aembed_documents(
+                self.openai_embeddings.model,
+                texts,
+                functools.partial(self._aembed_documents_uncached, token_count=None,
+                                  tenant=tenant),
+                self.numpy_dtype,
+            )
+        return await self._aembed_documents_uncached(texts, token_count, tenant)
+
+    async def _aembed_documents_uncached(self, texts: List[str], token_count: Union[int, None],
+                                         tenant: Tenant = None) -> EmbeddingsOutput:
         """
-        Get document embeddings
+        Get document embeddings from OpenAI (splitting texts into chunks if needed)
+        """
+        if self.batch_offload is not None:
+            return await aembed_offloaded(self.batch_offload, self.openai_embeddings.model,
+                                          texts, self.chunk_size, self.numpy_dtype)
+        if self._needs_chunking(texts, token_count):
+            return await aembed_chunks_with_limits(
+                self.openai_embeddings.model,
+                [self.openai_api_key],
+                texts,
+                await self._atext_token_counts(texts),
+                self.chunk_size,
+                lambda chunk, _: self._aembed_documents_admitted(chunk),
+                self.limit_await_timeout,
+                self.limit_await_sleep,
+                self.numpy_dtype,
+                tenant,
+            )
+        if self.single_flight:
+            return await asingle_flight(
+                request_key(self.openai_embeddings.model, texts),
+                functools.partial(self._aembed_documents_with_limit, texts, token_count,
+                                  tenant),
+            )
+        return await self._aembed_documents_with_limit(texts, token_count, tenant)
+
+    async def _aembed_texts(self, texts: List[str]) -> EmbeddingsOutput:
+        """
+        Async version of `_embed_texts`
+        """
+        attach_session_hooks()
+        if self.numpy_dtype is not None:
+            return await aembed_texts_array(self.openai_embeddings, texts, self.numpy_dtype)
+        return await self.openai_embeddings.aembed_documents(texts)
+
+    def _set_model_header(self) -> None:
+        """
+        Pass model name to the async header hook (embedding responses do not contain it)
         """
-        token_count = self.get_num_tokens(texts)
         if not self.openai_embeddings.headers:
             self.openai_embeddings.headers = {}
         self.openai_embeddings.headers["x-model"] = self.openai_embeddings.model
-        await await_for_limit(
+
+    async def _aembed_documents_admitted(self, texts: List[str]) -> EmbeddingsOutput:
+        """
+        Get document embeddings without limit awaiting
+        """
+        self._set_model_header()
+        async with aconcurrency_slot(self.openai_embeddings.model, self.openai_api_key,
+                                     self.concurrency_control,
+                                     self.limit_await_timeout, self.limit_await_sleep):
+            return await self._aembed_texts(texts)
+
+    async def _aembed_documents_with_limit(self, texts: List[str],
+                                           token_count: Union[int, None],
+                                           tenant: Tenant = None) -> EmbeddingsOutput:
+        """
+        Wait for limits and get document embeddings
+        (in-flight slot is taken after admission, so limit waits do not count as latency)
+        """
+        with await self._await_for_limit(texts, token_count, tenant):
+            return await self._aembed_documents_admitted(texts)
+
+    def embed_stream(self, texts: Iterable[str],
+                     max_concurrency: int = _BATCH_MAX_CONCURRENCY,
+                     tenant: Tenant = None) -> Iterator[Tuple[int, Any]]:
+        """
+        Embed lazily consumed texts (like a corpus read from disk), batching them by
+        token budget and keeping up to `max_concurrency` requests in flight.
+        Texts are read only when there is room for them, so memory stays constant.
+        Embedding cache is not used.
+        :return: Iterator over (text index, vector) pairs in completion order
+        """
+        return embed_stream_with_limits(
             self.openai_embeddings.model,
-            self.openai_api_key,
-            token_count,
+            [self.openai_api_key],
+            texts,
+            self._text_token_counts,
+            self.chunk_size,
+            lambda chunk, _: self._embed_documents_admitted(chunk),
             self.limit_await_timeout,
             self.limit_await_sleep,
+            max_concurrency,
+            tenant,
+        )
+
+    def aembed_stream(self, texts: Union[Iterable[str], AsyncIterable],
+                      max_concurrency: int = _BATCH_MAX_CONCURRENCY,
+                      tenant: Tenant = None) -> AsyncIterator[Tuple[int, Any]]:
+        """
+        Async version of `embed_stream` (`texts` could also be an asynchronyous iterable)
+        """
+        return aembed_stream_with_limits(
+            self.openai_embeddings.model,
+            [self.openai_api_key],
+            texts,
+            self._atext_token_counts,
+            self.chunk_size,
+            lambda chunk, _: self._aembed_documents_admitted(chunk),
+            self.limit_await_timeout,
+            self.limit_await_sleep,
+            max_concurrency,
+            tenant,
         )
-        return await self.openai_embeddings.aembed_documents(texts)
 
     async def aembed_query(self, text: str) -> List[float]:
         """
@@ -105,5 +420,3 @@ class LimitAwaitOpenAIEmbeddings(Embeddings):
         """
         return (await self.aembed_documents([text]))[0]
 
-
-attach_session_hooks()
@@ -0,0 +1,353 @@
+"""
+Limit-aware batch processing for chat wrappers.
+
+Instead of running every batch item independently (so every item polls the limiter
+on its own), a single dispatcher admits items in input order as soon as one of API keys
+has enough RPM/TPM budget for the next item, keeping a bounded amount of requests in flight.
+Items which never fit limits of any key fail right away instead of blocking the rest.
+"""
+from abc import ABC, abstractmethod
+import asyncio
+from collections.abc import AsyncIterable
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, \
+    Optional, Tuple, Union
+from langchain.schema.language_model import LanguageModelInput
+from langchain.schema.messages import BaseMessage
+from langchain.schema.runnable import Runnable, RunnableConfig
+from langchain.schema.runnable.config import get_config_list
+from .capture_headers import attach_session_hooks
+from .limit_info import reserve_any_key, areserve_any_key, predict_wait, apredict_wait, \
+    ApiKey, ModelName, LimitReservation
+from .tenant_quota import Tenant, TENANT_KWARG
+
+
+_BATCH_MAX_CONCURRENCY = 16
+# Call kwarg used by the batch dispatcher to tell LimitAwaitChatOpenAI
+# that the request limits were already reserved
+LIMIT_ADMITTED_KWARG = "limit_admitted"
+
+
+def _timeout_result(return_exceptions: bool) -> TimeoutError:
+    """
+    Build (or raise) the result of an item which was not admitted in time
+    """
+    error = TimeoutError()
+    if not return_exceptions:
+        raise error
+    return error
+
+
+def _call_reserved(call: Callable[[int, ApiKey], Any], index: int,
+                   reservation: LimitReservation) -> Any:
+    """
+    Run admitted item, refunding its reservation if it fails
+    """
+    attach_session_hooks()
+    with reservation:
+        return call(index, reservation.api_key)
+
+
+async def _acall_reserved(call: Callable[[int, ApiKey], Awaitable[Any]], index: int,
+                          reservation: LimitReservation) -> Any:
+    """
+    Run admitted item, refunding its reservation if it fails or gets cancelled
+    """
+    attach_session_hooks()
+    with reservation:
+        return await call(index, reservation.api_key)
+
+
+async def _aenumerate(token_counts: Union[Iterable[int], AsyncIterable]) \
+    -> AsyncIterator[Tuple[int, int]]:
+    """
+    Enumerate synchronyous or asynchronyous iterable
+    """
+    index = 0
+    if isinstance(token_counts, AsyncIterable):
+        async for token_count in token_counts:
+            yield index, token_count
+            index += 1
+    else:
+        for token_count in token_counts:
+            yield index, token_count
+            index += 1
+
+
+def batch_as_completed_with_limits(model_name: ModelName, api_keys: List[ApiKey],
+                                   token_counts: Iterable[int],
+                                   call: Callable[[int, ApiKey], Any],
+                                   limit_await_timeout: float, limit_await_sleep: float,
+                                   max_concurrency: int = _BATCH_MAX_CONCURRENCY,
+                                   return_exceptions: bool = False,
+                                   tenant: Tenant = None) \
+    -> Iterator[Tuple[int, Any]]:
+    """
+    Run `call(index, api_key)` for every item in a thread pool, admitting items in order
+    when some key has budget for `token_counts[index]` tokens.
+    An item which could not be admitted during `limit_await_timeout` seconds fails
+    with TimeoutError (right away if it never fits TPM limit of any key).
+    Budget of items which failed or were never started is refunded.
+    `token_counts` is consumed lazily: the next item is taken only when there is
+    a free slot for it, so a slow consumer of the results stops the intake.
+    All items are admitted within the share of `tenant` (see `set_tenant_quota`).
+    :return: Iterator over (item index, result or exception) pairs in completion order
+    """
+    items = enumerate(token_counts)
+    head = next(items, None) # (index, token count) of the first item which was not admitted
+    running: Dict[Future, int] = {}
+    reservations: Dict[Future, LimitReservation] = {}
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    head_since = time.monotonic()
+    try:
+        while head is not None or running:
+            while head is not None:
+                if len(running) >= max_concurrency:
+                    # Waiting for a free slot, not for the limit
+                    head_since = time.monotonic()
+                    break
+                index, token_count = head
+                reservation = reserve_any_key(model_name, api_keys, token_count, tenant)
+                if reservation is not None:
+                    future = executor.submit(_call_reserved, call, index, reservation)
+                    running[future] = index
+                    reservations[future] = reservation
+                    head = next(items, None)
+                elif time.monotonic() - head_since >= limit_await_timeout or \
+                        predict_wait(model_name, api_keys, token_count) == float("inf"):
+                    head = next(items, None)
+                    yield index, _timeout_result(return_exceptions)
+                else:
+                    break
+                head_since = time.monotonic()
+            if not running:
+                if head is not None:
+                    time.sleep(limit_await_sleep)
+                continue
+            done, _ = wait(running, timeout=limit_await_sleep if head is not None else None,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                reservations.pop(future)
+                try:
+                    result = future.result()
+                except Exception as error: # pylint: disable=broad-exception-caught
+                    if not return_exceptions:
+                        raise
+                    result = error
+                yield index, result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for reservation in reservations.values():
+            reservation.refund() # No-op for the items which managed to finish
+
+
+async def abatch_as_completed_with_limits(model_name: ModelName, api_keys: List[ApiKey],
+                                          token_counts: Union[Iterable[int],
+                                                              AsyncIterable],
+                                          call: Callable[[int, ApiKey], Awaitable[Any]],
+                                          limit_await_timeout: float, limit_await_sleep: float,
+                                          max_concurrency: int = _BATCH_MAX_CONCURRENCY,
+                                          return_exceptions: bool = False,
+                                          tenant: Tenant = None) \
+    -> AsyncIterator[Tuple[int, Any]]:
+    """
+    Async version of `batch_as_completed_with_limits`
+    (`token_counts` could also be an asynchronyous iterable)
+    """
+    items = _aenumerate(token_counts)
+    head = await anext(items, None)
+    running: Dict[asyncio.Task, int] = {}
+    reservations: Dict[asyncio.Task, LimitReservation] = {}
+    head_since = time.monotonic()
+    try:
+        while head is not None or running:
+            while head is not None:
+                if len(running) >= max_concurrency:
+                    head_since = time.monotonic()
+                    break
+                index, token_count = head
+                reservation = await areserve_any_key(model_name, api_keys, token_count, tenant)
+                if reservation is not None:
+                    task = asyncio.ensure_future(_acall_reserved(call, index, reservation))
+                    running[task] = index
+                    reservations[task] = reservation
+                    head = await anext(items, None)
+                elif time.monotonic() - head_since >= limit_await_timeout or \
+                        await apredict_wait(model_name, api_keys, token_count) == float("inf"):
+                    head = await anext(items, None)
+                    yield index, _timeout_result(return_exceptions)
+                else:
+                    break
+                head_since = time.monotonic()
+            if not running:
+                if head is not None:
+                    await asyncio.sleep(limit_await_sleep)
+                continue
+            done, _ = await asyncio.wait(running,
+                                         timeout=limit_await_sleep if head is not None else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = running.pop(task)
+                reservations.pop(task)
+                try:
+                    result = task.result()
+                except Exception as error: # pylint: disable=broad-exception-caught
+                    if not return_exceptions:
+                        raise
+                    result = error
+                yield index, result
+    finally:
+        for task in running:
+            task.cancel()
+        # Tasks cancelled before their first step never enter `_acall_reserved` body
+        for reservation in reservations.values():
+            reservation.refund()
+
+
+class LimitAwareBatchMixin(ABC):
+    """
+    Limit-aware `batch` / `abatch` implementation for chat wrappers.
+    Subclasses should define `_batch_api_keys` and `_batch_runnable`.
+    """
+    @abstractmethod
+    def _batch_api_keys(self) -> List[ApiKey]:
+        """
+        API keys to spread batch items across
+        """
+
+    @abstractmethod
+    def _batch_runnable(self, api_key: ApiKey) -> Tuple[Runnable, Dict[str, Any]]:
+        """
+        Chat model (and extra call kwargs) to run admitted batch item with given API key
+        """
+
+    def _batch_messages(self, inputs: List[LanguageModelInput]) -> List[List[BaseMessage]]:
+        """
+        Convert batch inputs to messages
+        """
+        # pylint: disable=no-member
+        return [
+            self._convert_input(model_input).to_messages()
+            for model_input in inputs
+        ]
+        # pylint: enable=no-member
+
+    def _batch_call(self, inputs: List[LanguageModelInput], configs: List[RunnableConfig],
+                    kwargs: dict) -> Callable[[int, ApiKey], Any]:
+        """
+        Build synchronyous batch item runner
+        """
+        runnables = {}
+
+        def _call(index: int, api_key: ApiKey) -> Any:
+            if api_key not in runnables:
+                runnables[api_key] = self._batch_runnable(api_key)
+            runnable, extra_kwargs = runnables[api_key]
+            return runnable.invoke(inputs[index], configs[index], **kwargs, **extra_kwargs)
+
+        return _call
+
+    def _abatch_call(self, inputs: List[LanguageModelInput], configs: List[RunnableConfig],
+                     kwargs: dict) -> Callable[[int, ApiKey], Awaitable[Any]]:
+        """
+        Build asynchronyous batch item runner
+        """
+        runnables = {}
+
+        async def _call(index: int, api_key: ApiKey) -> Any:
+            if api_key not in runnables:
+                runnables[api_key] = self._batch_runnable(api_key)
+            runnable, extra_kwargs = runnables[api_key]
+            return await runnable.ainvoke(inputs[index], configs[index], **kwargs, **extra_kwargs)
+
+        return _call
+
+    def batch_as_completed(self, inputs: List[LanguageModelInput],
+                           config: Optional[Union[RunnableConfig, List[RunnableConfig]]] = None,
+                           *,
+                           return_exceptions: bool = False,
+                           **kwargs: Any) -> Iterator[Tuple[int, Any]]:
+        """
+        Run inputs against RPM/TPM budget of API keys,
+        yielding (input index, result or exception) pairs as soon as they complete
+        """
+        if not inputs:
+            return
+        configs = get_config_list(config, len(inputs))
+        tenant = kwargs.pop(TENANT_KWARG, None)
+        token_counts = [
+            self.get_num_tokens_from_messages(messages) # pylint: disable=no-member
+            for messages in self._batch_messages(inputs)
+        ]
+        yield from batch_as_completed_with_limits(
+            self.model_name, # pylint: disable=no-member
+            self._batch_api_keys(),
+            token_counts,
+            self._batch_call(inputs, configs, kwargs),
+            self.limit_await_timeout, # pylint: disable=no-member
+            self.limit_await_sleep, # pylint: disable=no-member
+            configs[0].get("max_concurrency") or _BATCH_MAX_CONCURRENCY,
+            return_exceptions,
+            tenant,
+        )
+
+    async def abatch_as_completed(self, inputs: List[LanguageModelInput],
+                                  config: Optional[Union[RunnableConfig,
+                                                         List[RunnableConfig]]] = None,
+                                  *,
+                                  return_exceptions: bool = False,
+                                  **kwargs: Any) -> AsyncIterator[Tuple[int, Any]]:
+        """
+        Async version of `batch_as_completed`
+        """
+        if not inputs:
+            return
+        configs = get_config_list(config, len(inputs))
+        tenant = kwargs.pop(TENANT_KWARG, None)
+        token_counts = [
+            await self.aget_num_tokens_from_messages(messages) # pylint: disable=no-member
+            for messages in self._batch_messages(inputs)
+        ]
+        async for index, result in abatch_as_completed_with_limits(
+                self.model_name, # pylint: disable=no-member
+                self._batch_api_keys(),
+                token_counts,
+                self._abatch_call(inputs, configs, kwargs),
+                self.limit_await_timeout, # pylint: disable=no-member
+                self.limit_await_sleep, # pylint: disable=no-member
+                configs[0].get("max_concurrency") or _BATCH_MAX_CONCURRENCY,
+                return_exceptions,
+                tenant):
+            yield index, result
+
+    def batch(self, inputs: List[LanguageModelInput],
+              config: Optional[Union[RunnableConfig, List[RunnableConfig]]] = None,
+              *,
+              return_exceptions: bool = False,
+              **kwargs: Any) -> List[Any]:
+        """
+        Run inputs against RPM/TPM budget of API keys, returning results in input order
+        """
+        results: List[Any] = [None] * len(inputs)
+        for index, result in self.batch_as_completed(inputs, config,
+                                                     return_exceptions=return_exceptions,
+                                                     **kwargs):
+            results[index] = result
+        return results
+
+    async def abatch(self, inputs: List[LanguageModelInput],
+                     config: Optional[Union[RunnableConfig, List[RunnableConfig]]] = None,
+                     *,
+                     return_exceptions: bool = False,
+                     **kwargs: Any) -> List[Any]:
+        """
+        Async version of `batch`
+        """
+        results: List[Any] = [None] * len(inputs)
+        async for index, result in self.abatch_as_completed(inputs, config,
+                                                            return_exceptions=return_exceptions,
+                                                            **kwargs):
+            results[index] = result
+        return results
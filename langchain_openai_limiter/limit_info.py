@@ -1,13 +1,21 @@
 """
 Module for limit processing itself
 """
-from datetime import datetime
-from dataclasses import dataclass
-from typing import Dict, Union, List
+from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass, replace
+from typing import Awaitable, Callable, Dict, Iterator, Set, Tuple, Union, List
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
+import hashlib
 import time
 import asyncio
 import threading
 import random
+import weakref
+from .tenant_quota import Tenant, tenant_fits, record_tenant_usage, refund_tenant_usage, \
+    reset_tenant_quotas, store_tenant_quota
 
 
 @dataclass
@@ -21,35 +29,280 @@ class OrganizationLimitInfo:
     rpm_remain: int # Request per minute remain (total - used in some time frame)
     rpm_reset_time: datetime # When will RPM limit reset
     tpm_reset_time: datetime # When will TPM limit reset
+    # Daily quotas (None - there is no daily quota or it is unknown)
+    rpd_total: Union[int, None] = None # Request per day total
+    rpd_remain: Union[int, None] = None # Request per day remain
+    tpd_total: Union[int, None] = None # Token per day total
+    tpd_remain: Union[int, None] = None # Token per day remain
+    daily_reset_time: Union[datetime, None] = None # When will daily limits reset
+    daily_pace: bool = False # Spread daily quota evenly across the day
+    # Budget of the next TPM/RPM window taken by requests dispatched ahead of the reset
+    # (see `align_reset` of `wait_for_limit`), subtracted when the window resets
+    rpm_ahead: int = 0
+    tpm_ahead: int = 0
+
+
+@dataclass
+class DailyLimitConfig:
+    """
+    Configured daily quotas (for keys which responses do not tell them)
+    """
+    requests_per_day: Union[int, None] = None
+    tokens_per_day: Union[int, None] = None
+    pace: bool = False # Spread daily quota evenly across the day
+
+
+@dataclass
+class LimitSnapshot:
+    """
+    State of one key (organization) limits at snapshot time. API keys are redacted
+    """
+    model_name: str
+    owner: str # API key fingerprint or organization
+    # Per-minute limits (None - limits are unknown yet)
+    rpm_total: Union[int, None] = None
+    rpm_remain: Union[int, None] = None
+    tpm_total: Union[int, None] = None
+    tpm_remain: Union[int, None] = None
+    rpm_reset_in: Union[float, None] = None # Seconds until RPM reset (0 - already reset)
+    tpm_reset_in: Union[float, None] = None # Seconds until TPM reset (0 - already reset)
+    # Daily quotas (None - there is no daily quota or it is unknown)
+    rpd_remain: Union[int, None] = None
+    tpd_remain: Union[int, None] = None
+    daily_reset_in: Union[float, None] = None
+    waiters: int = 0 # Requests waiting for limits which could run via this key (organization)
+    in_flight: int = 0 # Running requests with reserved budget
+    in_flight_tokens: int = 0 # Tokens reserved by running requests
+    rtt: Union[float, None] = None # Smoothed network round trip of the key
+                                   # (mean of organization keys), seconds
+
+
+class DailyLimitExceededError(TimeoutError):
+    """
+    Daily quota does not allow to run the request within the limit awaiting timeout
+    """
 
 # Type helpers
 ApiKey = str
 ModelName = str
+Organization = str
+LimitOwner = str # API key or organization (if it is known for the key)
+
+# Constants
+_DAY_SECONDS = 24 * 60 * 60
+# How much of the daily quota paced consumption may take ahead of the even pace
+_DAILY_PACE_BURST = 1 / 24
+# Points of every key (organization) on the consistent hashing ring
+_AFFINITY_RING_REPLICAS = 64
+# How much more than the average TPM load the preferred key may take
+_AFFINITY_LOAD_FACTOR = 1.25
+# RTT smoothing weights (as in TCP retransmission timer)
+_RTT_SMOOTHING = 1 / 8
+_RTT_VARIATION_SMOOTHING = 1 / 4
 
 # Limit info store
-_LIMIT_INFO_STORE: Dict[ModelName, Dict[ApiKey, OrganizationLimitInfo]] = {}
+_LIMIT_INFO_STORE: Dict[ModelName, Dict[LimitOwner, OrganizationLimitInfo]] = {}
+# Organization of API keys - limits are shared by organization keys
+_API_KEY_ORGANIZATIONS: Dict[ApiKey, Organization] = {}
+# Configured daily quotas
+_DAILY_LIMIT_CONFIGS: Dict[ModelName, Dict[LimitOwner, DailyLimitConfig]] = {}
+# Network round trip estimates of API keys: smoothed RTT and its variation (seconds)
+_RTT_ESTIMATES: Dict[ApiKey, Tuple[float, float]] = {}
+# Amount of requests waiting for limits of the (model, key or organization)
+_LIMIT_WAITERS: Dict[Tuple[ModelName, LimitOwner], int] = {}
+# Reservations of running requests (dropped ones disappear on their own)
+_IN_FLIGHT_RESERVATIONS: "weakref.WeakSet[LimitReservation]" = weakref.WeakSet()
+# Model name resolution: requested model name (alias or snapshot) -> name limits are stored under.
+# Configured groups take precedence over aliases learned from responses
+_CONFIGURED_MODEL_GROUPS: Dict[ModelName, ModelName] = {}
+_LEARNED_MODEL_ALIASES: Dict[ModelName, ModelName] = {}
+# Requested model names which limits were looked up but not found (aliases the hooks should learn)
+_UNRESOLVED_MODEL_NAMES: Set[ModelName] = set()
+# Background true-up of reservations admitted by token estimates (see `wait_for_limit`)
+_TRUE_UP_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="limit-true-up")
+_TRUE_UP_TASKS: "Set[asyncio.Future]" = set()
 # Locks - threading based for synchronyous code, async to use in pair with it for async functions
 _SYNC_LIMIT_INFO_LOCK = threading.Lock()
 _ASYNC_LIMIT_INFO_LOCK = asyncio.Lock()
 
 
+def resolve_model_name(model_name: ModelName) -> ModelName:
+    """
+    Get the name limits of the model are stored under
+    (its limit group, or the model snapshot it is an alias of)
+    """
+    seen = set()
+    while model_name not in seen:
+        seen.add(model_name)
+        next_name = _CONFIGURED_MODEL_GROUPS.get(model_name)
+        if next_name is None:
+            next_name = _LEARNED_MODEL_ALIASES.get(model_name)
+        if next_name is None:
+            break
+        model_name = next_name
+    return model_name
+
+def set_model_group(group_name: ModelName, model_names: List[ModelName]) -> None:
+    """
+    Make models (like a few snapshots of the same model) share one limit,
+    stored under `group_name`
+    """
+    with _SYNC_LIMIT_INFO_LOCK:
+        for model_name in model_names:
+            _CONFIGURED_MODEL_GROUPS[model_name] = group_name
+
+def learn_model_alias(requested_model_name: ModelName, served_model_name: ModelName) -> None:
+    """
+    Remember that requests to `requested_model_name` (like "gpt-4")
+    are served by `served_model_name` (like "gpt-4-0613")
+    """
+    if requested_model_name == served_model_name:
+        return
+    with _SYNC_LIMIT_INFO_LOCK:
+        if requested_model_name not in _CONFIGURED_MODEL_GROUPS:
+            _LEARNED_MODEL_ALIASES[requested_model_name] = served_model_name
+        _UNRESOLVED_MODEL_NAMES.discard(requested_model_name)
+
+def model_aliases_pending() -> bool:
+    """
+    Whether limits were looked up for model names which are not resolved to known limits yet,
+    so header hooks should read requested model names to learn aliases
+    (a lock-free hint: a stale answer only delays or repeats learning)
+    """
+    return bool(_UNRESOLVED_MODEL_NAMES)
+
+def _limit_owner(api_key: ApiKey) -> LimitOwner:
+    """
+    (INNER VERSION) Get the name limits of the key are stored under
+    """
+    organization = _API_KEY_ORGANIZATIONS.get(api_key)
+    if organization is None:
+        return api_key
+    return f"organization:{organization}"
+
+def _set_api_key_organization(api_key: ApiKey, organization: Organization) -> None:
+    """
+    (INNER VERSION) Remember API key organization, moving limits stored for the key alone
+    to the organization
+    """
+    if _API_KEY_ORGANIZATIONS.get(api_key) == organization:
+        return
+    _API_KEY_ORGANIZATIONS[api_key] = organization
+    owner = _limit_owner(api_key)
+    for model_limits in _LIMIT_INFO_STORE.values():
+        limit_info = model_limits.pop(api_key, None)
+        if limit_info is not None and owner not in model_limits:
+            model_limits[owner] = limit_info
+
+def set_api_key_organization(api_key: ApiKey, organization: Organization) -> None:
+    """
+    Remember API key organization, so limits of keys from one organization are shared
+    """
+    with _SYNC_LIMIT_INFO_LOCK:
+        _set_api_key_organization(api_key, organization)
+
+def _next_daily_reset(current_time: datetime) -> datetime:
+    """
+    (INNER VERSION) Next UTC midnight (in naive local time, like other reset times)
+    :param current_time: Timezone-aware current time
+    """
+    utc_date = current_time.astimezone(timezone.utc).date()
+    utc_midnight = datetime.combine(utc_date + timedelta(days=1), datetime.min.time(),
+                                    tzinfo=timezone.utc)
+    return utc_midnight.astimezone().replace(tzinfo=None)
+
+def _apply_daily_limit_config(limit_info: OrganizationLimitInfo, config: DailyLimitConfig,
+                              current_time: datetime) -> None:
+    """
+    (INNER VERSION) Set configured daily quotas to limit info (keeping already spent budget)
+    :param current_time: Timezone-aware current time
+    """
+    if limit_info.daily_reset_time is None:
+        limit_info.daily_reset_time = _next_daily_reset(current_time)
+    limit_info.daily_pace = config.pace
+    if config.requests_per_day is not None:
+        spent = (limit_info.rpd_total or 0) - (limit_info.rpd_remain or 0)
+        limit_info.rpd_total = config.requests_per_day
+        limit_info.rpd_remain = config.requests_per_day - spent
+    if config.tokens_per_day is not None:
+        spent = (limit_info.tpd_total or 0) - (limit_info.tpd_remain or 0)
+        limit_info.tpd_total = config.tokens_per_day
+        limit_info.tpd_remain = config.tokens_per_day - spent
+
+def _carry_daily_limits(model_name: ModelName, owner: LimitOwner,
+                        limit_info: OrganizationLimitInfo) -> None:
+    """
+    (INNER VERSION) Per-minute headers do not always tell daily quotas -
+    take them from the previous limit info or from the config
+    """
+    if limit_info.daily_reset_time is not None:
+        return
+    previous = _LIMIT_INFO_STORE.get(model_name, {}).get(owner)
+    if previous is not None and previous.daily_reset_time is not None:
+        limit_info.rpd_total = previous.rpd_total
+        limit_info.rpd_remain = previous.rpd_remain
+        limit_info.tpd_total = previous.tpd_total
+        limit_info.tpd_remain = previous.tpd_remain
+        limit_info.daily_reset_time = previous.daily_reset_time
+        limit_info.daily_pace = previous.daily_pace
+        return
+    config = _DAILY_LIMIT_CONFIGS.get(model_name, {}).get(owner)
+    if config is not None:
+        _apply_daily_limit_config(limit_info, config, datetime.now(timezone.utc))
+
+def set_daily_limit(model_name: ModelName, api_key: ApiKey,
+                    requests_per_day: Union[int, None] = None,
+                    tokens_per_day: Union[int, None] = None,
+                    pace: bool = False) -> None:
+    """
+    Configure daily quotas of the key (organization) for keys which responses
+    do not tell them. Configured quotas reset at UTC midnight.
+    :param pace: Spread the quota evenly across the day instead of spending it ASAP
+    """
+    with _SYNC_LIMIT_INFO_LOCK:
+        model_name = resolve_model_name(model_name)
+        owner = _limit_owner(api_key)
+        config = DailyLimitConfig(requests_per_day, tokens_per_day, pace)
+        _DAILY_LIMIT_CONFIGS.setdefault(model_name, {})[owner] = config
+        limit_info = _LIMIT_INFO_STORE.get(model_name, {}).get(owner)
+        if limit_info is not None:
+            _apply_daily_limit_config(limit_info, config, datetime.now(timezone.utc))
+
+def set_tenant_quota(tenant: Tenant, min_share: float, max_share: float = 1.0) -> None:
+    """
+    Configure tenant share of every key (organization) TPM limit.
+    Tenants without quota have no guarantee, but may use idle capacity.
+    """
+    with _SYNC_LIMIT_INFO_LOCK:
+        store_tenant_quota(tenant, min_share, max_share)
+
 def set_limit_info(model_name: ModelName, api_key: ApiKey,
-                   limit_info: OrganizationLimitInfo) -> None:
+                   limit_info: OrganizationLimitInfo,
+                   organization: Union[Organization, None] = None) -> None:
     """
     Update model limit information for given API key
+    :param organization: API key organization (if known)
     """
     with _SYNC_LIMIT_INFO_LOCK:
+        if organization is not None:
+            _set_api_key_organization(api_key, organization)
+        model_name = resolve_model_name(model_name)
+        owner = _limit_owner(api_key)
+        _carry_daily_limits(model_name, owner, limit_info)
         if model_name not in _LIMIT_INFO_STORE:
             _LIMIT_INFO_STORE[model_name] = {}
-        _LIMIT_INFO_STORE[model_name][api_key] = limit_info
+        _LIMIT_INFO_STORE[model_name][owner] = limit_info
+        _UNRESOLVED_MODEL_NAMES.discard(model_name)
 
 async def aset_limit_info(model_name: ModelName, api_key: ApiKey,
-                   limit_info: OrganizationLimitInfo) -> None:
+                   limit_info: OrganizationLimitInfo,
+                   organization: Union[Organization, None] = None) -> None:
     """
     Update model limit information for given API key
+    :param organization: API key organization (if known)
     """
     async with _ASYNC_LIMIT_INFO_LOCK:
-        set_limit_info(model_name, api_key, limit_info)
+        set_limit_info(model_name, api_key, limit_info, organization)
 
 def _get_limit_info(model_name: ModelName, api_key: ApiKey) \
     -> Union[OrganizationLimitInfo, None]:
@@ -59,14 +312,100 @@ def _get_limit_info(model_name: ModelName, api_key: ApiKey) \
       called with the given API key
     """
     current_time = datetime.now()
-    result = _LIMIT_INFO_STORE.get(model_name, {}).get(api_key)
+    model_limits = _LIMIT_INFO_STORE.get(resolve_model_name(model_name))
+    if model_limits is None:
+        _UNRESOLVED_MODEL_NAMES.add(model_name)
+        return None
+    _UNRESOLVED_MODEL_NAMES.discard(model_name)
+    result = model_limits.get(_limit_owner(api_key))
     if result is not None:
         if result.rpm_reset_time < current_time:
-            result.rpm_remain = result.rpm_total
+            result.rpm_remain = result.rpm_total - result.rpm_ahead
         if result.tpm_reset_time < current_time:
-            result.tpm_remain = result.tpm_total
+            result.tpm_remain = result.tpm_total - result.tpm_ahead
+        if result.daily_reset_time is not None and result.daily_reset_time < current_time:
+            result.rpd_remain = result.rpd_total
+            result.tpd_remain = result.tpd_total
+            while result.daily_reset_time < current_time:
+                result.daily_reset_time += timedelta(days=1)
     return result
 
+def _daily_wait(limit_info: Union[OrganizationLimitInfo, None], token_count: int,
+                current_time: datetime) -> float:
+    """
+    (INNER VERSION) Predict how many seconds it takes for daily quotas to fit the request
+    (with pacing - the even share of the quota for the time passed, plus a burst)
+    """
+    if limit_info is None or limit_info.daily_reset_time is None:
+        return 0.0
+    seconds_to_reset = max((limit_info.daily_reset_time - current_time).total_seconds(), 0.0)
+    wait = 0.0
+    for total, remain, count in ((limit_info.rpd_total, limit_info.rpd_remain, 1),
+                                 (limit_info.tpd_total, limit_info.tpd_remain, token_count)):
+        if total is None:
+            continue
+        if count > total:
+            return float("inf")
+        if remain < count:
+            wait = max(wait, seconds_to_reset)
+        elif limit_info.daily_pace:
+            # Budget left for the rest of the day
+            reserved = total * max(seconds_to_reset / _DAY_SECONDS - _DAILY_PACE_BURST, 0.0)
+            if remain - reserved < count:
+                wait = max(wait, (count - remain + reserved) / total * _DAY_SECONDS)
+    return wait
+
+def _fits(limit_info: Union[OrganizationLimitInfo, None], token_count: int,
+          current_time: datetime) -> bool:
+    """
+    (INNER VERSION) Check if has 1 in RPM limit, more than `token_count` in TPM limit,
+    and daily quotas fit the request
+    """
+    if limit_info is None:
+        return True
+    return limit_info.rpm_remain > 0 and limit_info.tpm_remain > token_count and \
+        _daily_wait(limit_info, token_count, current_time) == 0.0
+
+def _decrease_limit(limit_info: Union[OrganizationLimitInfo, None], token_count: int,
+                    early: Tuple[bool, bool] = (False, False)) -> None:
+    """
+    (INNER VERSION) Take request budget from limits
+    :param early: Whether RPM and TPM budget is taken from the next window (see `_early_resets`)
+    """
+    if limit_info is None:
+        return
+    rpm_early, tpm_early = early
+    if rpm_early:
+        limit_info.rpm_ahead += 1
+    else:
+        limit_info.rpm_remain -= 1
+    if tpm_early:
+        limit_info.tpm_ahead += token_count
+    else:
+        limit_info.tpm_remain -= token_count
+    if limit_info.rpd_remain is not None:
+        limit_info.rpd_remain -= 1
+    if limit_info.tpd_remain is not None:
+        limit_info.tpd_remain -= token_count
+
+def _daily_limit_wait(model_name: ModelName, api_keys: List[ApiKey], token_count: int) \
+    -> float:
+    """
+    Predict how many seconds daily quotas of the best of given keys need to fit the request
+    """
+    with _SYNC_LIMIT_INFO_LOCK:
+        current_time = datetime.now()
+        return min(_daily_wait(_get_limit_info(model_name, api_key), token_count, current_time)
+                   for api_key in api_keys)
+
+async def _adaily_limit_wait(model_name: ModelName, api_keys: List[ApiKey],
+                             token_count: int) -> float:
+    """
+    Async version of `_daily_limit_wait`
+    """
+    async with _ASYNC_LIMIT_INFO_LOCK:
+        return _daily_limit_wait(model_name, api_keys, token_count)
+
 def get_limit_info(model_name: ModelName, api_key: ApiKey) \
     -> Union[OrganizationLimitInfo, None]:
     """
@@ -87,83 +426,426 @@ async def aget_limit_info(model_name: ModelName, api_key: ApiKey) \
     async with _ASYNC_LIMIT_INFO_LOCK:
         return get_limit_info(model_name, api_key)
 
-def _get_and_decrease_limit(model_name: ModelName, api_key: ApiKey, token_count: int) -> bool:
+def record_rtt(api_key: ApiKey, rtt: float) -> None:
     """
-    Check if has 1 in RPM limit and not least than `token_count` in TPM limit
+    Account measured network round trip (response time without server processing) of the key
+    """
+    with _SYNC_LIMIT_INFO_LOCK:
+        estimate = _RTT_ESTIMATES.get(api_key)
+        if estimate is None:
+            _RTT_ESTIMATES[api_key] = (rtt, rtt / 2)
+            return
+        smoothed_rtt, rtt_variation = estimate
+        rtt_variation += _RTT_VARIATION_SMOOTHING * (abs(smoothed_rtt - rtt) - rtt_variation)
+        smoothed_rtt += _RTT_SMOOTHING * (rtt - smoothed_rtt)
+        _RTT_ESTIMATES[api_key] = (smoothed_rtt, rtt_variation)
+
+async def arecord_rtt(api_key: ApiKey, rtt: float) -> None:
+    """
+    Account measured network round trip (response time without server processing) of the key
+    """
+    async with _ASYNC_LIMIT_INFO_LOCK:
+        record_rtt(api_key, rtt)
+
+def _reset_lead(api_key: ApiKey) -> float:
+    """
+    (INNER VERSION) How early requests of the key may be sent to arrive right after
+    the server-side limit reset.
+    Reset time is learned from response headers, so it is late by the response trip,
+    and the request itself needs the request trip - one RTT in total.
+    The lead is lowered by RTT variation, so requests do not arrive before the reset.
+    :return: Seconds (0 while RTT is unknown)
+    """
+    estimate = _RTT_ESTIMATES.get(api_key)
+    if estimate is None:
+        return 0.0
+    smoothed_rtt, rtt_variation = estimate
+    return max(smoothed_rtt - 2 * rtt_variation, 0.0)
+
+def _early_resets(limit_info: Union[OrganizationLimitInfo, None],
+                  reset_lead: float) -> Tuple[bool, bool]:
+    """
+    (INNER VERSION) Whether RPM and TPM windows, which did not reset yet,
+    reset within `reset_lead` seconds
+    """
+    if limit_info is None or reset_lead <= 0.0:
+        return False, False
+    current_time = datetime.now()
+    reset_time = current_time + timedelta(seconds=reset_lead)
+    return current_time <= limit_info.rpm_reset_time < reset_time, \
+        current_time <= limit_info.tpm_reset_time < reset_time
+
+def _early_reset_view(limit_info: Union[OrganizationLimitInfo, None],
+                      early: Tuple[bool, bool]) -> Union[OrganizationLimitInfo, None]:
+    """
+    (INNER VERSION) Limits as seen by a reset-aligned waiter: a copy with the next window
+    budget (what is not taken ahead yet) for windows which reset early (see `_early_resets`).
+    The stored limit info is not changed, so other waiters are not admitted before the reset.
+    """
+    rpm_early, tpm_early = early
+    if not rpm_early and not tpm_early:
+        return limit_info
+    view = replace(limit_info)
+    if rpm_early:
+        view.rpm_remain = view.rpm_total - view.rpm_ahead
+    if tpm_early:
+        view.tpm_remain = view.tpm_total - view.tpm_ahead
+    return view
+
+def _reset_align_sleep(model_name: ModelName, api_key: ApiKey,
+                       limit_await_sleep: float) -> float:
+    """
+    How long a reset-aligned waiter should sleep: until the (lead-adjusted) TPM/RPM reset
+    if it comes before the next `limit_await_sleep` tick
     """
     with _SYNC_LIMIT_INFO_LOCK:
         limit_info = _get_limit_info(model_name, api_key)
-        run = False
-        if limit_info is None or (
-                limit_info.rpm_remain > 0
-                and
-                limit_info.tpm_remain > token_count
-        ):
-            if limit_info:
-                limit_info.rpm_remain -= 1
-                limit_info.tpm_remain -= token_count
-            run = True
-        return run
-
-async def _aget_and_decrease_limit(model_name: ModelName, api_key: ApiKey, token_count: int) \
-    -> bool:
+        if limit_info is None:
+            return limit_await_sleep
+        reset_time = datetime.now() + timedelta(seconds=_reset_lead(api_key))
+        until_reset = [
+            (limit_reset_time - reset_time).total_seconds()
+            for limit_reset_time in (limit_info.rpm_reset_time, limit_info.tpm_reset_time)
+            if limit_reset_time > reset_time
+        ]
+        return min(until_reset + [limit_await_sleep])
+
+async def _areset_align_sleep(model_name: ModelName, api_key: ApiKey,
+                              limit_await_sleep: float) -> float:
+    """
+    Async version of `_reset_align_sleep`
+    """
+    async with _ASYNC_LIMIT_INFO_LOCK:
+        return _reset_align_sleep(model_name, api_key, limit_await_sleep)
+
+class LimitReservation:
+    """
+    RPM/TPM budget reserved for a single request.
+
+    Use it as a context manager around the request: the reservation is refunded
+    if the block raises (including cancellation and generator close), and kept otherwise.
+    Refund only happens while the limit info it was taken from is still actual - once
+    response headers arrive, they already describe server-side budget, request included.
+    """
+    def __init__(self, model_name: ModelName, api_key: ApiKey, token_count: int,
+                 limit_info: Union[OrganizationLimitInfo, None],
+                 tenant: Tenant = None, tenant_usage: Union[List[float], None] = None,
+                 early: Tuple[bool, bool] = (False, False)):
+        self.model_name = model_name
+        self.api_key = api_key
+        self.token_count = token_count
+        self.tenant = tenant
+        self._limit_info = limit_info # Limit info we decreased (None - limits were unknown)
+        self._tenant_usage = tenant_usage # Tenant usage entry we added (None - not tracked)
+        self._early = early # RPM and TPM budget was taken from the next window
+        self._active = limit_info is not None
+
+    def refund(self) -> None:
+        """
+        Give reserved budget back
+        """
+        with _SYNC_LIMIT_INFO_LOCK:
+            self._refund()
+
+    def _refund(self) -> None:
+        """
+        (INNER VERSION) Give reserved budget back
+        """
+        _IN_FLIGHT_RESERVATIONS.discard(self)
+        if not self._active:
+            return
+        self._active = False
+        limit_info = self._limit_info
+        model_name = resolve_model_name(self.model_name)
+        if self._tenant_usage is not None:
+            refund_tenant_usage(model_name, _limit_owner(self.api_key), self.tenant,
+                                self._tenant_usage)
+        if _LIMIT_INFO_STORE.get(model_name, {}).get(_limit_owner(self.api_key)) is limit_info:
+            rpm_early, tpm_early = self._early
+            if rpm_early:
+                limit_info.rpm_ahead = max(limit_info.rpm_ahead - 1, 0)
+            else:
+                limit_info.rpm_remain = min(limit_info.rpm_total, limit_info.rpm_remain + 1)
+            if tpm_early:
+                limit_info.tpm_ahead = max(limit_info.tpm_ahead - self.token_count, 0)
+            else:
+                limit_info.tpm_remain = min(limit_info.tpm_total,
+                                            limit_info.tpm_remain + self.token_count)
+            if limit_info.rpd_remain is not None:
+                limit_info.rpd_remain = min(limit_info.rpd_total, limit_info.rpd_remain + 1)
+            if limit_info.tpd_remain is not None:
+                limit_info.tpd_remain = min(limit_info.tpd_total,
+                                            limit_info.tpd_remain + self.token_count)
+
+    @property
+    def active(self) -> bool:
+        """
+        The reservation holds budget (limits were known, not committed or refunded yet)
+        """
+        return self._active
+
+    def true_up(self, token_count: int) -> None:
+        """
+        Replace the reserved token estimate with the exact token count,
+        giving the excess back (while the limit info it was taken from is still actual)
+        """
+        with _SYNC_LIMIT_INFO_LOCK:
+            excess = self.token_count - token_count
+            if not self._active or excess <= 0:
+                return
+            self.token_count = token_count
+            limit_info = self._limit_info
+            if self._tenant_usage is not None:
+                self._tenant_usage[1] = token_count
+            model_name = resolve_model_name(self.model_name)
+            if _LIMIT_INFO_STORE.get(model_name, {}).get(_limit_owner(self.api_key)) \
+                    is limit_info:
+                if self._early[1]:
+                    limit_info.tpm_ahead = max(limit_info.tpm_ahead - excess, 0)
+                else:
+                    limit_info.tpm_remain = min(limit_info.tpm_total,
+                                                limit_info.tpm_remain + excess)
+                if limit_info.tpd_remain is not None:
+                    limit_info.tpd_remain = min(limit_info.tpd_total,
+                                                limit_info.tpd_remain + excess)
+
+    def commit(self) -> None:
+        """
+        Mark reserved budget as spent
+        """
+        with _SYNC_LIMIT_INFO_LOCK:
+            self._active = False
+            _IN_FLIGHT_RESERVATIONS.discard(self)
+
+    def __enter__(self) -> "LimitReservation":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.commit()
+        else:
+            self.refund()
+
+
+def _fits_tenant(model_name: ModelName, api_key: ApiKey,
+                 limit_info: Union[OrganizationLimitInfo, None], token_count: int,
+                 tenant: Tenant) -> bool:
+    """
+    (INNER VERSION) Check if the tenant share of key (organization) TPM fits the request
+    """
+    if limit_info is None:
+        return True
+    return tenant_fits(resolve_model_name(model_name), _limit_owner(api_key), tenant,
+                       token_count, limit_info.tpm_total, limit_info.tpm_remain)
+
+def _reserve(model_name: ModelName, api_key: ApiKey,
+             limit_info: Union[OrganizationLimitInfo, None], token_count: int,
+             tenant: Tenant, early: Tuple[bool, bool] = (False, False)) -> LimitReservation:
+    """
+    (INNER VERSION) Take request budget from limits (and the tenant share)
+    :param early: Whether RPM and TPM budget is taken from the next window (see `_early_resets`)
+    """
+    _decrease_limit(limit_info, token_count, early)
+    tenant_usage = None
+    if limit_info is not None:
+        tenant_usage = record_tenant_usage(resolve_model_name(model_name),
+                                           _limit_owner(api_key), tenant, token_count)
+    reservation = LimitReservation(model_name, api_key, token_count, limit_info, tenant,
+                                   tenant_usage, early)
+    _IN_FLIGHT_RESERVATIONS.add(reservation)
+    return reservation
+
+def _get_and_decrease_limit(model_name: ModelName, api_key: ApiKey, token_count: int,
+                            tenant: Tenant = None, align_reset: bool = False) \
+    -> Union[LimitReservation, None]:
     """
     Check if has 1 in RPM limit and not least than `token_count` in TPM limit
+    (and daily quotas and the tenant share allow the request), and reserve them if so
+    :param align_reset: Treat TPM and RPM as reset one RTT earlier (see `_reset_lead`)
+    :return: Reservation or None if limits do not allow to run now
+    """
+    with _SYNC_LIMIT_INFO_LOCK:
+        limit_info = _get_limit_info(model_name, api_key)
+        early = _early_resets(limit_info, _reset_lead(api_key) if align_reset else 0.0)
+        view = _early_reset_view(limit_info, early)
+        if _fits(view, token_count, datetime.now()) and \
+                _fits_tenant(model_name, api_key, view, token_count, tenant):
+            # Early dispatched requests take budget of the next window, carried over the reset
+            return _reserve(model_name, api_key, limit_info, token_count, tenant, early)
+        return None
+
+async def _aget_and_decrease_limit(model_name: ModelName, api_key: ApiKey, token_count: int,
+                                   tenant: Tenant = None, align_reset: bool = False) \
+    -> Union[LimitReservation, None]:
+    """
+    Check if has 1 in RPM limit and not least than `token_count` in TPM limit,
+    and reserve them if so
+    :return: Reservation or None if limits do not allow to run now
     """
     async with _ASYNC_LIMIT_INFO_LOCK:
-        return _get_and_decrease_limit(model_name, api_key, token_count)
+        return _get_and_decrease_limit(model_name, api_key, token_count, tenant, align_reset)
+
+@contextlib.contextmanager
+def _limit_waiter(model_name: ModelName, api_keys: List[ApiKey]) -> Iterator[None]:
+    """
+    Account a request waiting for limits of any of given keys (see `snapshot_limits`)
+    """
+    with _SYNC_LIMIT_INFO_LOCK:
+        waits = [(resolve_model_name(model_name), owner) for owner in _group_keys(api_keys)]
+        for wait in waits:
+            _LIMIT_WAITERS[wait] = _LIMIT_WAITERS.get(wait, 0) + 1
+    try:
+        yield
+    finally:
+        with _SYNC_LIMIT_INFO_LOCK:
+            for wait in waits:
+                # The store could be reset meanwhile
+                _LIMIT_WAITERS[wait] = _LIMIT_WAITERS.get(wait, 0) - 1
+                if _LIMIT_WAITERS[wait] <= 0:
+                    del _LIMIT_WAITERS[wait]
+
+def _true_up(reservation: LimitReservation, exact_token_count: Callable[[], int]) -> None:
+    """
+    Count tokens of the request admitted by the estimate and true up its reservation
+    (if counting fails, the estimate is kept - it is an upper bound anyway)
+    """
+    try:
+        token_count = exact_token_count()
+    except Exception: # pylint: disable=broad-exception-caught
+        return
+    reservation.true_up(token_count)
+
+async def _atrue_up(reservation: LimitReservation,
+                    exact_token_count: Callable[[], Awaitable[int]]) -> None:
+    """
+    Async version of `_true_up`
+    """
+    try:
+        token_count = await exact_token_count()
+    except Exception: # pylint: disable=broad-exception-caught
+        return
+    reservation.true_up(token_count)
 
 def wait_for_limit(model_name: ModelName, api_key: ApiKey, token_count: int,
-                   limit_await_timeout: float, limit_await_sleep: float) -> None:
+                   limit_await_timeout: float, limit_await_sleep: float,
+                   exact_token_count: Union[Callable[[], int], None] = None,
+                   tenant: Tenant = None, align_reset: bool = False) -> LimitReservation:
     """
     Wait up to `limit_await_timeout` seconds timeout (splitted to `limit_await_sleep` chunks).
     If during this timeout model got `token_count` tokens free TPM and 1 RPM - continue, else fail.
+    Fails right away (with DailyLimitExceededError) if daily quota won't fit in time.
+    :param exact_token_count: If passed - `token_count` is treated as a conservative estimate,
+      and this function is called (once) to get exact token count when the estimate does not fit
+      the remaining budget. If the estimate is admitted, it is called in background instead,
+      to true up the reservation while the request runs
+    :param tenant: Tenant of the request (see `set_tenant_quota`)
+    :param align_reset: Dispatch one RTT before TPM/RPM reset (as measured for the key),
+      so the request arrives right after the server-side reset
+    :return: Reservation of the request budget
     """
     max_await_count = int(limit_await_timeout / limit_await_sleep)
-    for _ in range(max_await_count):
-        run = _get_and_decrease_limit(model_name, api_key, token_count)
-        if run:
-            return
-        time.sleep(limit_await_sleep)
-    raise TimeoutError()
+    with _limit_waiter(model_name, [api_key]):
+        for _ in range(max_await_count):
+            reservation = _get_and_decrease_limit(model_name, api_key, token_count, tenant,
+                                                  align_reset)
+            if reservation is None and exact_token_count is not None:
+                token_count = exact_token_count()
+                exact_token_count = None
+                reservation = _get_and_decrease_limit(model_name, api_key, token_count,
+                                                      tenant, align_reset)
+            if reservation is not None and exact_token_count is not None and reservation.active:
+                # Admitted by the estimate - count exactly off the dispatch path
+                _TRUE_UP_EXECUTOR.submit(_true_up, reservation, exact_token_count)
+            if reservation is not None:
+                return reservation
+            if _daily_limit_wait(model_name, [api_key], token_count) > limit_await_timeout:
+                raise DailyLimitExceededError()
+            if align_reset:
+                time.sleep(_reset_align_sleep(model_name, api_key, limit_await_sleep))
+            else:
+                time.sleep(limit_await_sleep)
+        raise TimeoutError()
 
 async def await_for_limit(model_name: ModelName, api_key: ApiKey, token_count: int,
-                   limit_await_timeout: float, limit_await_sleep: float) -> None:
+                   limit_await_timeout: float, limit_await_sleep: float,
+                   exact_token_count: Union[Callable[[], Awaitable[int]], None] = None,
+                   tenant: Tenant = None, align_reset: bool = False) -> LimitReservation:
     """
     Wait up to `limit_await_timeout` seconds timeout (splitted to `limit_await_sleep` chunks).
     If during this timeout model got `token_count` tokens free TPM and 1 RPM - continue, else fail.
+    Fails right away (with DailyLimitExceededError) if daily quota won't fit in time.
+    :param exact_token_count: If passed - `token_count` is treated as a conservative estimate,
+      and this coroutine function is awaited (once) to get exact token count when the estimate
+      does not fit the remaining budget. If the estimate is admitted, it is awaited in a task
+      instead, to true up the reservation while the request runs
+    :param tenant: Tenant of the request (see `set_tenant_quota`)
+    :param align_reset: Dispatch one RTT before TPM/RPM reset (as measured for the key),
+      so the request arrives right after the server-side reset
+    :return: Reservation of the request budget
     """
     max_await_count = int(limit_await_timeout / limit_await_sleep)
-    for _ in range(max_await_count):
-        run = await _aget_and_decrease_limit(model_name, api_key, token_count)
-        if run:
-            return
-        await asyncio.sleep(limit_await_sleep)
-    raise TimeoutError()
+    with _limit_waiter(model_name, [api_key]):
+        for _ in range(max_await_count):
+            reservation = await _aget_and_decrease_limit(model_name, api_key, token_count,
+                                                         tenant, align_reset)
+            if reservation is None and exact_token_count is not None:
+                token_count = await exact_token_count()
+                exact_token_count = None
+                reservation = await _aget_and_decrease_limit(model_name, api_key, token_count,
+                                                             tenant, align_reset)
+            if reservation is not None and exact_token_count is not None and reservation.active:
+                # Admitted by the estimate - count exactly off the dispatch path
+                task = asyncio.ensure_future(_atrue_up(reservation, exact_token_count))
+                _TRUE_UP_TASKS.add(task)
+                task.add_done_callback(_TRUE_UP_TASKS.discard)
+            if reservation is not None:
+                return reservation
+            if await _adaily_limit_wait(model_name, [api_key],
+                                        token_count) > limit_await_timeout:
+                raise DailyLimitExceededError()
+            if align_reset:
+                await asyncio.sleep(await _areset_align_sleep(model_name, api_key,
+                                                              limit_await_sleep))
+            else:
+                await asyncio.sleep(limit_await_sleep)
+        raise TimeoutError()
+
+def _group_keys(api_keys: List[ApiKey]) -> Dict[LimitOwner, List[ApiKey]]:
+    """
+    (INNER VERSION) Group API keys by the limits they share
+    """
+    groups: Dict[LimitOwner, List[ApiKey]] = {}
+    for api_key in api_keys:
+        groups.setdefault(_limit_owner(api_key), []).append(api_key)
+    return groups
+
+def keys_of_other_owners(api_keys: List[ApiKey], api_key: ApiKey) -> List[ApiKey]:
+    """
+    Keys which do not share limits with the given one (neither it nor its organization keys)
+    """
+    with _SYNC_LIMIT_INFO_LOCK:
+        owner = _limit_owner(api_key)
+        return [key for key in api_keys if _limit_owner(key) != owner]
 
 def choose_key(model_name: ModelName, api_keys: List[ApiKey], token_count: int) -> ApiKey:
     """
     Choose one API key from known.
+    Keys are spread across organizations (keys of one organization share its limits).
     """
     with _SYNC_LIMIT_INFO_LOCK:
         assert len(api_keys) > 0, "Should have passed API keys"
-        limit_infos = [
-            _get_limit_info(model_name, api_key)
-            for api_key in api_keys
-        ]
         # Check which limits allow us to place corresponding amount of tokens
-        clearly_possible_keys = []
-        api_key: ApiKey
-        for api_key, limit in zip(api_keys, limit_infos):
-            if limit is None:
-                clearly_possible_keys.append(api_key)
-            elif (limit.rpm_remain > 0) and (limit.tpm_remain > token_count):
-                clearly_possible_keys.append(api_key)
+        current_time = datetime.now()
+        clearly_possible_groups = [
+            owner_keys
+            for owner_keys in _group_keys(api_keys).values()
+            if _fits(_get_limit_info(model_name, owner_keys[0]), token_count, current_time)
+        ]
         # Than choose one of them
-        if len(clearly_possible_keys) > 0:
-            return random.choice(clearly_possible_keys)
+        if len(clearly_possible_groups) > 0:
+            return random.choice(random.choice(clearly_possible_groups))
         # Or choose one of default and hope it will soon be available
-        return random.choice(api_key)
+        return random.choice(api_keys)
 
 async def achoose_key(model_name: ModelName, api_keys: List[ApiKey], token_count: int) -> ApiKey:
     """
@@ -172,8 +854,314 @@ async def achoose_key(model_name: ModelName, api_keys: List[ApiKey], token_count
     async with _ASYNC_LIMIT_INFO_LOCK:
         return choose_key(model_name, api_keys, token_count)
 
+def _ring_hash(value: str) -> int:
+    """
+    (INNER VERSION) Position on the consistent hashing ring
+    """
+    return int.from_bytes(hashlib.sha256(value.encode("utf-8")).digest()[:8], "big")
+
+@functools.lru_cache(maxsize=128)
+def _affinity_ring(owners: Tuple[LimitOwner, ...]) -> Tuple[List[int], List[LimitOwner]]:
+    """
+    (INNER VERSION) Consistent hashing ring of limit owners
+    :return: Sorted point positions and owners of the points
+    """
+    points = sorted(
+        (_ring_hash(f"{owner}:{replica}"), owner)
+        for owner in owners
+        for replica in range(_AFFINITY_RING_REPLICAS)
+    )
+    return [position for position, _ in points], [owner for _, owner in points]
+
+def _ring_order(owners: Tuple[LimitOwner, ...], affinity_key: str) -> List[LimitOwner]:
+    """
+    (INNER VERSION) Owners in the order of the ring walk starting from the affinity key
+    """
+    positions, point_owners = _affinity_ring(owners)
+    start = bisect.bisect(positions, _ring_hash(affinity_key))
+    order: Dict[LimitOwner, None] = {}
+    for i in range(len(point_owners)):
+        order.setdefault(point_owners[(start + i) % len(point_owners)])
+        if len(order) == len(owners):
+            break
+    return list(order)
+
+def choose_key_by_affinity(model_name: ModelName, api_keys: List[ApiKey], token_count: int,
+                           affinity_key: str,
+                           load_factor: float = _AFFINITY_LOAD_FACTOR) -> ApiKey:
+    """
+    Choose API key consistently for the same `affinity_key` (like a prompt prefix hash),
+    using consistent hashing with bounded load: the preferred key (organization)
+    is skipped if it does not have limits for the request, or if its TPM load
+    (tokens spent in the current window) exceeds `load_factor` times the average one.
+    """
+    with _SYNC_LIMIT_INFO_LOCK:
+        assert len(api_keys) > 0, "Should have passed API keys"
+        groups = _group_keys(api_keys)
+        limits = {owner: _get_limit_info(model_name, owner_keys[0])
+                  for owner, owner_keys in groups.items()}
+        loads = {
+            owner: 0 if limit_info is None else limit_info.tpm_total - limit_info.tpm_remain
+            for owner, limit_info in limits.items()
+        }
+        max_load = load_factor * sum(loads.values()) / len(groups)
+        current_time = datetime.now()
+        fitting = [
+            owner
+            for owner in _ring_order(tuple(sorted(groups)), affinity_key)
+            if _fits(limits[owner], token_count, current_time)
+        ]
+        for owner in fitting:
+            if loads[owner] <= max_load:
+                return random.choice(groups[owner])
+        if fitting:
+            return random.choice(groups[fitting[0]])
+        # Or choose one of default and hope it will soon be available
+        return random.choice(api_keys)
+
+async def achoose_key_by_affinity(model_name: ModelName, api_keys: List[ApiKey],
+                                  token_count: int, affinity_key: str,
+                                  load_factor: float = _AFFINITY_LOAD_FACTOR) -> ApiKey:
+    """
+    Async version of `choose_key_by_affinity`
+    """
+    async with _ASYNC_LIMIT_INFO_LOCK:
+        return choose_key_by_affinity(model_name, api_keys, token_count, affinity_key,
+                                      load_factor)
+
+def reserve_any_key(model_name: ModelName, api_keys: List[ApiKey], token_count: int,
+                    tenant: Tenant = None) -> Union[LimitReservation, None]:
+    """
+    Choose the API key with the most TPM headroom which has 1 in RPM limit and not least
+    than `token_count` in TPM limit, and reserve them.
+    Keys with unknown limits are preferred, so we will learn their limits.
+    Headroom is compared between organizations (keys of one organization share its limits).
+    :return: Reservation (with chosen `api_key`) or None if neither key fits now
+    """
+    with _SYNC_LIMIT_INFO_LOCK:
+        assert len(api_keys) > 0, "Should have passed API keys"
+        current_time = datetime.now()
+        best_groups: List[List[ApiKey]] = []
+        best_headroom = None
+        for owner_keys in _group_keys(api_keys).values():
+            limit_info = _get_limit_info(model_name, owner_keys[0])
+            if not _fits(limit_info, token_count, current_time) or \
+                    not _fits_tenant(model_name, owner_keys[0], limit_info, token_count, tenant):
+                continue
+            if limit_info is None:
+                headroom = float("inf")
+            else:
+                headroom = limit_info.tpm_remain - token_count
+            if best_headroom is None or headroom > best_headroom:
+                best_groups = [owner_keys]
+                best_headroom = headroom
+            elif headroom == best_headroom:
+                best_groups.append(owner_keys)
+        if not best_groups:
+            return None
+        api_key = random.choice(random.choice(best_groups))
+        limit_info = _get_limit_info(model_name, api_key)
+        return _reserve(model_name, api_key, limit_info, token_count, tenant)
+
+async def areserve_any_key(model_name: ModelName, api_keys: List[ApiKey], token_count: int,
+                           tenant: Tenant = None) -> Union[LimitReservation, None]:
+    """
+    Choose the API key with the most TPM headroom which has 1 in RPM limit and not least
+    than `token_count` in TPM limit, and reserve them.
+    :return: Reservation (with chosen `api_key`) or None if neither key fits now
+    """
+    async with _ASYNC_LIMIT_INFO_LOCK:
+        return reserve_any_key(model_name, api_keys, token_count, tenant)
+
+def wait_for_any_key(model_name: ModelName, api_keys: List[ApiKey], token_count: int,
+                     limit_await_timeout: float, limit_await_sleep: float,
+                     tenant: Tenant = None) -> LimitReservation:
+    """
+    Wait up to `limit_await_timeout` seconds timeout (splitted to `limit_await_sleep` chunks)
+    until one of API keys got `token_count` tokens free TPM and 1 RPM,
+    and reserve them (see `reserve_any_key`).
+    Fails right away (with DailyLimitExceededError) if daily quotas won't fit in time.
+    """
+    max_await_count = int(limit_await_timeout / limit_await_sleep)
+    with _limit_waiter(model_name, api_keys):
+        for _ in range(max_await_count):
+            reservation = reserve_any_key(model_name, api_keys, token_count, tenant)
+            if reservation is not None:
+                return reservation
+            if _daily_limit_wait(model_name, api_keys, token_count) > limit_await_timeout:
+                raise DailyLimitExceededError()
+            time.sleep(limit_await_sleep)
+        raise TimeoutError()
+
+async def await_for_any_key(model_name: ModelName, api_keys: List[ApiKey], token_count: int,
+                            limit_await_timeout: float, limit_await_sleep: float,
+                            tenant: Tenant = None) -> LimitReservation:
+    """
+    Wait up to `limit_await_timeout` seconds timeout (splitted to `limit_await_sleep` chunks)
+    until one of API keys got `token_count` tokens free TPM and 1 RPM,
+    and reserve them (see `reserve_any_key`).
+    Fails right away (with DailyLimitExceededError) if daily quotas won't fit in time.
+    """
+    max_await_count = int(limit_await_timeout / limit_await_sleep)
+    with _limit_waiter(model_name, api_keys):
+        for _ in range(max_await_count):
+            reservation = await areserve_any_key(model_name, api_keys, token_count, tenant)
+            if reservation is not None:
+                return reservation
+            if await _adaily_limit_wait(model_name, api_keys, token_count) > limit_await_timeout:
+                raise DailyLimitExceededError()
+            await asyncio.sleep(limit_await_sleep)
+        raise TimeoutError()
+
+def _predict_wait(limit_info: Union[OrganizationLimitInfo, None], token_count: int,
+                  current_time: datetime) -> float:
+    """
+    (INNER VERSION) Predict how many seconds it takes for limits to fit the request
+    """
+    if limit_info is None:
+        return 0.0
+    if token_count >= limit_info.tpm_total:
+        return float("inf")
+    wait = 0.0
+    if limit_info.rpm_remain <= 0:
+        wait = max(wait, (limit_info.rpm_reset_time - current_time).total_seconds())
+    if limit_info.tpm_remain <= token_count:
+        wait = max(wait, (limit_info.tpm_reset_time - current_time).total_seconds())
+    return max(wait, _daily_wait(limit_info, token_count, current_time))
+
+def predict_wait(model_name: ModelName, api_keys: List[ApiKey], token_count: int) -> float:
+    """
+    Predict how many seconds the request of `token_count` tokens will wait for limits
+    of the best of given API keys (0 - it fits now or limits are unknown,
+    infinity - it never fits)
+    """
+    with _SYNC_LIMIT_INFO_LOCK:
+        assert len(api_keys) > 0, "Should have passed API keys"
+        current_time = datetime.now()
+        return min(
+            _predict_wait(_get_limit_info(model_name, owner_keys[0]), token_count, current_time)
+            for owner_keys in _group_keys(api_keys).values()
+        )
+
+async def apredict_wait(model_name: ModelName, api_keys: List[ApiKey], token_count: int) \
+    -> float:
+    """
+    Async version of `predict_wait`
+    """
+    async with _ASYNC_LIMIT_INFO_LOCK:
+        return predict_wait(model_name, api_keys, token_count)
+
+def key_fingerprint(api_key: ApiKey) -> str:
+    """
+    Non-secret identity of the API key to show in snapshots and logs
+    """
+    return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+def _redact_owner(owner: LimitOwner) -> str:
+    """
+    (INNER VERSION) Limit owner name without API keys
+    """
+    if owner.startswith("organization:"):
+        return owner
+    return key_fingerprint(owner)
+
+def _seconds_until(reset_time: Union[datetime, None], current_time: datetime) \
+    -> Union[float, None]:
+    """
+    (INNER VERSION) Seconds until the reset time (0 if it passed)
+    """
+    if reset_time is None:
+        return None
+    return max((reset_time - current_time).total_seconds(), 0.0)
+
+def _owner_rtt(owner: LimitOwner) -> Union[float, None]:
+    """
+    (INNER VERSION) Smoothed RTT of the key, or the mean of its keys for an organization
+    (RTT is measured per key)
+    """
+    rtts = [
+        smoothed_rtt
+        for api_key, (smoothed_rtt, _) in _RTT_ESTIMATES.items()
+        if _limit_owner(api_key) == owner
+    ]
+    if not rtts:
+        return None
+    return sum(rtts) / len(rtts)
+
+def _limit_snapshot(model_name: ModelName, owner: LimitOwner, current_time: datetime,
+                    waiters: int, in_flight_tokens: List[int]) -> LimitSnapshot:
+    """
+    (INNER VERSION) Snapshot of the key (organization) limits, as they are seen by requests
+    (passed reset times are applied, but the store is not changed)
+    """
+    snapshot = LimitSnapshot(
+        model_name=model_name,
+        owner=_redact_owner(owner),
+        waiters=waiters,
+        in_flight=len(in_flight_tokens),
+        in_flight_tokens=sum(in_flight_tokens),
+    )
+    snapshot.rtt = _owner_rtt(owner)
+    limit_info = _LIMIT_INFO_STORE.get(model_name, {}).get(owner)
+    if limit_info is None:
+        return snapshot
+    snapshot.rpm_total = limit_info.rpm_total
+    snapshot.tpm_total = limit_info.tpm_total
+    snapshot.rpm_reset_in = _seconds_until(limit_info.rpm_reset_time, current_time)
+    snapshot.tpm_reset_in = _seconds_until(limit_info.tpm_reset_time, current_time)
+    snapshot.rpm_remain = limit_info.rpm_total - limit_info.rpm_ahead \
+        if snapshot.rpm_reset_in == 0.0 else limit_info.rpm_remain
+    snapshot.tpm_remain = limit_info.tpm_total - limit_info.tpm_ahead \
+        if snapshot.tpm_reset_in == 0.0 else limit_info.tpm_remain
+    snapshot.daily_reset_in = _seconds_until(limit_info.daily_reset_time, current_time)
+    daily_reset = snapshot.daily_reset_in == 0.0
+    snapshot.rpd_remain = limit_info.rpd_total if daily_reset else limit_info.rpd_remain
+    snapshot.tpd_remain = limit_info.tpd_total if daily_reset else limit_info.tpd_remain
+    return snapshot
+
+def snapshot_limits() -> List[LimitSnapshot]:
+    """
+    Consistent snapshot of the whole limit store: limits of every known key (organization)
+    per model, requests waiting for them and running requests with reserved budget.
+    API keys are redacted to fingerprints (see `key_fingerprint`)
+    """
+    with _SYNC_LIMIT_INFO_LOCK:
+        current_time = datetime.now()
+        in_flight: Dict[Tuple[ModelName, LimitOwner], List[int]] = {}
+        for reservation in list(_IN_FLIGHT_RESERVATIONS):
+            owner = (resolve_model_name(reservation.model_name),
+                     _limit_owner(reservation.api_key))
+            in_flight.setdefault(owner, []).append(reservation.token_count)
+        owners = set(in_flight) | set(_LIMIT_WAITERS) | {
+            (model_name, owner)
+            for model_name, model_limits in _LIMIT_INFO_STORE.items()
+            for owner in model_limits
+        }
+        return [
+            _limit_snapshot(model_name, owner, current_time,
+                            _LIMIT_WAITERS.get((model_name, owner), 0),
+                            in_flight.get((model_name, owner), []))
+            for model_name, owner in sorted(owners)
+        ]
+
+async def asnapshot_limits() -> List[LimitSnapshot]:
+    """
+    Async version of `snapshot_limits`
+    """
+    async with _ASYNC_LIMIT_INFO_LOCK:
+        return snapshot_limits()
+
 def reset_limit_info() -> None:
     """
-    Reset collected limit info for testing purpose
+    Reset collected limit info (and model groups) for testing purpose
     """
     _LIMIT_INFO_STORE.clear()
+    _CONFIGURED_MODEL_GROUPS.clear()
+    _LEARNED_MODEL_ALIASES.clear()
+    _UNRESOLVED_MODEL_NAMES.clear()
+    _API_KEY_ORGANIZATIONS.clear()
+    _DAILY_LIMIT_CONFIGS.clear()
+    _RTT_ESTIMATES.clear()
+    _LIMIT_WAITERS.clear()
+    _IN_FLIGHT_RESERVATIONS.clear()
+    reset_tenant_quotas()
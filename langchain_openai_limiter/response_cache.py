@@ -0,0 +1,150 @@
+"""
+Module for exact-match chat response caching.
+
+Repeated deterministic prompts (classification, extraction at temperature 0)
+are served from the cache, so they do not wait for limits and do not spend them.
+There is an in-memory LRU tier and an optional SQLite disk tier.
+"""
+import copy
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Union
+from langchain.schema.messages import messages_from_dict, messages_to_dict
+from langchain.schema.output import ChatGeneration, ChatResult
+from .token_counter import LRUCache
+
+
+_RESPONSE_CACHE_SIZE = 1024
+
+
+def _result_to_dict(result: ChatResult) -> Dict[str, Any]:
+    """
+    Convert chat result to JSON-serializable dictionary
+    """
+    return {
+        "generations": [
+            {
+                "message": messages_to_dict([generation.message])[0],
+                "generation_info": generation.generation_info,
+            }
+            for generation in result.generations
+        ],
+        "llm_output": result.llm_output,
+    }
+
+
+def _result_from_dict(data: Dict[str, Any]) -> ChatResult:
+    """
+    Convert dictionary made by `_result_to_dict` back to chat result
+    """
+    return ChatResult(
+        generations=[
+            ChatGeneration(
+                message=messages_from_dict([generation["message"]])[0],
+                generation_info=generation["generation_info"],
+            )
+            for generation in data["generations"]
+        ],
+        llm_output=data["llm_output"],
+    )
+
+
+class ResponseCache:
+    """
+    Chat response cache with TTL and LRU eviction, and an optional SQLite disk tier.
+    The instance is shared (not copied) when wrappers are deep-copied
+    (like ChooseKeyChatOpenAI does).
+    """
+    def __init__(self, maxsize: int = _RESPONSE_CACHE_SIZE,
+                 ttl: Union[float, None] = None,
+                 path: Union[str, None] = None):
+        """
+        :param maxsize: How many responses to keep in memory
+        :param ttl: Response time-to-live in seconds (None - never expire)
+        :param path: SQLite database file for the disk tier (None - memory only)
+        """
+        self.ttl = ttl
+        self._memory = LRUCache(maxsize)
+        self._connection: Union[sqlite3.Connection, None] = None
+        self._connection_lock = threading.Lock()
+        if path is not None:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            with self._connection_lock, self._connection:
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS responses "
+                    "(key TEXT PRIMARY KEY, expires_at REAL, value TEXT)"
+                )
+
+    def __deepcopy__(self, memo: dict) -> "ResponseCache":
+        return self
+
+    def _expires_at(self) -> Union[float, None]:
+        """
+        Expiration time of the response cached now
+        """
+        if self.ttl is None:
+            return None
+        return time.time() + self.ttl
+
+    @staticmethod
+    def _expired(expires_at: Union[float, None]) -> bool:
+        """
+        Check if the cached response expired
+        """
+        return expires_at is not None and expires_at < time.time()
+
+    def _disk_get(self, key: str) -> Union[ChatResult, None]:
+        """
+        Read response from the disk tier (and put it to the memory tier)
+        """
+        with self._connection_lock:
+            row = self._connection.execute(
+                "SELECT expires_at, value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        expires_at, value = row
+        if self._expired(expires_at):
+            return None
+        result = _result_from_dict(json.loads(value))
+        self._memory.set(key, (expires_at, result))
+        return result
+
+    def get(self, key: str) -> Union[ChatResult, None]:
+        """
+        Get cached response (copy) or None if it is missing or expired
+        """
+        cached = self._memory.get(key)
+        if cached is not None:
+            expires_at, result = cached
+            if not self._expired(expires_at):
+                return copy.deepcopy(result)
+        if self._connection is None:
+            return None
+        result = self._disk_get(key)
+        return copy.deepcopy(result) if result is not None else None
+
+    def set(self, key: str, result: ChatResult) -> None:
+        """
+        Put response to the cache
+        """
+        expires_at = self._expires_at()
+        self._memory.set(key, (expires_at, copy.deepcopy(result)))
+        if self._connection is not None:
+            value = json.dumps(_result_to_dict(result), default=str)
+            with self._connection_lock, self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, expires_at, value) VALUES (?, ?, ?)",
+                    (key, expires_at, value),
+                )
+
+    def clear(self) -> None:
+        """
+        Drop all cached responses
+        """
+        self._memory.clear()
+        if self._connection is not None:
+            with self._connection_lock, self._connection:
+                self._connection.execute("DELETE FROM responses")
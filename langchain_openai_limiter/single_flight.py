@@ -0,0 +1,86 @@
+"""
+Module for coalescing identical in-flight requests (single-flight).
+
+When identical requests run at the same moment only the first one ("leader")
+reserves limits and calls OpenAI, while others wait for its result.
+"""
+import asyncio
+import copy
+import hashlib
+import json
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple, TypeVar, Union
+
+
+T = TypeVar("T")
+
+
+class _Call:
+    """
+    In-flight synchronyous call
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Union[BaseException, None] = None
+
+
+_SYNC_CALLS: Dict[Hashable, _Call] = {}
+_ASYNC_CALLS: Dict[Tuple[int, Hashable], asyncio.Future] = {}
+_SINGLE_FLIGHT_LOCK = threading.Lock()
+
+
+def request_key(*parts: Any) -> str:
+    """
+    Build request identity hash from JSON-serializable (or stringifiable) parts
+    """
+    serialized = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def single_flight(key: Hashable, func: Callable[[], T]) -> T:
+    """
+    Run `func` unless an identical call (with the same `key`) is already running -
+    in such case wait for it and return (a copy of) its result
+    """
+    with _SINGLE_FLIGHT_LOCK:
+        call = _SYNC_CALLS.get(key)
+        leader = call is None
+        if leader:
+            call = _Call()
+            _SYNC_CALLS[key] = call
+    if not leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return copy.deepcopy(call.result)
+    try:
+        call.result = func()
+        return call.result
+    except BaseException as error:
+        call.error = error
+        raise
+    finally:
+        with _SINGLE_FLIGHT_LOCK:
+            del _SYNC_CALLS[key]
+        call.done.set()
+
+
+async def asingle_flight(key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+    """
+    Async version of `single_flight`.
+    The shared call runs as a separate task, so cancellation of one of the waiting
+    callers does not cancel it for the others.
+    """
+    loop_key = (id(asyncio.get_running_loop()), key)
+    with _SINGLE_FLIGHT_LOCK:
+        task = _ASYNC_CALLS.get(loop_key)
+        leader = task is None
+        if leader:
+            task = asyncio.ensure_future(func())
+            _ASYNC_CALLS[loop_key] = task
+            task.add_done_callback(lambda _: _ASYNC_CALLS.pop(loop_key, None))
+    result = await asyncio.shield(task)
+    if leader:
+        return result
+    return copy.deepcopy(result)
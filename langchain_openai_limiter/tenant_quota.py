@@ -0,0 +1,114 @@
+"""
+Module for hierarchical per-tenant sub-quotas.
+
+Many tenants (like internal teams) may share one key pool. Every tenant gets a guaranteed
+share of key (organization) TPM, and may borrow idle capacity up to its max share,
+as long as it does not take unused guarantees of other tenants.
+So one tenant's bulk job does not starve others, while idle budget is still used.
+
+Functions here are not thread-safe: they are called under the limit store lock.
+"""
+from collections import deque
+from dataclasses import dataclass
+import time
+from typing import Deque, Dict, List, Tuple, Union
+
+
+Tenant = Union[str, None] # None - requests without tenant
+# Call kwarg of chat wrappers to pass the request tenant
+TENANT_KWARG = "tenant"
+# Tenant usage is tracked in the same window as TPM limits
+_TENANT_USAGE_WINDOW = 60.0
+
+
+@dataclass
+class TenantQuota:
+    """
+    Tenant share of key (organization) TPM limit
+    """
+    min_share: float = 0.0 # Guaranteed share
+    max_share: float = 1.0 # Max share (including borrowed idle capacity)
+
+
+_TENANT_QUOTAS: Dict[Tenant, TenantQuota] = {}
+# (model, limit owner) -> tenant -> [time, token count] entries in the usage window
+_TENANT_USAGE: Dict[Tuple[str, str], Dict[Tenant, Deque[List[float]]]] = {}
+
+
+def store_tenant_quota(tenant: Tenant, min_share: float, max_share: float = 1.0) -> None:
+    """
+    Configure tenant share of every key (organization) TPM limit
+    (use `limit_info.set_tenant_quota`, which takes the limit store lock)
+    """
+    assert 0.0 <= min_share <= max_share <= 1.0, "Should have 0 <= min_share <= max_share <= 1"
+    _TENANT_QUOTAS[tenant] = TenantQuota(min_share, max_share)
+
+
+def _tenant_usage(usage: Deque[List[float]], current_time: float) -> float:
+    """
+    Tokens spent by the tenant in the usage window
+    """
+    while usage and usage[0][0] < current_time - _TENANT_USAGE_WINDOW:
+        usage.popleft()
+    return sum(token_count for _, token_count in usage)
+
+
+def tenant_fits(model_name: str, owner: str, tenant: Tenant, token_count: int,
+                tpm_total: int, tpm_remain: int) -> bool:
+    """
+    Check if the tenant may take `token_count` tokens of key (organization) TPM budget:
+    within its guaranteed share, or borrowing idle capacity up to its max share
+    """
+    if not _TENANT_QUOTAS:
+        return True
+    current_time = time.monotonic()
+    usages = _TENANT_USAGE.get((model_name, owner), {})
+    used = _tenant_usage(usages.get(tenant, deque()), current_time)
+    quota = _TENANT_QUOTAS.get(tenant, TenantQuota())
+    if used + token_count > quota.max_share * tpm_total:
+        return False
+    if used + token_count <= quota.min_share * tpm_total:
+        return True
+    unused_guarantees = sum(
+        max(other_quota.min_share * tpm_total
+            - _tenant_usage(usages.get(other, deque()), current_time), 0.0)
+        for other, other_quota in _TENANT_QUOTAS.items()
+        if other != tenant
+    )
+    return tpm_remain - token_count >= unused_guarantees
+
+
+def record_tenant_usage(model_name: str, owner: str, tenant: Tenant,
+                        token_count: int) -> Union[List[float], None]:
+    """
+    Account tokens taken by the tenant
+    :return: Usage entry to refund (None - tenants are not configured)
+    """
+    if not _TENANT_QUOTAS:
+        return None
+    current_time = time.monotonic()
+    usage = _TENANT_USAGE.setdefault((model_name, owner), {}).setdefault(tenant, deque())
+    _tenant_usage(usage, current_time)
+    entry = [current_time, token_count]
+    usage.append(entry)
+    return entry
+
+
+def refund_tenant_usage(model_name: str, owner: str, tenant: Tenant,
+                        entry: List[float]) -> None:
+    """
+    Give tokens taken by the tenant back
+    """
+    usage = _TENANT_USAGE.get((model_name, owner), {}).get(tenant, deque())
+    for i, other in enumerate(usage):
+        if other is entry:
+            del usage[i]
+            return
+
+
+def reset_tenant_quotas() -> None:
+    """
+    Forget tenant quotas and usage
+    """
+    _TENANT_QUOTAS.clear()
+    _TENANT_USAGE.clear()
@@ -0,0 +1,289 @@
+"""
+Module for token counting with per-message memoization.
+
+Chat histories mostly consist of the same system prompt and earlier turns,
+so we cache token counts of individual messages and only tokenize new ones.
+Async helpers move large tokenization jobs to a thread pool (tiktoken releases the GIL),
+so they won't block the event loop.
+"""
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import Executor
+import functools
+import hashlib
+import json
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Hashable, List, Tuple, TypeVar, Union
+from langchain.adapters.openai import convert_message_to_dict
+from langchain.schema.messages import BaseMessage
+
+if TYPE_CHECKING:
+    import tiktoken
+
+
+T = TypeVar("T")
+
+_MESSAGE_TOKEN_CACHE_SIZE = 4096
+# Inputs shorter than this (in characters) are tokenized right inside the event loop
+_TOKENIZE_INLINE_THRESHOLD = 16384
+# Upper bounds of OpenAI chat format overhead: tokens per message (+ per name)
+# and reply priming tokens
+_MESSAGE_OVERHEAD_BOUND = 4 + 1
+_REPLY_OVERHEAD_BOUND = 3
+
+
+class LRUCache:
+    """
+    Thread-safe size-bounded least-recently-used cache
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Union[Any, None]:
+        """
+        Get cached value (or None if it is missing) and mark it as recently used
+        """
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Put value to the cache, evicting least recently used values if needed
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def resize(self, maxsize: int) -> None:
+        """
+        Change cache size, evicting least recently used values if needed
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        Drop all cached values
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+# Cache of (encoding model, message hash) -> message token count
+_MESSAGE_TOKEN_CACHE = LRUCache(_MESSAGE_TOKEN_CACHE_SIZE)
+# Async tokenization settings. `None` executor means the event loop default one
+_TOKENIZE_EXECUTOR: Union[Executor, None] = None
+_TOKENIZE_INLINE_THRESHOLD_CURRENT = _TOKENIZE_INLINE_THRESHOLD
+
+
+def _encoding_model_name(chat_model: Any) -> str:
+    """
+    Get model name which defines tokenization rules of the chat model
+    """
+    tiktoken_model_name = getattr(chat_model, "tiktoken_model_name", None)
+    if tiktoken_model_name is not None:
+        return tiktoken_model_name
+    return chat_model.model_name
+
+
+def _message_hash(message: BaseMessage) -> str:
+    """
+    Calculate stable content hash of the message
+    """
+    serialized = json.dumps(message.dict(), sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+def _cached_count(chat_model: Any, key: Hashable, messages: List[BaseMessage]) -> int:
+    """
+    Get token count of `messages` from cache or calculate it via chat model
+    """
+    count = _MESSAGE_TOKEN_CACHE.get(key)
+    if count is None:
+        count = chat_model.get_num_tokens_from_messages(messages)
+        _MESSAGE_TOKEN_CACHE.set(key, count)
+    return count
+
+
+def _message_keys(chat_model: Any, messages: List[BaseMessage]) \
+    -> Tuple[Hashable, List[Hashable]]:
+    """
+    Build cache keys for the reply priming overhead and for every message
+    """
+    encoding_model = _encoding_model_name(chat_model)
+    overhead_key = (encoding_model, None)
+    message_keys = [
+        (encoding_model, _message_hash(message))
+        for message in messages
+    ]
+    return overhead_key, message_keys
+
+
+def _count_with_keys(chat_model: Any, messages: List[BaseMessage],
+                     overhead_key: Hashable, message_keys: List[Hashable]) -> int:
+    """
+    (INNER VERSION) Count tokens in messages using precalculated cache keys
+    """
+    overhead = _cached_count(chat_model, overhead_key, [])
+    result = overhead
+    for message, key in zip(messages, message_keys):
+        result += _cached_count(chat_model, key, [message]) - overhead
+    return result
+
+
+def num_tokens_from_messages(chat_model: Any, messages: List[BaseMessage]) -> int:
+    """
+    Count tokens in messages as `chat_model.get_num_tokens_from_messages` does,
+    but tokenize only messages which were not seen before.
+
+    OpenAI message token count is additive: a constant reply priming overhead
+    plus a sum of per-message counts. So we cache the overhead (the count of an empty
+    history) and every `count([message]) - overhead` separately.
+    :param chat_model: Model with `model_name` and `get_num_tokens_from_messages`, like ChatOpenAI
+    :param messages: Chat history
+    :return: Token count
+    """
+    overhead_key, message_keys = _message_keys(chat_model, messages)
+    return _count_with_keys(chat_model, messages, overhead_key, message_keys)
+
+
+async def _run_tokenization(size: int, func: Callable[..., T], *args: Any) -> T:
+    """
+    Run tokenization function inline for small inputs or inside the executor for large ones
+    """
+    if size < _TOKENIZE_INLINE_THRESHOLD_CURRENT:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_TOKENIZE_EXECUTOR, functools.partial(func, *args))
+
+
+async def anum_tokens_from_messages(chat_model: Any, messages: List[BaseMessage]) -> int:
+    """
+    Async version of `num_tokens_from_messages`, which does not block the event loop
+    if there are too much uncached text to tokenize
+    """
+    overhead_key, message_keys = _message_keys(chat_model, messages)
+    uncached_size = sum(
+        len(str(message.content))
+        for message, key in zip(messages, message_keys)
+        if _MESSAGE_TOKEN_CACHE.get(key) is None
+    )
+    return await _run_tokenization(uncached_size, _count_with_keys,
+                                   chat_model, messages, overhead_key, message_keys)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> "tiktoken.Encoding":
+    """
+    Get (cached) tiktoken encoding for the model (tiktoken is imported on first use)
+    """
+    # pylint: disable=import-outside-toplevel
+    import tiktoken
+    # pylint: enable=import-outside-toplevel
+    return tiktoken.encoding_for_model(model_name)
+
+
+def num_tokens_per_text(model_name: str, texts: List[str]) -> List[int]:
+    """
+    Count tokens in every text (like embedding inputs)
+    """
+    return [len(row) for row in get_encoding(model_name).encode_batch(texts)]
+
+
+async def anum_tokens_per_text(model_name: str, texts: List[str]) -> List[int]:
+    """
+    Async version of `num_tokens_per_text`, which does not block the event loop
+    on large inputs
+    """
+    size = sum(len(text) for text in texts)
+    return await _run_tokenization(size, num_tokens_per_text, model_name, texts)
+
+
+def num_tokens_from_texts(model_name: str, texts: List[str]) -> int:
+    """
+    Count tokens in texts (like embedding inputs)
+    """
+    return sum(num_tokens_per_text(model_name, texts))
+
+
+async def anum_tokens_from_texts(model_name: str, texts: List[str]) -> int:
+    """
+    Async version of `num_tokens_from_texts`, which does not block the event loop
+    on large inputs
+    """
+    size = sum(len(text) for text in texts)
+    return await _run_tokenization(size, num_tokens_from_texts, model_name, texts)
+
+
+def estimate_num_tokens_per_text(texts: List[str]) -> List[int]:
+    """
+    Cheap upper bound of token count in every text.
+
+    Every tiktoken BPE token encodes at least one byte, so UTF-8 length
+    of a text is never less than its token count.
+    """
+    return [len(text.encode("utf-8")) for text in texts]
+
+
+def estimate_num_tokens_from_texts(texts: List[str]) -> int:
+    """
+    Cheap upper bound of token count in texts (see `estimate_num_tokens_per_text`)
+    """
+    return sum(estimate_num_tokens_per_text(texts))
+
+
+def estimate_num_tokens_from_messages(messages: List[BaseMessage]) -> int:
+    """
+    Cheap upper bound of token count in messages (see `estimate_num_tokens_from_texts`)
+    """
+    result = _REPLY_OVERHEAD_BOUND
+    for message in messages:
+        result += _MESSAGE_OVERHEAD_BOUND
+        result += estimate_num_tokens_from_texts([
+            str(value)
+            for value in convert_message_to_dict(message).values()
+        ])
+    return result
+
+
+def configure_token_counter(cache_size: int = _MESSAGE_TOKEN_CACHE_SIZE) -> None:
+    """
+    Configure token counting
+    :param cache_size: How many per-message token counts to keep
+    """
+    _MESSAGE_TOKEN_CACHE.resize(cache_size)
+
+
+def configure_async_tokenization(executor: Union[Executor, None] = None,
+                                 inline_threshold: int = _TOKENIZE_INLINE_THRESHOLD) -> None:
+    """
+    Configure how async code paths tokenize inputs
+    :param executor: Thread pool to tokenize large inputs in (`None` - event loop default one)
+    :param inline_threshold: Inputs shorter than that (in characters) are tokenized
+      inside the event loop, since thread hop costs more than tokenizing them
+    """
+    # pylint: disable=global-statement
+    global _TOKENIZE_EXECUTOR, _TOKENIZE_INLINE_THRESHOLD_CURRENT
+    # pylint: enable=global-statement
+    _TOKENIZE_EXECUTOR = executor
+    _TOKENIZE_INLINE_THRESHOLD_CURRENT = inline_threshold
+
+
+def reset_token_counter() -> None:
+    """
+    Reset cached token counts for testing purpose
+    """
+    _MESSAGE_TOKEN_CACHE.clear()
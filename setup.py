@@ -15,6 +15,7 @@ INSTALL_REQUIRES = [
     "requests>=2.31.0",
     "langchain>=0.0.329",
     "tiktoken>=0.5.1",
+    "numpy>=1.26.1",
 ]
 DEV_REQUIRES = [
     "pytest>=7.4.1",
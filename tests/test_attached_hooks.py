@@ -1,9 +1,15 @@
+from datetime import timedelta
+import json
 import os
 from .utils import load_env
 import pytest
+import threading
 import time
+import openai.api_requestor
+import requests
+from langchain_openai_limiter import capture_headers
 from langchain_openai_limiter.limit_info import get_limit_info, reset_limit_info
-from langchain_openai_limiter.capture_headers import attach_session_hooks
+from langchain_openai_limiter.capture_headers import attach_session_hooks, _response_hook
 from langchain.chat_models import ChatOpenAI
 from langchain.schema import SystemMessage, HumanMessage
 
@@ -51,3 +57,87 @@ async def test_attach_async_session_hooks(load_env):
     await chat_model.ainvoke(history)
     limit_info = get_limit_info("gpt-4-0613", api_key)
     assert limit_info is not None
+
+
+LIMIT_HEADERS = {
+    "x-ratelimit-limit-requests": "100",
+    "x-ratelimit-limit-tokens": "1000",
+    "x-ratelimit-remaining-requests": "99",
+    "x-ratelimit-remaining-tokens": "900",
+    "x-ratelimit-reset-requests": "600ms",
+    "x-ratelimit-reset-tokens": "6s",
+}
+
+
+def _fake_response(request: requests.Request, headers: dict) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response.request = request.prepare()
+    response.headers.update(headers)
+    response.elapsed = timedelta(milliseconds=100)
+    return response
+
+
+def test_response_hook_skips_file_uploads():
+    reset_limit_info()
+    upload = requests.Request(
+        "POST", "https://api.openai.com/v1/files",
+        headers={"Authorization": "Bearer sk-fake"},
+        files={"file": ("batch.jsonl", b'{"custom_id": "0"}\n')},
+        data={"purpose": "batch"},
+    )
+    _response_hook(_fake_response(upload, {"openai-organization": "org"}))
+    # Multipart body does not break the hook even with limit headers
+    _response_hook(_fake_response(upload, LIMIT_HEADERS))
+    # Wrappers look up limits before the request, so the hook learns the alias
+    assert get_limit_info("gpt-4", "sk-fake") is None
+    _response_hook(_fake_response(_completion_request(),
+                                  dict(LIMIT_HEADERS, **{"openai-model": "gpt-4-0613"})))
+    limit_info = get_limit_info("gpt-4", "sk-fake")
+    assert (limit_info.rpm_remain, limit_info.tpm_remain) == (99, 900)
+
+
+def _completion_request() -> requests.Request:
+    return requests.Request(
+        "POST", "https://api.openai.com/v1/chat/completions",
+        headers={"Authorization": "Bearer sk-fake", "Content-Type": "application/json"},
+        data=json.dumps({"model": "gpt-4", "messages": []}),
+    )
+
+
+def test_response_hook_parses_body_only_when_needed(monkeypatch):
+    reset_limit_info()
+    parsed = []
+    loads = json.loads
+    monkeypatch.setattr(json, "loads", lambda body: parsed.append(body) or loads(body))
+    response = _fake_response(_completion_request(),
+                              dict(LIMIT_HEADERS, **{"openai-model": "gpt-4-0613"}))
+    _response_hook(response)
+    assert parsed == [] # Served model header is enough
+    assert get_limit_info("gpt-4-0613", "sk-fake").rpm_remain == 99
+    _response_hook(_fake_response(_completion_request(), LIMIT_HEADERS))
+    assert len(parsed) == 1 # No served model header
+
+
+def test_concurrent_attach_wraps_requests_once(monkeypatch):
+    response = _fake_response(_completion_request(), LIMIT_HEADERS)
+    # Stands for a request via any session, including ones openai cached per thread
+    monkeypatch.setattr(openai.api_requestor.APIRequestor, "request_raw",
+                        lambda self, *args, **kwargs: response)
+    monkeypatch.setattr(capture_headers, "_ATTACHED_SYNC_SESSION_HOOKS", False)
+    hooked = []
+    monkeypatch.setattr(capture_headers, "_response_hook", hooked.append)
+    barrier = threading.Barrier(8)
+
+    def attach():
+        barrier.wait()
+        capture_headers._attach_sync_session_hooks()
+
+    threads = [threading.Thread(target=attach) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    requestor = openai.api_requestor.APIRequestor(key="sk-fake")
+    assert requestor.request_raw("post", "/chat/completions") is response
+    assert hooked == [response]
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import os
+import time
+import pytest
+from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.schema import HumanMessage
+from langchain_openai_limiter import LimitAwaitChatOpenAI, LimitAwaitOpenAIEmbeddings, \
+    BatchOffload, BatchUploader
+from langchain_openai_limiter.limit_info import get_limit_info, reset_limit_info
+from .utils import FakeChatOpenAI
+
+
+MODEL_NAME = "gpt-4-0613"
+API_KEY = "sk-fake"
+
+
+class LocalBatchUploader(BatchUploader):
+    """
+    Stand-in which "runs" jobs right away: chat requests echo the last message,
+    embedding requests return [text length, 0] vectors
+    """
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.files = []
+
+    def submit(self, path, endpoint):
+        with open(path, "r", encoding="utf-8") as src:
+            requests = [json.loads(row) for row in src]
+        self.files.append(requests)
+        output_path = path + ".output"
+        with open(output_path, "w", encoding="utf-8") as dst:
+            for request in reversed(requests): # Results may come in any order
+                if request["url"] == "/v1/chat/completions":
+                    body = {"choices": [{
+                        "message": {"role": "assistant",
+                                    "content": request["body"]["messages"][-1]["content"]},
+                        "finish_reason": "stop",
+                    }]}
+                else:
+                    body = {"data": [
+                        {"index": i, "embedding": [float(len(text)), 0.0]}
+                        for i, text in enumerate(request["body"]["input"])
+                    ]}
+                dst.write(json.dumps({
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": body},
+                    "error": None,
+                }) + "\n")
+        return output_path
+
+    def result(self, job_id):
+        if self.fail:
+            raise RuntimeError("Batch job failed")
+        return job_id
+
+
+class SlowBatchUploader(LocalBatchUploader):
+    """
+    Stand-in which takes a while to upload files
+    """
+    def submit(self, path, endpoint):
+        time.sleep(0.2)
+        return super().submit(path, endpoint)
+
+
+def _offload(tmp_path, uploader: BatchUploader) -> BatchOffload:
+    return BatchOffload(uploader, directory=str(tmp_path), flush_delay=0.05,
+                        poll_interval=0.01)
+
+
+@pytest.mark.asyncio
+async def test_chat_requests_are_offloaded_in_one_batch_file(tmp_path):
+    reset_limit_info()
+    uploader = LocalBatchUploader()
+    chat_model = LimitAwaitChatOpenAI(
+        chat_openai=FakeChatOpenAI(model_name=MODEL_NAME, openai_api_key=API_KEY),
+        batch_offload=_offload(tmp_path, uploader),
+    )
+    FakeChatOpenAI.calls.clear()
+    results = await chat_model.abatch([[HumanMessage(content=f"Question {i}")]
+                                       for i in range(3)])
+    assert [result.content for result in results] == [f"Question {i}" for i in range(3)]
+    assert len(uploader.files) == 1
+    assert uploader.files[0][0]["body"]["model"] == MODEL_NAME
+    assert FakeChatOpenAI.calls == [] # No live requests
+    assert get_limit_info(MODEL_NAME, API_KEY) is None
+    assert chat_model.invoke([HumanMessage(content="Sync question")]).content == "Sync question"
+
+
+def test_embeddings_are_offloaded(tmp_path):
+    uploader = LocalBatchUploader()
+    embeddings = LimitAwaitOpenAIEmbeddings(
+        OpenAIEmbeddings(openai_api_key=API_KEY),
+        batch_offload=_offload(tmp_path, uploader),
+        numpy_dtype="float32",
+    )
+    vectors = embeddings.embed_documents(["a", "bb", "a"])
+    assert vectors.tolist() == [[1.0, 0.0], [2.0, 0.0], [1.0, 0.0]]
+    assert [request["body"]["input"] for request in uploader.files[0]] == [["a", "bb"]]
+
+
+def test_failed_job_fails_requests(tmp_path):
+    embeddings = LimitAwaitOpenAIEmbeddings(
+        OpenAIEmbeddings(openai_api_key=API_KEY),
+        batch_offload=_offload(tmp_path, LocalBatchUploader(fail=True)),
+    )
+    with pytest.raises(RuntimeError):
+        embeddings.embed_documents(["a"])
+    assert os.listdir(tmp_path)
+
+
+def test_uploader_interface_is_abstract():
+    with pytest.raises(TypeError):
+        BatchUploader()
+
+
+def test_batch_files_are_kept_per_endpoint(tmp_path):
+    uploader = LocalBatchUploader()
+    offload = _offload(tmp_path, uploader)
+    chat_body = {"model": MODEL_NAME, "messages": [{"role": "user", "content": "hi"}]}
+    futures = [
+        offload.submit("/v1/chat/completions", chat_body),
+        offload.submit("/v1/embeddings", {"model": "text-embedding-ada-002", "input": ["a"]}),
+        offload.submit("/v1/chat/completions", chat_body),
+    ]
+    for future in futures:
+        future.result(timeout=5)
+    assert sorted(len(requests) for requests in uploader.files) == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_async_upload_does_not_block_event_loop(tmp_path):
+    uploader = SlowBatchUploader()
+    offload = BatchOffload(uploader, directory=str(tmp_path), max_requests=1,
+                           poll_interval=0.01)
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticker = asyncio.create_task(tick())
+    body = {"model": "text-embedding-ada-002", "input": ["abc"]}
+    result = await offload.asubmit("/v1/embeddings", body)
+    ticker.cancel()
+    assert result["data"][0]["embedding"] == [3.0, 0.0]
+    assert ticks >= 5
+
+
+def test_sync_batch_puts_all_inputs_in_one_file(tmp_path):
+    reset_limit_info()
+    uploader = LocalBatchUploader()
+    chat_model = LimitAwaitChatOpenAI(
+        chat_openai=FakeChatOpenAI(model_name=MODEL_NAME, openai_api_key=API_KEY),
+        batch_offload=_offload(tmp_path, uploader),
+    )
+    questions = [f"Question {i}" for i in range(50)]
+    results = chat_model.batch(questions, {"max_concurrency": 4})
+    assert [result.content for result in results] == questions
+    assert len(uploader.files) == 1
+    assert len(uploader.files[0]) == 50
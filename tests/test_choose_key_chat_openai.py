@@ -2,7 +2,7 @@ from langchain_openai_limiter.limit_await_chat_openai import LimitAwaitChatOpenA
 from langchain_openai_limiter.choose_key_chat_openai import ChooseKeyChatOpenAI
 from langchain_openai_limiter.limit_info import reset_limit_info
 from langchain_openai_limiter.capture_headers import attach_session_hooks
-from .utils import load_env
+from .utils import load_env, FakeChatOpenAI
 from langchain_openai_limiter.limit_info import get_limit_info
 import os
 import pytest
@@ -156,4 +156,37 @@ async def test_choose_key_chat_openai_astream_async(load_env):
         _iter(chat_model, history),
     )
     for key in api_keys:
-        assert get_limit_info("gpt-4-0613", key) is not None
\ No newline at end of file
+        assert get_limit_info("gpt-4-0613", key) is not None
+
+
+def test_choose_key_chat_openai_counts_tokens_once(monkeypatch):
+    reset_limit_info()
+    FakeChatOpenAI.calls.clear()
+    counted = []
+    original_count = LimitAwaitChatOpenAI.get_num_tokens_from_messages
+
+    def _count(self, messages):
+        counted.append(messages)
+        return original_count(self, messages)
+
+    monkeypatch.setattr(LimitAwaitChatOpenAI, "get_num_tokens_from_messages", _count)
+    chat_model = ChooseKeyChatOpenAI(
+        chat_openai=LimitAwaitChatOpenAI(
+            chat_openai=FakeChatOpenAI(
+                model_name="gpt-4-0613",
+                openai_api_key="sk-fake",
+            )
+        ),
+        openai_api_keys=["sk-fake0", "sk-fake1"],
+    )
+    history = [
+        SystemMessage(
+            content="You are a helpful assistant that translates English to French."
+        ),
+        HumanMessage(
+            content="Translate this sentence from English to French. I love programming."
+        ),
+    ]
+    chat_model.generate([history])
+    assert len(counted) == 1
+    assert FakeChatOpenAI.calls[-1]["kwargs"] == {}
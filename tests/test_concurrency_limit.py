@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+import openai
+import pytest
+from langchain_openai_limiter import LimitAwaitChatOpenAI
+from langchain_openai_limiter.concurrency_limit import AIMDSettings, concurrency_slot, \
+    get_concurrency_state, reset_concurrency_state
+from langchain_openai_limiter.limit_info import OrganizationLimitInfo, reset_limit_info, \
+    set_limit_info
+from .utils import FakeChatOpenAI
+
+
+MODEL_NAME = "gpt-4-0613"
+API_KEY = "sk-fake"
+
+
+def test_concurrency_window_grows_on_success():
+    reset_concurrency_state()
+    settings = AIMDSettings(initial_window=2.0, latency_tolerance=float("inf")) # No jitter spikes
+    for _ in range(4):
+        with concurrency_slot(MODEL_NAME, API_KEY, settings, 0.1, 0.01):
+            pass
+    state = get_concurrency_state(MODEL_NAME, API_KEY)
+    assert state.window > 2.0
+    assert state.in_flight == 0
+
+
+def test_concurrency_window_shrinks_on_rate_limit():
+    reset_concurrency_state()
+    settings = AIMDSettings(initial_window=8.0)
+    with pytest.raises(openai.error.RateLimitError):
+        with concurrency_slot(MODEL_NAME, API_KEY, settings, 0.1, 0.01):
+            raise openai.error.RateLimitError("Rate limit reached")
+    assert get_concurrency_state(MODEL_NAME, API_KEY).window == 4.0
+
+
+def test_concurrency_slot_waits_for_window():
+    reset_concurrency_state()
+    settings = AIMDSettings(initial_window=1.0)
+    with concurrency_slot(MODEL_NAME, API_KEY, settings, 0.1, 0.01):
+        with pytest.raises(TimeoutError):
+            with concurrency_slot(MODEL_NAME, API_KEY, settings, 0.05, 0.01):
+                pass
+    assert get_concurrency_state(MODEL_NAME, API_KEY).in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_limit_wait_is_not_counted_as_latency():
+    reset_concurrency_state()
+    reset_limit_info()
+    reset_time = datetime.now() + timedelta(seconds=0.2)
+    set_limit_info(MODEL_NAME, API_KEY, OrganizationLimitInfo(
+        tpm_total=1000,
+        tpm_remain=1000,
+        rpm_total=100,
+        rpm_remain=0,
+        rpm_reset_time=reset_time,
+        tpm_reset_time=reset_time,
+    ))
+    chat_model = LimitAwaitChatOpenAI(
+        chat_openai=FakeChatOpenAI(model_name=MODEL_NAME, openai_api_key=API_KEY),
+        limit_await_timeout=1.0,
+        limit_await_sleep=0.01,
+        concurrency_control=AIMDSettings(),
+    )
+    await chat_model.ainvoke("hello")
+    assert datetime.now() >= reset_time
+    assert get_concurrency_state(MODEL_NAME, API_KEY).latency < 0.1
@@ -0,0 +1,54 @@
+import pytest
+from langchain_openai_limiter import ChooseKeyOpenAIEmbeddings, LimitAwaitOpenAIEmbeddings
+from langchain_openai_limiter.limit_info import reset_limit_info
+from .utils import FakeOpenAIEmbeddings
+
+
+MODEL_NAME = "text-embedding-ada-002"
+
+
+def _embeddings() -> LimitAwaitOpenAIEmbeddings:
+    return LimitAwaitOpenAIEmbeddings(
+        openai_embeddings=FakeOpenAIEmbeddings(model=MODEL_NAME, openai_api_key="sk-fake",
+                                               chunk_size=4),
+        estimate_tokens=True,
+    )
+
+
+def test_embed_stream_consumes_input_lazily():
+    reset_limit_info()
+    FakeOpenAIEmbeddings.calls.clear()
+    read = []
+
+    def _texts():
+        for i in range(1000):
+            read.append(i)
+            yield "x" * (i % 7)
+
+    stream = _embeddings().embed_stream(_texts(), max_concurrency=2)
+    index, vector = next(stream)
+    assert vector == [float(index % 7), 0.0]
+    # Only the chunks admitted so far (and the next one) were read
+    assert len(read) <= 4 * 4
+    results = dict(stream)
+    results[index] = vector
+    assert sorted(results) == list(range(1000))
+    assert all(vector == [float(i % 7), 0.0] for i, vector in results.items())
+
+
+@pytest.mark.asyncio
+async def test_aembed_stream_async_iterable_across_keys():
+    reset_limit_info()
+    FakeOpenAIEmbeddings.calls.clear()
+
+    async def _texts():
+        for i in range(50):
+            yield f"document {i}"
+
+    embeddings = ChooseKeyOpenAIEmbeddings(
+        openai_embeddings=_embeddings(),
+        openai_api_keys=["sk-first", "sk-second"],
+    )
+    results = {index: vector async for index, vector in embeddings.aembed_stream(_texts())}
+    assert results == {i: [float(len(f"document {i}")), 0.0] for i in range(50)}
+    assert {call["api_key"] for call in FakeOpenAIEmbeddings.calls} == {"sk-first", "sk-second"}
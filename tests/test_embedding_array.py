@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from langchain_openai_limiter import embedding_array
+from langchain_openai_limiter import ChooseKeyOpenAIEmbeddings, EmbeddingCache, \
+    LimitAwaitOpenAIEmbeddings
+from langchain_openai_limiter.limit_info import reset_limit_info
+from .utils import FakeOpenAIEmbeddings
+
+
+MODEL_NAME = "text-embedding-ada-002"
+TEXTS = ["first", "second", "the third"]
+EXPECTED = [[5.0, 0.0], [6.0, 0.0], [9.0, 0.0]]
+
+
+def _embeddings(numpy_dtype=None, **kwargs) -> LimitAwaitOpenAIEmbeddings:
+    return LimitAwaitOpenAIEmbeddings(
+        openai_embeddings=FakeOpenAIEmbeddings(model=MODEL_NAME, openai_api_key="sk-fake",
+                                               chunk_size=2),
+        estimate_tokens=True,
+        numpy_dtype=numpy_dtype,
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_limit_await_embeddings_return_array(dtype):
+    reset_limit_info()
+    result = _embeddings(dtype).embed_documents(TEXTS)
+    assert isinstance(result, np.ndarray)
+    assert result.dtype == np.dtype(dtype)
+    assert result.flags["C_CONTIGUOUS"]
+    assert result.tolist() == EXPECTED
+
+
+@pytest.mark.asyncio
+async def test_choose_key_embeddings_return_array():
+    reset_limit_info()
+    embeddings = ChooseKeyOpenAIEmbeddings(
+        openai_embeddings=_embeddings(),
+        openai_api_keys=["sk-first", "sk-second"],
+        numpy_dtype="float32",
+    )
+    result = await embeddings.aembed_documents(TEXTS)
+    assert isinstance(result, np.ndarray)
+    assert result.dtype == np.float32
+    assert result.tolist() == EXPECTED
+
+
+def test_cached_embeddings_return_array(tmp_path):
+    reset_limit_info()
+    embeddings = _embeddings("float32", embedding_cache=EmbeddingCache(str(tmp_path)))
+    embeddings.embed_documents(TEXTS[:1])
+    result = embeddings.embed_documents(TEXTS)
+    assert isinstance(result, np.ndarray)
+    assert result.tolist() == EXPECTED
+
+
+def test_long_texts_are_told_by_exact_token_count(monkeypatch):
+    openai_embeddings = FakeOpenAIEmbeddings(model=MODEL_NAME, openai_api_key="sk-fake",
+                                             embedding_ctx_length=6)
+    tokenized = []
+
+    def _num_tokens_per_text(model_name, texts):
+        tokenized.extend(texts)
+        return [len(text.split()) for text in texts]
+
+    monkeypatch.setattr(embedding_array, "num_tokens_per_text", _num_tokens_per_text)
+    texts = ["short", "many bytes but few words", "one two three four five six seven"]
+    assert embedding_array._long_text_indices(openai_embeddings, texts) == [2]
+    assert tokenized == texts[1:] # Texts shorter than the context in bytes are not tokenized
@@ -0,0 +1,64 @@
+import os
+import pytest
+from langchain_openai_limiter import EmbeddingCache, LimitAwaitOpenAIEmbeddings
+from langchain_openai_limiter.limit_info import reset_limit_info
+from .utils import FakeOpenAIEmbeddings
+
+
+MODEL_NAME = "text-embedding-ada-002"
+
+
+def _embeddings(cache: EmbeddingCache) -> LimitAwaitOpenAIEmbeddings:
+    return LimitAwaitOpenAIEmbeddings(
+        openai_embeddings=FakeOpenAIEmbeddings(model=MODEL_NAME, openai_api_key="sk-fake"),
+        estimate_tokens=True,
+        embedding_cache=cache,
+    )
+
+
+def test_embedding_cache_embeds_only_missing_texts(tmp_path):
+    reset_limit_info()
+    FakeOpenAIEmbeddings.calls.clear()
+    embeddings = _embeddings(EmbeddingCache(str(tmp_path)))
+    assert embeddings.embed_documents(["first", "second"]) == [[5.0, 0.0], [6.0, 0.0]]
+    assert embeddings.embed_documents(["second", "the third", "first"]) == \
+        [[6.0, 0.0], [9.0, 0.0], [5.0, 0.0]]
+    assert [call["texts"] for call in FakeOpenAIEmbeddings.calls] == \
+        [["first", "second"], ["the third"]]
+
+
+def test_embedding_cache_persists(tmp_path):
+    reset_limit_info()
+    FakeOpenAIEmbeddings.calls.clear()
+    _embeddings(EmbeddingCache(str(tmp_path))).embed_documents(["first", "second"])
+    cache = EmbeddingCache(str(tmp_path))
+    vectors = cache.get(MODEL_NAME, ["second", "unknown"])
+    assert vectors[0].tolist() == [6.0, 0.0]
+    assert vectors[1] is None
+    assert cache.get("other-model", ["second"]) == [None]
+    cache.clear()
+    assert cache.get(MODEL_NAME, ["second"]) == [None]
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_async(tmp_path):
+    reset_limit_info()
+    FakeOpenAIEmbeddings.calls.clear()
+    embeddings = _embeddings(EmbeddingCache(str(tmp_path)))
+    assert await embeddings.aembed_documents(["first"]) == [[5.0, 0.0]]
+    assert await embeddings.aembed_query("first") == [5.0, 0.0]
+    assert len(FakeOpenAIEmbeddings.calls) == 1
+
+
+def test_embedding_cache_overwrites_interrupted_write(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    # Garbage of writes which crashed before the index was updated
+    with open(cache._vector_file(MODEL_NAME), "wb") as dst:
+        dst.write(b"\x01\x02\x03")
+    cache.set(MODEL_NAME, ["first", "first"], [[1.0, 0.0], [1.0, 0.0]])
+    with open(cache._vector_file(MODEL_NAME), "ab") as dst:
+        dst.write(b"\x01\x02\x03")
+    cache.set(MODEL_NAME, ["second"], [[2.0, 0.0]])
+    assert [vector.tolist() for vector in cache.get(MODEL_NAME, ["first", "second"])] == \
+        [[1.0, 0.0], [2.0, 0.0]]
+    assert os.path.getsize(cache._vector_file(MODEL_NAME)) == 2 * 2 * 4
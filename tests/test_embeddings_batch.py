@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+import pytest
+from langchain_openai_limiter import ChooseKeyOpenAIEmbeddings, LimitAwaitOpenAIEmbeddings
+from langchain_openai_limiter.embeddings_batch import chunk_token_limit, split_texts
+from langchain_openai_limiter.limit_info import OrganizationLimitInfo, set_limit_info, \
+    reset_limit_info
+from .utils import FakeOpenAIEmbeddings
+
+
+MODEL_NAME = "text-embedding-ada-002"
+API_KEYS = ["sk-first", "sk-second"]
+
+
+def _set_limit(api_key: str, tpm_total: int) -> None:
+    reset_time = datetime.now() + timedelta(milliseconds=50)
+    set_limit_info(MODEL_NAME, api_key, OrganizationLimitInfo(
+        tpm_total=tpm_total,
+        tpm_remain=tpm_total,
+        rpm_total=100,
+        rpm_remain=100,
+        rpm_reset_time=reset_time,
+        tpm_reset_time=reset_time,
+    ))
+
+
+def _limit_await_embeddings(chunk_size: int = 1000) -> LimitAwaitOpenAIEmbeddings:
+    return LimitAwaitOpenAIEmbeddings(
+        openai_embeddings=FakeOpenAIEmbeddings(model=MODEL_NAME, openai_api_key="sk-fake",
+                                               chunk_size=chunk_size),
+        limit_await_timeout=5.0,
+        estimate_tokens=True,
+    )
+
+
+def test_split_texts():
+    assert split_texts([5, 5, 5, 20, 1], max_tokens=10, max_inputs=10) == [[0, 1], [2], [3], [4]]
+    assert split_texts([1, 1, 1], max_tokens=10, max_inputs=2) == [[0, 1], [2]]
+
+
+def test_limit_await_embeddings_split_inputs_above_tpm_window():
+    reset_limit_info()
+    FakeOpenAIEmbeddings.calls.clear()
+    _set_limit("sk-fake", tpm_total=100)
+    texts = [f"text number {i:04d}" for i in range(20)] # 16 bytes each
+    embeddings = _limit_await_embeddings()
+    assert embeddings.embed_documents(texts) == [[16.0, 0.0]] * 20
+    assert len(FakeOpenAIEmbeddings.calls) > 1
+    assert all(len(call["texts"]) <= 6 for call in FakeOpenAIEmbeddings.calls)
+
+
+def test_choose_key_embeddings_fan_out_across_keys():
+    reset_limit_info()
+    FakeOpenAIEmbeddings.calls.clear()
+    for api_key in API_KEYS:
+        _set_limit(api_key, tpm_total=10000)
+    texts = [f"document {i}" for i in range(30)]
+    embeddings = ChooseKeyOpenAIEmbeddings(
+        openai_embeddings=_limit_await_embeddings(chunk_size=8),
+        openai_api_keys=API_KEYS,
+    )
+    assert embeddings.embed_documents(texts) == [[float(len(text)), 0.0] for text in texts]
+    assert {call["api_key"] for call in FakeOpenAIEmbeddings.calls} == set(API_KEYS)
+    assert all(len(call["texts"]) <= 8 for call in FakeOpenAIEmbeddings.calls)
+
+
+def test_choose_key_embeddings_send_small_inputs_at_once():
+    reset_limit_info()
+    FakeOpenAIEmbeddings.calls.clear()
+    api_keys = [f"sk-key-{i}" for i in range(4)]
+    for api_key in api_keys:
+        _set_limit(api_key, tpm_total=10000)
+    texts = ["first", "second", "third", "fourth"]
+    embeddings = ChooseKeyOpenAIEmbeddings(
+        openai_embeddings=_limit_await_embeddings(),
+        openai_api_keys=api_keys,
+    )
+    assert embeddings.embed_documents(texts) == [[float(len(text)), 0.0] for text in texts]
+    assert [call["texts"] for call in FakeOpenAIEmbeddings.calls] == [texts]
+
+
+def test_chunk_token_limit_spreads_large_inputs():
+    reset_limit_info()
+    for api_key in API_KEYS:
+        _set_limit(api_key, tpm_total=100000)
+    assert chunk_token_limit(MODEL_NAME, API_KEYS, 1000) == 8192
+    assert chunk_token_limit(MODEL_NAME, API_KEYS, 60000) == 30000
+    # Does not fit the remaining TPM of any key
+    assert chunk_token_limit(MODEL_NAME, API_KEYS, 150000) == 75000
+
+
+@pytest.mark.asyncio
+async def test_choose_key_embeddings_async_keep_order():
+    reset_limit_info()
+    FakeOpenAIEmbeddings.calls.clear()
+    texts = [f"document {'x' * i}" for i in range(30)]
+    embeddings = ChooseKeyOpenAIEmbeddings(
+        openai_embeddings=_limit_await_embeddings(chunk_size=4),
+        openai_api_keys=API_KEYS,
+    )
+    assert await embeddings.aembed_documents(texts) == [[float(len(text)), 0.0] for text in texts]
+    assert len(FakeOpenAIEmbeddings.calls) >= 8
+
+
+def test_embeddings_deduplicate_texts():
+    reset_limit_info()
+    FakeOpenAIEmbeddings.calls.clear()
+    texts = ["license", "first", "license", "second", "first"]
+    result = _limit_await_embeddings().embed_documents(texts)
+    assert result == [[float(len(text)), 0.0] for text in texts]
+    assert result[0] is not result[2]
+    assert [call["texts"] for call in FakeOpenAIEmbeddings.calls] == \
+        [["license", "first", "second"]]
+
+
+@pytest.mark.asyncio
+async def test_choose_key_embeddings_deduplicate_texts_async():
+    reset_limit_info()
+    FakeOpenAIEmbeddings.calls.clear()
+    texts = ["license"] * 10 + ["first"]
+    embeddings = ChooseKeyOpenAIEmbeddings(
+        openai_embeddings=_limit_await_embeddings(),
+        openai_api_keys=API_KEYS,
+    )
+    assert await embeddings.aembed_documents(texts) == [[float(len(text)), 0.0] for text in texts]
+    assert sorted(text for call in FakeOpenAIEmbeddings.calls for text in call["texts"]) == \
+        ["first", "license"]
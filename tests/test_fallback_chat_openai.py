@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+import pytest
+from langchain.schema import HumanMessage, LLMResult
+from langchain_openai_limiter import ChooseKeyChatOpenAI, LimitAwaitChatOpenAI, \
+    FallbackChatOpenAI, FallbackTier
+from langchain_openai_limiter.fallback_chat_openai import FALLBACK_TIER_KEY
+from langchain_openai_limiter.limit_info import OrganizationLimitInfo, set_limit_info, \
+    reset_limit_info, predict_wait, get_limit_info
+from .utils import FakeChatOpenAI
+
+
+def _set_limit(model_name: str, api_key: str, tpm_remain: int, reset_in: float) -> None:
+    reset_time = datetime.now() + timedelta(seconds=reset_in)
+    set_limit_info(model_name, api_key, OrganizationLimitInfo(
+        tpm_total=1000,
+        tpm_remain=tpm_remain,
+        rpm_total=100,
+        rpm_remain=100,
+        rpm_reset_time=reset_time,
+        tpm_reset_time=reset_time,
+    ))
+
+
+def _tier(model_name: str, api_key: str, max_wait: float) -> FallbackTier:
+    return FallbackTier(
+        chat_model=ChooseKeyChatOpenAI(
+            chat_openai=LimitAwaitChatOpenAI(
+                chat_openai=FakeChatOpenAI(model_name=model_name, openai_api_key=api_key),
+                estimate_tokens=True,
+            ),
+            openai_api_keys=[api_key],
+        ),
+        max_wait=max_wait,
+    )
+
+
+def _router() -> FallbackChatOpenAI:
+    return FallbackChatOpenAI(tiers=[
+        _tier("gpt-4-0613", "sk-premium", 1.0),
+        _tier("gpt-3.5-turbo-0613", "sk-cheap", 1.0),
+    ])
+
+
+def _used_tier(result: LLMResult) -> int:
+    return result.generations[0][0].generation_info[FALLBACK_TIER_KEY]
+
+
+def test_predict_wait():
+    reset_limit_info()
+    assert predict_wait("gpt-4-0613", ["sk-premium"], 100) == 0.0
+    _set_limit("gpt-4-0613", "sk-premium", 0, 30.0)
+    assert 29.0 < predict_wait("gpt-4-0613", ["sk-premium"], 100) <= 30.0
+    assert predict_wait("gpt-4-0613", ["sk-premium"], 1000) == float("inf")
+
+
+def test_fallback_routes_to_first_tier_which_fits():
+    reset_limit_info()
+    router = _router()
+    message = HumanMessage(content="What is Markdown?")
+    assert _used_tier(router.generate([[message]])) == 0
+    _set_limit("gpt-4-0613", "sk-premium", 0, 30.0)
+    FakeChatOpenAI.calls.clear()
+    assert _used_tier(router.generate([[message]])) == 1
+    assert [call["api_key"] for call in FakeChatOpenAI.calls] == ["sk-cheap"]
+
+
+@pytest.mark.asyncio
+async def test_fallback_overflow_goes_to_tier_freed_first():
+    reset_limit_info()
+    router = _router()
+    _set_limit("gpt-4-0613", "sk-premium", 0, 30.0)
+    _set_limit("gpt-3.5-turbo-0613", "sk-cheap", 0, 0.2)
+    message = HumanMessage(content="What is Markdown?")
+    result = await router.agenerate([[message]])
+    assert _used_tier(result) == 1
+
+
+def test_fallback_routes_by_exact_token_count():
+    reset_limit_info()
+    router = _router()
+    # 9 tokens by the fake tokenizer, while the byte length bound is about 30
+    _set_limit("gpt-4-0613", "sk-premium", 20, 30.0)
+    message = HumanMessage(content="What is Markdown?")
+    assert _used_tier(router.generate([[message]])) == 0
+    # The tier reserved the router count instead of its own estimate
+    assert get_limit_info("gpt-4-0613", "sk-premium").tpm_remain == 11
+    assert FakeChatOpenAI.calls[-1]["kwargs"] == {}
@@ -0,0 +1,112 @@
+import asyncio
+from datetime import datetime, timedelta
+import time
+import pytest
+from langchain.schema import HumanMessage
+from langchain_openai_limiter import ChooseKeyChatOpenAI, LimitAwaitChatOpenAI
+from langchain_openai_limiter.hedging import _LATENCY_STORE, reset_latency_info
+from langchain_openai_limiter.limit_info import OrganizationLimitInfo, set_limit_info, \
+    get_limit_info, reset_limit_info, set_api_key_organization, snapshot_limits
+from .utils import FakeChatOpenAI
+
+
+MODEL_NAME = "gpt-4-0613"
+SLOW_KEY = "sk-slow"
+FAST_KEY = "sk-fast"
+SLOW_ORG_KEY = "sk-slow-org"
+CALLED_KEYS = []
+
+
+class SlowKeyFakeChatOpenAI(FakeChatOpenAI):
+    """
+    Fake chat model which answers slowly via `SLOW_KEY`
+    """
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        CALLED_KEYS.append(self.openai_api_key)
+        if self.openai_api_key in (SLOW_KEY, SLOW_ORG_KEY):
+            await asyncio.sleep(5.0)
+        return self._generate(messages, stop, run_manager, **kwargs)
+
+
+def _hedged_chat_model(api_keys) -> ChooseKeyChatOpenAI:
+    return ChooseKeyChatOpenAI(
+        chat_openai=LimitAwaitChatOpenAI(
+            chat_openai=SlowKeyFakeChatOpenAI(
+                model_name=MODEL_NAME,
+                openai_api_key="sk-fake",
+            )
+        ),
+        openai_api_keys=api_keys,
+        hedge=True,
+        hedge_delay=0.05,
+    )
+
+
+def _set_limit(api_key: str, tpm_remain: int) -> None:
+    reset_time = datetime.now() + timedelta(minutes=1)
+    set_limit_info(MODEL_NAME, api_key, OrganizationLimitInfo(
+        tpm_total=1000,
+        tpm_remain=tpm_remain,
+        rpm_total=100,
+        rpm_remain=100,
+        rpm_reset_time=reset_time,
+        tpm_reset_time=reset_time,
+    ))
+
+
+@pytest.mark.asyncio
+async def test_hedged_request_uses_faster_key():
+    reset_limit_info()
+    # Slow key has more headroom, so it is tried first
+    _set_limit(SLOW_KEY, 1000)
+    _set_limit(FAST_KEY, 900)
+    chat_model = ChooseKeyChatOpenAI(
+        chat_openai=LimitAwaitChatOpenAI(
+            chat_openai=SlowKeyFakeChatOpenAI(
+                model_name=MODEL_NAME,
+                openai_api_key="sk-fake",
+            )
+        ),
+        openai_api_keys=[SLOW_KEY, FAST_KEY],
+        hedge=True,
+        hedge_delay=0.05,
+    )
+    start_time = time.monotonic()
+    result = await chat_model.ainvoke([HumanMessage(content="What is Markdown?")])
+    assert result.content == "What is Markdown?"
+    assert time.monotonic() - start_time < 1.0
+    await asyncio.sleep(0)
+    assert get_limit_info(MODEL_NAME, SLOW_KEY).tpm_remain == 1000
+    assert get_limit_info(MODEL_NAME, SLOW_KEY).rpm_remain == 100
+
+
+@pytest.mark.asyncio
+async def test_hedged_request_accounts_both_requests():
+    reset_limit_info()
+    reset_latency_info()
+    _set_limit(SLOW_KEY, 1000)
+    _set_limit(FAST_KEY, 900)
+    await _hedged_chat_model([SLOW_KEY, FAST_KEY]).ainvoke([HumanMessage(content="Hi")])
+    # The cancelled slow request is accounted as a latency lower bound
+    latencies = sorted(_LATENCY_STORE[MODEL_NAME])
+    assert len(latencies) == 2
+    assert latencies[0] < latencies[1] and latencies[1] >= 0.05
+    # The winner budget is spent, not left in flight
+    assert all(snapshot.in_flight == 0 for snapshot in snapshot_limits())
+
+
+@pytest.mark.asyncio
+async def test_request_is_not_hedged_via_same_organization():
+    reset_limit_info()
+    reset_latency_info()
+    set_api_key_organization(SLOW_KEY, "org-slow")
+    set_api_key_organization(SLOW_ORG_KEY, "org-slow")
+    _set_limit(SLOW_KEY, 1000)
+    CALLED_KEYS.clear()
+    chat_model = _hedged_chat_model([SLOW_KEY, SLOW_ORG_KEY])
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(chat_model.ainvoke([HumanMessage(content="Hi")]), 0.3)
+    # Keys of one organization share limits, so a hedge would not help
+    assert len(CALLED_KEYS) == 1
+    await asyncio.sleep(0)
+    assert get_limit_info(MODEL_NAME, SLOW_KEY).rpm_remain == 100
@@ -0,0 +1,38 @@
+import subprocess
+import sys
+
+
+# Generous budget: the package itself should only import the standard library
+PACKAGE_IMPORT_BUDGET = 0.1
+
+
+def _run(code: str) -> str:
+    return subprocess.run([sys.executable, "-c", code], check=True, capture_output=True,
+                          text=True).stdout.strip()
+
+
+def test_package_import_is_lazy_and_fast():
+    output = _run(
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import langchain_openai_limiter\n"
+        "print(time.perf_counter() - start)\n"
+        "print(sorted(name for name in ('langchain', 'openai', 'tiktoken', 'aiohttp', "
+        "'requests', 'numpy') if name in sys.modules))\n"
+    )
+    import_time, loaded = output.splitlines()
+    assert loaded == "[]"
+    assert float(import_time) < PACKAGE_IMPORT_BUDGET
+
+
+def test_embeddings_import_does_not_load_chat_models_or_attach_hooks():
+    output = _run(
+        "import sys\n"
+        "from langchain_openai_limiter import LimitAwaitOpenAIEmbeddings\n"
+        "from langchain_openai_limiter import capture_headers\n"
+        "print(sorted(name for name in ('langchain.chat_models', 'tiktoken', 'openai') "
+        "if name in sys.modules))\n"
+        "print(capture_headers._ATTACHED_SYNC_SESSION_HOOKS, "
+        "capture_headers._ATTACHED_ASYNC_SESSION_HOOKS)\n"
+    )
+    assert output.splitlines() == ["[]", "False False"]
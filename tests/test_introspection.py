@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import pytest
+from langchain_openai_limiter.introspection import SnapshotExporter, main, snapshot_dict, \
+    write_snapshot
+from langchain_openai_limiter.limit_info import OrganizationLimitInfo, key_fingerprint, \
+    record_rtt, reset_limit_info, reserve_any_key, set_api_key_organization, set_limit_info, \
+    snapshot_limits, wait_for_limit
+
+
+MODEL_NAME = "gpt-4-0613"
+API_KEY = "sk-secret-fake"
+
+
+def _set_limit(tpm_remain: int = 1000) -> None:
+    reset_time = datetime.now() + timedelta(minutes=1)
+    set_limit_info(MODEL_NAME, API_KEY, OrganizationLimitInfo(
+        tpm_total=1000,
+        tpm_remain=tpm_remain,
+        rpm_total=100,
+        rpm_remain=100,
+        rpm_reset_time=reset_time,
+        tpm_reset_time=reset_time,
+    ))
+
+
+def _wait_and_time_out() -> None:
+    with pytest.raises(TimeoutError):
+        wait_for_limit(MODEL_NAME, API_KEY, 100, 0.3, 0.01)
+
+
+def test_snapshot_counts_waiters():
+    reset_limit_info()
+    _set_limit(tpm_remain=10)
+    waiter = threading.Thread(target=_wait_and_time_out)
+    waiter.start()
+    time.sleep(0.1)
+    snapshot, = snapshot_limits()
+    assert snapshot.waiters == 1
+    assert snapshot.tpm_remain == 10
+    waiter.join()
+    snapshot, = snapshot_limits()
+    assert snapshot.waiters == 0
+
+
+def test_snapshot_counts_in_flight_reservations():
+    reset_limit_info()
+    _set_limit()
+    reservation = reserve_any_key(MODEL_NAME, [API_KEY], 100)
+    with reservation:
+        snapshot, = snapshot_limits()
+        assert (snapshot.in_flight, snapshot.in_flight_tokens) == (1, 100)
+        assert snapshot.tpm_remain == 900
+    snapshot, = snapshot_limits()
+    assert (snapshot.in_flight, snapshot.in_flight_tokens) == (0, 0)
+
+
+def test_snapshot_shows_organization_rtt():
+    reset_limit_info()
+    set_api_key_organization(API_KEY, "org-fake")
+    set_api_key_organization("sk-secret-fake-2", "org-fake")
+    _set_limit()
+    record_rtt(API_KEY, 0.1)
+    record_rtt("sk-secret-fake-2", 0.3)
+    snapshot, = snapshot_limits()
+    assert snapshot.rtt == pytest.approx(0.2)
+
+
+def test_snapshot_redacts_keys():
+    reset_limit_info()
+    _set_limit()
+    with reserve_any_key(MODEL_NAME, [API_KEY], 100):
+        dumped = json.dumps(snapshot_dict())
+    assert API_KEY not in dumped
+    assert key_fingerprint(API_KEY) in dumped
+
+
+def test_cli_prints_exported_snapshot(tmp_path, capsys):
+    reset_limit_info()
+    _set_limit()
+    path = str(tmp_path / "snapshot.json")
+    assert main([path, "--once"]) == 1
+    exporter = SnapshotExporter(path, interval=0.01).start()
+    time.sleep(0.1)
+    exporter.stop()
+    capsys.readouterr()
+    assert main([path, "--once"]) == 0
+    output = capsys.readouterr().out
+    assert key_fingerprint(API_KEY) in output
+    assert "1000/1000" in output
+    assert API_KEY not in output
+
+
+def test_module_entry_point(tmp_path):
+    reset_limit_info()
+    _set_limit()
+    path = str(tmp_path / "snapshot.json")
+    write_snapshot(path)
+    result = subprocess.run(
+        [sys.executable, "-m", "langchain_openai_limiter", "--once"],
+        env=dict(os.environ, LANGCHAIN_OPENAI_LIMITER_SNAPSHOT=path),
+        capture_output=True, text=True, check=True,
+    )
+    assert MODEL_NAME in result.stdout
+    assert key_fingerprint(API_KEY) in result.stdout
@@ -0,0 +1,77 @@
+from collections import Counter
+from datetime import datetime, timedelta
+import time
+import pytest
+from langchain_openai_limiter import ChooseKeyChatOpenAI, LimitAwaitChatOpenAI
+from langchain_openai_limiter.limit_batch import LimitAwareBatchMixin
+from langchain_openai_limiter.limit_info import OrganizationLimitInfo, set_limit_info, \
+    reset_limit_info
+from .utils import FakeChatOpenAI
+
+
+MODEL_NAME = "gpt-4-0613"
+API_KEYS = ["sk-fake0", "sk-fake1"]
+
+
+def _set_limits(tpm_remain: int) -> None:
+    reset_time = datetime.now() + timedelta(minutes=1)
+    for api_key in API_KEYS:
+        set_limit_info(MODEL_NAME, api_key, OrganizationLimitInfo(
+            tpm_total=1000,
+            tpm_remain=tpm_remain,
+            rpm_total=100,
+            rpm_remain=100,
+            rpm_reset_time=reset_time,
+            tpm_reset_time=reset_time,
+        ))
+
+
+def _build_chat_model(limit_await_timeout: float = 0.1) -> ChooseKeyChatOpenAI:
+    return ChooseKeyChatOpenAI(
+        chat_openai=LimitAwaitChatOpenAI(
+            chat_openai=FakeChatOpenAI(
+                model_name=MODEL_NAME,
+                openai_api_key="sk-fake",
+            )
+        ),
+        openai_api_keys=API_KEYS,
+        limit_await_timeout=limit_await_timeout,
+    )
+
+
+def test_choose_key_chat_openai_batch_spreads_across_keys():
+    reset_limit_info()
+    FakeChatOpenAI.calls.clear()
+    _set_limits(tpm_remain=1000)
+    inputs = [f"message number {i}" for i in range(8)]
+    results = _build_chat_model().batch(inputs)
+    assert [result.content for result in results] == inputs
+    assert FakeChatOpenAI.calls[-1]["kwargs"] == {}
+    used_keys = Counter(call["api_key"] for call in FakeChatOpenAI.calls)
+    assert set(used_keys) == set(API_KEYS)
+
+
+@pytest.mark.asyncio
+async def test_choose_key_chat_openai_abatch_reports_item_failures():
+    reset_limit_info()
+    FakeChatOpenAI.calls.clear()
+    # Short inputs fit the budget, while the long one never does
+    _set_limits(tpm_remain=40)
+    inputs = ["short", "long " * 100, "short again"]
+    results = await _build_chat_model().abatch(inputs, return_exceptions=True)
+    assert results[0].content == "short"
+    assert isinstance(results[1], TimeoutError)
+    assert results[2].content == "short again"
+
+
+def test_batch_fails_oversized_items_right_away():
+    reset_limit_info()
+    _set_limits(tpm_remain=1000)
+    inputs = ["long " * 1000, "short"]
+    start_time = time.monotonic()
+    results = _build_chat_model(limit_await_timeout=5.0).batch(inputs, return_exceptions=True)
+    assert time.monotonic() - start_time < 1.0
+    assert isinstance(results[0], TimeoutError)
+    assert results[1].content == "short"
+    with pytest.raises(TypeError):
+        LimitAwareBatchMixin()
@@ -0,0 +1,220 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import threading
+import time
+import pytest
+from langchain_openai_limiter.limit_info import OrganizationLimitInfo, set_limit_info, \
+    get_limit_info, reset_limit_info, wait_for_limit, await_for_limit, learn_model_alias, \
+    set_model_group, set_api_key_organization, reserve_any_key, set_daily_limit, \
+    DailyLimitExceededError, predict_wait, record_rtt, _next_daily_reset
+from langchain_openai_limiter.capture_headers import _extract_rtt
+
+
+MODEL_NAME = "gpt-4-0613"
+API_KEY = "sk-fake"
+
+
+def _set_limit(tpm_remain: int, rpm_remain: int = 100, model_name: str = MODEL_NAME) -> None:
+    reset_time = datetime.now() + timedelta(minutes=1)
+    set_limit_info(model_name, API_KEY, OrganizationLimitInfo(
+        tpm_total=1000,
+        tpm_remain=tpm_remain,
+        rpm_total=100,
+        rpm_remain=rpm_remain,
+        rpm_reset_time=reset_time,
+        tpm_reset_time=reset_time,
+    ))
+
+
+def _wait_until(condition, timeout: float = 1.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_wait_for_limit_admits_by_estimate():
+    reset_limit_info()
+    _set_limit(tpm_remain=1000)
+    dispatched = threading.Event()
+    exact_calls = []
+
+    def _exact_token_count():
+        exact_calls.append(dispatched.wait(1.0))
+        return 10
+
+    reservation = wait_for_limit(MODEL_NAME, API_KEY, 100, 0.1, 0.01, _exact_token_count)
+    # Admitted by the estimate, exact counting does not delay the dispatch
+    assert get_limit_info(MODEL_NAME, API_KEY).tpm_remain == 900
+    dispatched.set()
+    _wait_until(lambda: reservation.token_count == 10)
+    assert exact_calls == [True]
+    assert get_limit_info(MODEL_NAME, API_KEY).tpm_remain == 990
+
+
+@pytest.mark.asyncio
+async def test_await_for_limit_admits_by_estimate():
+    reset_limit_info()
+    _set_limit(tpm_remain=1000)
+    dispatched = asyncio.Event()
+    exact_calls = []
+
+    async def _exact_token_count():
+        exact_calls.append(dispatched.is_set())
+        return 10
+
+    reservation = await await_for_limit(MODEL_NAME, API_KEY, 100, 0.1, 0.01, _exact_token_count)
+    assert get_limit_info(MODEL_NAME, API_KEY).tpm_remain == 900
+    dispatched.set()
+    await asyncio.sleep(0.01)
+    assert exact_calls == [True]
+    assert reservation.token_count == 10
+    assert get_limit_info(MODEL_NAME, API_KEY).tpm_remain == 990
+
+
+def test_failed_request_admitted_by_estimate_refunds_estimate():
+    reset_limit_info()
+    _set_limit(tpm_remain=1000)
+    dispatched = threading.Event()
+
+    def _exact_token_count():
+        dispatched.wait(1.0)
+        return 10
+
+    reservation = wait_for_limit(MODEL_NAME, API_KEY, 100, 0.1, 0.01, _exact_token_count)
+    with pytest.raises(RuntimeError):
+        with reservation:
+            raise RuntimeError()
+    dispatched.set()
+    time.sleep(0.05)
+    assert get_limit_info(MODEL_NAME, API_KEY).tpm_remain == 1000
+
+
+def test_wait_for_limit_counts_exactly_near_limit():
+    reset_limit_info()
+    _set_limit(tpm_remain=50)
+    exact_calls = []
+
+    def _exact_token_count():
+        exact_calls.append(True)
+        return 10
+
+    wait_for_limit(MODEL_NAME, API_KEY, 100, 0.1, 0.01, _exact_token_count)
+    assert exact_calls == [True]
+    assert get_limit_info(MODEL_NAME, API_KEY).tpm_remain == 40
+
+
+def test_learned_model_alias_shares_limits():
+    reset_limit_info()
+    learn_model_alias("gpt-4", MODEL_NAME)
+    _set_limit(tpm_remain=1000)
+    wait_for_limit("gpt-4", API_KEY, 100, 0.1, 0.01)
+    assert get_limit_info(MODEL_NAME, API_KEY).tpm_remain == 900
+    assert get_limit_info("gpt-4", API_KEY).tpm_remain == 900
+
+
+def test_model_group_shares_limits():
+    reset_limit_info()
+    set_model_group("gpt-4", ["gpt-4", "gpt-4-0613", "gpt-4-0314"])
+    learn_model_alias("gpt-4", "gpt-4-0613") # Configured group takes precedence
+    _set_limit(tpm_remain=1000, model_name="gpt-4-0613")
+    wait_for_limit("gpt-4-0314", API_KEY, 100, 0.1, 0.01)
+    assert get_limit_info("gpt-4", API_KEY).tpm_remain == 900
+    assert get_limit_info("gpt-4-0613", API_KEY).tpm_remain == 900
+
+
+def test_organization_keys_share_limits():
+    reset_limit_info()
+    _set_limit(tpm_remain=1000)
+    set_api_key_organization(API_KEY, "org-fake")
+    set_api_key_organization("sk-fake-2", "org-fake")
+    wait_for_limit(MODEL_NAME, "sk-fake-2", 100, 0.1, 0.01)
+    assert get_limit_info(MODEL_NAME, API_KEY).tpm_remain == 900
+
+
+def test_reserve_any_key_spreads_across_organizations():
+    reset_limit_info()
+    _set_limit(tpm_remain=1000)
+    set_api_key_organization(API_KEY, "org-fake")
+    set_api_key_organization("sk-fake-2", "org-fake")
+    # The organization has less headroom than the key with unknown limits
+    for _ in range(10):
+        with reserve_any_key(MODEL_NAME, [API_KEY, "sk-fake-2", "sk-other"], 100) as reservation:
+            assert reservation.api_key == "sk-other"
+
+
+def test_daily_limit_fails_fast_and_survives_new_headers():
+    reset_limit_info()
+    _set_limit(tpm_remain=1000)
+    set_daily_limit(MODEL_NAME, API_KEY, tokens_per_day=150)
+    wait_for_limit(MODEL_NAME, API_KEY, 100, 10.0, 0.01)
+    _set_limit(tpm_remain=1000) # Per-minute headers do not reset daily quota
+    assert get_limit_info(MODEL_NAME, API_KEY).tpd_remain == 50
+    start_time = time.monotonic()
+    with pytest.raises(DailyLimitExceededError):
+        wait_for_limit(MODEL_NAME, API_KEY, 100, 10.0, 0.01)
+    assert time.monotonic() - start_time < 1.0
+
+
+def test_daily_limit_resets_at_utc_midnight():
+    def _local(utc_time: datetime) -> datetime:
+        return utc_time.astimezone().replace(tzinfo=None)
+
+    assert _next_daily_reset(datetime(2026, 3, 1, 23, 30, tzinfo=timezone.utc)) == \
+        _local(datetime(2026, 3, 2, tzinfo=timezone.utc))
+    # 20:00 at UTC-5 is already the next UTC day
+    assert _next_daily_reset(datetime(2026, 3, 1, 20, tzinfo=timezone(timedelta(hours=-5)))) == \
+        _local(datetime(2026, 3, 3, tzinfo=timezone.utc))
+
+
+def test_daily_limit_reroutes_to_other_key():
+    reset_limit_info()
+    _set_limit(tpm_remain=1000)
+    set_daily_limit(MODEL_NAME, API_KEY, requests_per_day=0)
+    for _ in range(10):
+        with reserve_any_key(MODEL_NAME, [API_KEY, "sk-other"], 100) as reservation:
+            assert reservation.api_key == "sk-other"
+
+
+def test_daily_limit_pacing():
+    reset_limit_info()
+    _set_limit(tpm_remain=1000)
+    set_daily_limit(MODEL_NAME, API_KEY, requests_per_day=48, pace=True)
+    get_limit_info(MODEL_NAME, API_KEY).daily_reset_time = datetime.now() + timedelta(hours=12)
+    admitted = 0
+    while reserve_any_key(MODEL_NAME, [API_KEY], 1) is not None:
+        admitted += 1
+    # Half of the day passed: half of the quota + one hour burst
+    assert admitted == 26
+    assert 1700 < predict_wait(MODEL_NAME, [API_KEY], 1) < 1900
+
+
+def test_reset_aligned_dispatch():
+    reset_limit_info()
+    _set_limit(tpm_remain=0)
+    limit_info = get_limit_info(MODEL_NAME, API_KEY)
+    limit_info.tpm_reset_time = datetime.now() + timedelta(seconds=0.3)
+    for _ in range(20):
+        record_rtt(API_KEY, 0.4)
+    with pytest.raises(TimeoutError):
+        wait_for_limit(MODEL_NAME, API_KEY, 100, 0.05, 0.01)
+    # The reset is ~0.25s away, while requests need ~0.4s to get there
+    wait_for_limit(MODEL_NAME, API_KEY, 100, 0.05, 0.01, align_reset=True)
+    # The early reset is not stored, so other waiters still wait for the reset
+    assert get_limit_info(MODEL_NAME, API_KEY).tpm_remain == 0
+    with pytest.raises(TimeoutError):
+        wait_for_limit(MODEL_NAME, API_KEY, 100, 0.05, 0.01)
+    # The early request is carried over to the new window
+    time.sleep(max((limit_info.tpm_reset_time - datetime.now()).total_seconds(), 0.0) + 0.01)
+    assert get_limit_info(MODEL_NAME, API_KEY).tpm_remain == 900
+
+
+def test_reset_aligned_dispatch_without_rtt_waits_for_reset():
+    reset_limit_info()
+    _set_limit(tpm_remain=0)
+    with pytest.raises(TimeoutError):
+        wait_for_limit(MODEL_NAME, API_KEY, 100, 0.05, 0.01, align_reset=True)
+
+
+def test_rtt_excludes_server_processing():
+    assert _extract_rtt(0.5, {"openai-processing-ms": "350"}) == pytest.approx(0.15)
+    assert _extract_rtt(0.5, {}) is None
@@ -0,0 +1,109 @@
+import asyncio
+from datetime import datetime, timedelta
+import pytest
+from langchain.schema import HumanMessage
+from langchain_openai_limiter import LimitAwaitChatOpenAI
+from langchain_openai_limiter.limit_info import OrganizationLimitInfo, set_limit_info, \
+    get_limit_info, reset_limit_info, wait_for_limit
+from .utils import FakeChatOpenAI
+
+
+MODEL_NAME = "gpt-4-0613"
+API_KEY = "sk-fake"
+
+
+class FailingFakeChatOpenAI(FakeChatOpenAI):
+    """
+    Fake chat model which fails every request
+    """
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        raise ValueError("Upstream failure")
+
+
+class HangingFakeChatOpenAI(FakeChatOpenAI):
+    """
+    Fake chat model which never answers asynchronyous requests
+    """
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(60.0)
+
+
+def _set_limit() -> None:
+    reset_time = datetime.now() + timedelta(minutes=1)
+    set_limit_info(MODEL_NAME, API_KEY, OrganizationLimitInfo(
+        tpm_total=1000,
+        tpm_remain=1000,
+        rpm_total=100,
+        rpm_remain=100,
+        rpm_reset_time=reset_time,
+        tpm_reset_time=reset_time,
+    ))
+
+
+def _assert_full_budget() -> None:
+    limit_info = get_limit_info(MODEL_NAME, API_KEY)
+    assert limit_info.tpm_remain == 1000
+    assert limit_info.rpm_remain == 100
+
+
+def test_reservation_is_kept_on_success_and_refunded_on_failure():
+    reset_limit_info()
+    _set_limit()
+    with wait_for_limit(MODEL_NAME, API_KEY, 100, 0.1, 0.01):
+        pass
+    assert get_limit_info(MODEL_NAME, API_KEY).tpm_remain == 900
+    _set_limit()
+    with pytest.raises(ValueError):
+        with wait_for_limit(MODEL_NAME, API_KEY, 100, 0.1, 0.01):
+            raise ValueError()
+    _assert_full_budget()
+
+
+def test_reservation_is_not_refunded_after_new_headers():
+    reset_limit_info()
+    _set_limit()
+    reservation = wait_for_limit(MODEL_NAME, API_KEY, 100, 0.1, 0.01)
+    _set_limit() # Headers of the request arrived - they already count it
+    get_limit_info(MODEL_NAME, API_KEY).tpm_remain = 500
+    reservation.refund()
+    assert get_limit_info(MODEL_NAME, API_KEY).tpm_remain == 500
+
+
+def test_failed_request_refunds_limits():
+    reset_limit_info()
+    _set_limit()
+    chat_model = LimitAwaitChatOpenAI(
+        chat_openai=FailingFakeChatOpenAI(model_name=MODEL_NAME, openai_api_key=API_KEY),
+    )
+    with pytest.raises(ValueError):
+        chat_model.invoke([HumanMessage(content="What is Markdown?")])
+    _assert_full_budget()
+
+
+def test_closed_stream_refunds_limits():
+    reset_limit_info()
+    _set_limit()
+    chat_model = LimitAwaitChatOpenAI(
+        chat_openai=FakeChatOpenAI(model_name=MODEL_NAME, openai_api_key=API_KEY),
+    )
+    stream = chat_model.stream([HumanMessage(content="What is Markdown?")])
+    next(stream)
+    assert get_limit_info(MODEL_NAME, API_KEY).rpm_remain == 99
+    stream.close()
+    _assert_full_budget()
+
+
+@pytest.mark.asyncio
+async def test_cancelled_request_refunds_limits():
+    reset_limit_info()
+    _set_limit()
+    chat_model = LimitAwaitChatOpenAI(
+        chat_openai=HangingFakeChatOpenAI(model_name=MODEL_NAME, openai_api_key=API_KEY),
+    )
+    task = asyncio.ensure_future(chat_model.ainvoke([HumanMessage(content="What is Markdown?")]))
+    await asyncio.sleep(0.05)
+    assert get_limit_info(MODEL_NAME, API_KEY).rpm_remain == 99
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    _assert_full_budget()
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+from langchain.schema import HumanMessage, SystemMessage
+from langchain_openai_limiter import ChooseKeyChatOpenAI, LimitAwaitChatOpenAI
+from langchain_openai_limiter.limit_info import OrganizationLimitInfo, set_limit_info, \
+    reset_limit_info, choose_key_by_affinity
+from .utils import FakeChatOpenAI
+
+
+MODEL_NAME = "gpt-4-0613"
+API_KEYS = [f"sk-fake-{i}" for i in range(4)]
+
+
+def _set_limit(api_key: str, tpm_remain: int) -> None:
+    reset_time = datetime.now() + timedelta(minutes=1)
+    set_limit_info(MODEL_NAME, api_key, OrganizationLimitInfo(
+        tpm_total=1000,
+        tpm_remain=tpm_remain,
+        rpm_total=100,
+        rpm_remain=100,
+        rpm_reset_time=reset_time,
+        tpm_reset_time=reset_time,
+    ))
+
+
+def test_same_prefix_goes_to_same_key():
+    reset_limit_info()
+    FakeChatOpenAI.calls.clear()
+    chat_model = ChooseKeyChatOpenAI(
+        chat_openai=LimitAwaitChatOpenAI(
+            chat_openai=FakeChatOpenAI(model_name=MODEL_NAME, openai_api_key=API_KEYS[0]),
+            estimate_tokens=True,
+        ),
+        openai_api_keys=API_KEYS,
+        prefix_affinity=True,
+    )
+    system_message = SystemMessage(content="You are a helpful assistant. " * 50)
+    for i in range(8):
+        chat_model.invoke([system_message, HumanMessage(content=f"Question {i}")])
+    assert len({call["api_key"] for call in FakeChatOpenAI.calls}) == 1
+
+
+def test_affinity_spills_when_preferred_key_is_exhausted_or_overloaded():
+    reset_limit_info()
+    for api_key in API_KEYS:
+        _set_limit(api_key, 1000)
+    preferred = choose_key_by_affinity(MODEL_NAME, API_KEYS, 100, "prefix")
+    assert choose_key_by_affinity(MODEL_NAME, API_KEYS, 100, "prefix") == preferred
+    _set_limit(preferred, 50) # Does not have headroom
+    assert choose_key_by_affinity(MODEL_NAME, API_KEYS, 100, "prefix") != preferred
+    _set_limit(preferred, 500) # Has headroom, but spent much more than others
+    assert choose_key_by_affinity(MODEL_NAME, API_KEYS, 100, "prefix") != preferred
+    for api_key in API_KEYS:
+        _set_limit(api_key, 500) # Load is even again
+    assert choose_key_by_affinity(MODEL_NAME, API_KEYS, 100, "prefix") == preferred
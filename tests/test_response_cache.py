@@ -0,0 +1,53 @@
+import os
+import pytest
+from langchain.schema import HumanMessage
+from langchain_openai_limiter import LimitAwaitChatOpenAI
+from langchain_openai_limiter.limit_info import reset_limit_info
+from langchain_openai_limiter.response_cache import ResponseCache
+from .utils import FakeChatOpenAI
+
+
+def _build_chat_model(response_cache: ResponseCache) -> LimitAwaitChatOpenAI:
+    return LimitAwaitChatOpenAI(
+        chat_openai=FakeChatOpenAI(
+            model_name="gpt-4-0613",
+            openai_api_key="sk-fake",
+            temperature=0,
+        ),
+        response_cache=response_cache,
+    )
+
+
+def test_response_cache_serves_repeated_prompts():
+    reset_limit_info()
+    FakeChatOpenAI.calls.clear()
+    chat_model = _build_chat_model(ResponseCache())
+    history = [HumanMessage(content="Classify this sentence")]
+    first = chat_model.invoke(history)
+    second = chat_model.invoke(history)
+    assert first.content == second.content == "Classify this sentence"
+    assert len(FakeChatOpenAI.calls) == 1
+    chunks = [chunk.content for chunk in chat_model.stream(history)]
+    assert "".join(chunks) == "Classify this sentence"
+    assert len(FakeChatOpenAI.calls) == 1
+
+
+def test_response_cache_expires():
+    FakeChatOpenAI.calls.clear()
+    chat_model = _build_chat_model(ResponseCache(ttl=-1.0))
+    history = [HumanMessage(content="Classify this sentence")]
+    chat_model.invoke(history)
+    chat_model.invoke(history)
+    assert len(FakeChatOpenAI.calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_response_cache_disk_tier(tmp_path):
+    FakeChatOpenAI.calls.clear()
+    path = os.path.join(tmp_path, "responses.sqlite")
+    history = [HumanMessage(content="Extract entities")]
+    async for _ in _build_chat_model(ResponseCache(path=path)).astream(history):
+        pass
+    result = await _build_chat_model(ResponseCache(path=path)).ainvoke(history)
+    assert result.content == "Extract entities"
+    assert len(FakeChatOpenAI.calls) == 1
@@ -0,0 +1,77 @@
+from asyncio import gather
+import threading
+import time
+import pytest
+from langchain.schema import HumanMessage
+from langchain_openai_limiter import LimitAwaitChatOpenAI
+from langchain_openai_limiter.single_flight import single_flight
+from .utils import FakeChatOpenAI
+
+
+def test_single_flight_runs_sequential_calls_separately():
+    calls = []
+
+    def _call():
+        calls.append(True)
+        return [1.0, 2.0]
+
+    assert single_flight("key", _call) == [1.0, 2.0]
+    assert single_flight("key", _call) == [1.0, 2.0]
+    assert len(calls) == 2
+
+
+class SlowFakeChatOpenAI(FakeChatOpenAI):
+    """
+    Fake chat model which keeps the request in flight for a while
+    """
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(0.2)
+        return super()._generate(messages, stop, run_manager, **kwargs)
+
+
+def test_limitawait_chat_openai_coalesces_concurrent_sync_requests():
+    FakeChatOpenAI.calls.clear()
+    chat_model = LimitAwaitChatOpenAI(
+        chat_openai=SlowFakeChatOpenAI(
+            model_name="gpt-4-0613",
+            openai_api_key="sk-fake",
+            temperature=0,
+        ),
+        single_flight=True,
+    )
+    barrier = threading.Barrier(8)
+    results = []
+
+    def _generate():
+        barrier.wait()
+        results.append(chat_model.generate([[HumanMessage(content="What is Markdown?")]]))
+
+    workers = [threading.Thread(target=_generate) for _ in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert len(FakeChatOpenAI.calls) == 1
+    assert [result.generations[0][0].text for result in results] == ["What is Markdown?"] * 8
+
+
+@pytest.mark.asyncio
+async def test_limitawait_chat_openai_coalesces_identical_requests():
+    FakeChatOpenAI.calls.clear()
+    chat_model = LimitAwaitChatOpenAI(
+        chat_openai=FakeChatOpenAI(
+            model_name="gpt-4-0613",
+            openai_api_key="sk-fake",
+            temperature=0,
+        ),
+        single_flight=True,
+    )
+    history = [HumanMessage(content="What is Markdown?")]
+    results = await gather(
+        chat_model.agenerate([history]),
+        chat_model.agenerate([history]),
+        chat_model.agenerate([[HumanMessage(content="What is Brainfuck?")]]),
+    )
+    assert len(FakeChatOpenAI.calls) == 2
+    assert results[0].generations[0][0].text == "What is Markdown?"
+    assert results[1].generations[0][0].text == "What is Markdown?"
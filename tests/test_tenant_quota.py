@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta
+from typing import List
+import pytest
+from langchain_openai_limiter import ChooseKeyChatOpenAI, LimitAwaitChatOpenAI, \
+    LimitAwaitOpenAIEmbeddings
+from langchain_openai_limiter.limit_info import OrganizationLimitInfo, set_limit_info, \
+    get_limit_info, reset_limit_info, reserve_any_key, set_tenant_quota
+from .utils import FakeChatOpenAI, FakeOpenAIEmbeddings
+
+
+MODEL_NAME = "gpt-4-0613"
+EMBEDDING_MODEL_NAME = "text-embedding-ada-002"
+API_KEY = "sk-fake"
+
+
+class WordCountEmbeddings(LimitAwaitOpenAIEmbeddings):
+    """
+    Limit awaiting embeddings which count words as tokens (so tiktoken is not needed)
+    """
+    def get_num_tokens(self, texts: List[str]) -> int:
+        return sum(len(text.split()) for text in texts)
+
+    async def aget_num_tokens(self, texts: List[str]) -> int:
+        return self.get_num_tokens(texts)
+
+
+def _set_limit(model_name: str = MODEL_NAME) -> None:
+    reset_time = datetime.now() + timedelta(minutes=1)
+    set_limit_info(model_name, API_KEY, OrganizationLimitInfo(
+        tpm_total=1000,
+        tpm_remain=1000,
+        rpm_total=100,
+        rpm_remain=100,
+        rpm_reset_time=reset_time,
+        tpm_reset_time=reset_time,
+    ))
+
+
+def test_borrowing_keeps_guarantees_of_other_tenants():
+    reset_limit_info()
+    _set_limit()
+    set_tenant_quota("interactive", 0.5)
+    set_tenant_quota("reports", 0.2)
+    # Idle capacity is 300 tokens: the rest is guaranteed to other tenants
+    assert reserve_any_key(MODEL_NAME, [API_KEY], 250, "bulk") is not None
+    assert reserve_any_key(MODEL_NAME, [API_KEY], 100, "bulk") is None
+    # Guaranteed share is still there
+    assert reserve_any_key(MODEL_NAME, [API_KEY], 500, "interactive") is not None
+    assert reserve_any_key(MODEL_NAME, [API_KEY], 200, "reports") is not None
+
+
+def test_max_share_caps_burst():
+    reset_limit_info()
+    _set_limit()
+    set_tenant_quota("bulk", 0.0, max_share=0.3)
+    assert reserve_any_key(MODEL_NAME, [API_KEY], 300, "bulk") is not None
+    assert reserve_any_key(MODEL_NAME, [API_KEY], 10, "bulk") is None
+    assert reserve_any_key(MODEL_NAME, [API_KEY], 10) is not None
+
+
+def test_refund_restores_tenant_share():
+    reset_limit_info()
+    _set_limit()
+    set_tenant_quota("bulk", 0.0, max_share=0.3)
+    with pytest.raises(RuntimeError):
+        with reserve_any_key(MODEL_NAME, [API_KEY], 300, "bulk"):
+            raise RuntimeError()
+    assert get_limit_info(MODEL_NAME, API_KEY).tpm_remain == 1000
+    assert reserve_any_key(MODEL_NAME, [API_KEY], 300, "bulk") is not None
+
+
+def test_chat_wrappers_take_tenant_from_call_kwargs():
+    reset_limit_info()
+    FakeChatOpenAI.calls.clear()
+    _set_limit()
+    set_tenant_quota("bulk", 0.0, max_share=0.01)
+    chat_model = LimitAwaitChatOpenAI(
+        chat_openai=FakeChatOpenAI(model_name=MODEL_NAME, openai_api_key=API_KEY),
+        limit_await_timeout=0.05,
+    )
+    assert chat_model.invoke("hello", tenant="other").content == "hello"
+    assert FakeChatOpenAI.calls[-1]["kwargs"] == {}
+    with pytest.raises(TimeoutError):
+        chat_model.invoke("hello " * 20, tenant="bulk")
+    choose_key_model = ChooseKeyChatOpenAI(
+        chat_openai=FakeChatOpenAI(model_name=MODEL_NAME, openai_api_key=API_KEY),
+        openai_api_keys=[API_KEY],
+    )
+    assert choose_key_model.invoke("hello", tenant="bulk").content == "hello"
+    assert FakeChatOpenAI.calls[-1]["kwargs"] == {}
+
+
+@pytest.mark.asyncio
+async def test_embeddings_take_tenant_per_call():
+    reset_limit_info()
+    _set_limit(EMBEDDING_MODEL_NAME)
+    set_tenant_quota("bulk", 0.0, max_share=0.01)
+    embeddings = WordCountEmbeddings(
+        FakeOpenAIEmbeddings(model=EMBEDDING_MODEL_NAME, openai_api_key=API_KEY),
+        limit_await_timeout=0.05,
+        estimate_tokens=True,
+    )
+    texts = ["some text " * 10]
+    assert await embeddings.aembed_documents(texts, tenant="other") == [[100.0, 0.0]]
+    with pytest.raises(TimeoutError):
+        await embeddings.aembed_documents(texts, tenant="bulk")
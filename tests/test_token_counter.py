@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import pytest
+from langchain.schema import SystemMessage, HumanMessage
+from langchain_openai_limiter.token_counter import num_tokens_from_messages, \
+    anum_tokens_from_messages, configure_token_counter, configure_async_tokenization, \
+    reset_token_counter
+
+
+class CountingChatModel:
+    """
+    Chat model stub with OpenAI-like additive token counting
+    """
+    model_name = "gpt-4-0613"
+    tiktoken_model_name = None
+
+    def __init__(self):
+        self.counted_messages = 0
+
+    def get_num_tokens_from_messages(self, messages):
+        self.counted_messages += len(messages)
+        return 3 + sum(3 + len(message.content.split()) for message in messages)
+
+
+def test_num_tokens_from_messages_matches_model():
+    reset_token_counter()
+    chat_model = CountingChatModel()
+    history = [
+        SystemMessage(content="You are a helpful assistant"),
+        HumanMessage(content="Translate this sentence"),
+    ]
+    expected = CountingChatModel().get_num_tokens_from_messages(history)
+    assert num_tokens_from_messages(chat_model, history) == expected
+    assert num_tokens_from_messages(chat_model, []) == 3
+
+
+def test_num_tokens_from_messages_counts_only_new_messages():
+    reset_token_counter()
+    chat_model = CountingChatModel()
+    history = [
+        SystemMessage(content="You are a helpful assistant"),
+        HumanMessage(content="Translate this sentence"),
+    ]
+    num_tokens_from_messages(chat_model, history)
+    counted = chat_model.counted_messages
+    history.append(HumanMessage(content="And this one too"))
+    num_tokens_from_messages(chat_model, history)
+    assert chat_model.counted_messages == counted + 1
+
+
+def test_token_counter_cache_is_bounded():
+    reset_token_counter()
+    configure_token_counter(cache_size=2)
+    try:
+        chat_model = CountingChatModel()
+        history = [HumanMessage(content=f"message {i}") for i in range(3)]
+        num_tokens_from_messages(chat_model, history)
+        counted = chat_model.counted_messages
+        num_tokens_from_messages(chat_model, history[:1])
+        assert chat_model.counted_messages > counted
+    finally:
+        configure_token_counter()
+
+
+@pytest.mark.asyncio
+async def test_anum_tokens_from_messages_offloads_large_inputs():
+    reset_token_counter()
+    chat_model = CountingChatModel()
+    history = [
+        SystemMessage(content="You are a helpful assistant"),
+        HumanMessage(content="Translate this sentence"),
+    ]
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="tokenize") as executor:
+        threads = []
+        original_count = chat_model.get_num_tokens_from_messages
+
+        def _count(messages):
+            threads.append(threading.current_thread().name)
+            return original_count(messages)
+
+        chat_model.get_num_tokens_from_messages = _count
+        try:
+            configure_async_tokenization(executor=executor, inline_threshold=1000)
+            await anum_tokens_from_messages(chat_model, history[:1])
+            assert not any(name.startswith("tokenize") for name in threads)
+            configure_async_tokenization(executor=executor, inline_threshold=0)
+            expected = CountingChatModel().get_num_tokens_from_messages(history)
+            assert await anum_tokens_from_messages(chat_model, history) == expected
+            assert threads[-1].startswith("tokenize")
+        finally:
+            configure_async_tokenization()
@@ -1,6 +1,13 @@
+import base64
 import os
+from typing import AsyncIterator, ClassVar, Iterator, List
 from dotenv import load_dotenv
+import numpy as np
 import pytest
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.schema.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain.schema.output import ChatGeneration, ChatGenerationChunk, ChatResult
 
 
 ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
@@ -11,3 +18,89 @@ def load_env():
     env_file = os.path.join(ROOT_DIR, ".env")
     if os.path.exists(env_file):
         load_dotenv(env_file)
+
+
+class FakeChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI which does not call OpenAI: it counts words as tokens
+    and answers with the last message content
+    """
+    calls: ClassVar[List[dict]] = []
+
+    def get_num_tokens_from_messages(self, messages: List[BaseMessage]) -> int:
+        return 3 + sum(3 + len(message.content.split()) for message in messages)
+
+    def _answer(self, messages: List[BaseMessage], kwargs: dict) -> str:
+        FakeChatOpenAI.calls.append({
+            "api_key": self.openai_api_key,
+            "messages": messages,
+            "kwargs": kwargs,
+        })
+        return messages[-1].content
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        content = self._answer(messages, kwargs)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return self._generate(messages, stop, run_manager, **kwargs)
+
+    def _stream(self, messages, stop=None, run_manager=None,
+                **kwargs) -> Iterator[ChatGenerationChunk]:
+        words = self._answer(messages, kwargs).split(" ")
+        for i, word in enumerate(words):
+            if i < len(words) - 1:
+                word += " "
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word))
+
+    async def _astream(self, messages, stop=None, run_manager=None,
+                       **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        for chunk in self._stream(messages, stop, run_manager, **kwargs):
+            yield chunk
+
+
+class FakeEmbeddingClient:
+    """
+    `openai.Embedding` replacement which answers like `FakeOpenAIEmbeddings`
+    with base64-encoded float32 vectors
+    """
+    @classmethod
+    def create(cls, input: List[str], api_key: str, **kwargs) -> dict:
+        FakeOpenAIEmbeddings.calls.append({
+            "api_key": api_key,
+            "texts": input,
+        })
+        return {"data": [
+            {
+                "index": i,
+                "embedding": base64.b64encode(
+                    np.array([len(text), 0.0], dtype=np.float32).tobytes()
+                ).decode("ascii"),
+            }
+            for i, text in enumerate(input)
+        ]}
+
+    @classmethod
+    async def acreate(cls, **kwargs) -> dict:
+        return cls.create(**kwargs)
+
+
+class FakeOpenAIEmbeddings(OpenAIEmbeddings):
+    """
+    OpenAIEmbeddings which does not call OpenAI: the vector of a text is [its length, 0]
+    """
+    calls: ClassVar[List[dict]] = []
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.client = FakeEmbeddingClient
+
+    def embed_documents(self, texts: List[str], chunk_size: int = 0) -> List[List[float]]:
+        FakeOpenAIEmbeddings.calls.append({
+            "api_key": self.openai_api_key,
+            "texts": texts,
+        })
+        return [[float(len(text)), 0.0] for text in texts]
+
+    async def aembed_documents(self, texts: List[str], chunk_size: int = 0) -> List[List[float]]:
+        return self.embed_documents(texts, chunk_size)